@@ -3,8 +3,10 @@
 #
 
 prodhome = "/home/nas/flask/imagelib"
+import mimetypes
 import os
 import sys
+import time
 if (os.path.exists(prodhome)):
     sys.path.insert(0, prodhome)
 else:
@@ -24,6 +26,8 @@ dictConfig({
 })
 
 import flask
+import urllib.parse
+import werkzeug.utils
 app = flask.Flask(__name__)
 
 _key_file = os.path.join(prodhome, '.secret_key') if os.path.exists(prodhome) else '.secret_key'
@@ -37,8 +41,19 @@ if not _secret_key:
     raise RuntimeError('Set IMAGELIB_SECRET_KEY env var or create .secret_key file')
 app.secret_key = _secret_key
 
+# How files under /fits and /Eagle reach the browser: '' (Flask reads and sends them),
+# 'xsendfile' (Apache mod_xsendfile; see etc/100-imagelib.conf) or 'accel' (nginx
+# X-Accel-Redirect to an internal location at $IMAGELIB_ACCEL_PREFIX/fits and /Eagle)
+sendfile = os.environ.get('IMAGELIB_SENDFILE', '')
+accel_prefix = os.environ.get('IMAGELIB_ACCEL_PREFIX', '/protected')
+png_max_age = 365 * 24 * 3600  # Previews and thumbnails never change once rendered
+
+import catalog
+import jobs
 import markup
+import tiles
 markup = markup.Markup()
+jobs = jobs.DownloadJobs(markup)
 
 
 #
@@ -49,12 +64,16 @@ markup = markup.Markup()
 def top():
     app.logger.debug("Args: {}  Form: {}".format(flask.request.args.to_dict(), flask.request.form.to_dict()))
     t = markup.build_images(start = flask.request.form.get('start'),
+                            start_id = flask.request.form.get('start_id', type=int),
                             target = flask.request.form.get('target'),
                             imgfilter = flask.request.form.get('imgfilter'),
                             lastTarget = flask.request.form.get('last_target'),
                             orgproject = flask.request.form.get('orgproject'),
                             observatory = flask.request.form.get('observatory'),
-                            observer = flask.request.form.get('observer'))
+                            observer = flask.request.form.get('observer'),
+                            ra = flask.request.form.get('ra'),
+                            dec = flask.request.form.get('dec'),
+                            radius = flask.request.form.get('radius'))
     return flask.render_template('imagelib.html', **t)
 
 @app.route('/search', methods=['GET','POST'])
@@ -65,18 +84,102 @@ def search():
     t = markup.build_images(target = target,
                             orgproject = flask.request.args.get('orgproject'),
                             observatory = flask.request.args.get('observatory'),
-                            observer = flask.request.args.get('observer'))
+                            observer = flask.request.args.get('observer'),
+                            ra = flask.request.args.get('ra'),        # cone search: /search?ra=&dec=&radius=
+                            dec = flask.request.args.get('dec'),
+                            radius = flask.request.args.get('radius'))
     return flask.render_template('imagelib.html', **t)
 
+@app.route('/api/targets', methods=['GET'])
+def api_targets():
+    prefix = flask.request.args.get('prefix', '').strip()
+    app.logger.debug("api_targets(prefix={})".format(prefix))
+    response = flask.jsonify(markup.fetchTargetSuggestions(prefix))
+    response.cache_control.private = True   # behind basic auth
+    response.cache_control.max_age = 300
+    response.add_etag()
+    return response.make_conditional(flask.request)
+
+@app.route('/api/catalog', methods=['GET'])
+def api_catalog():
+    args = flask.request.args
+    app.logger.debug("api_catalog({})".format(args.to_dict()))
+    try:
+        limit = max(1, min(int(args.get('limit', 50)), 500))
+        results = catalog.Catalog.query(args.get('q', ''), mode=args.get('mode', 'exact'), type=args.get('type'),
+                                        con=args.get('con'), limit=limit, db=markup.db)  # this thread's connection
+    except ValueError as e:
+        flask.abort(400, str(e))
+    response = flask.jsonify(results)
+    response.cache_control.private = True   # behind basic auth
+    response.cache_control.max_age = 300
+    response.add_etag()
+    return response.make_conditional(flask.request)
+
 @app.route('/download', methods=['GET','POST'])
 def download():
     app.logger.debug("download({})".format(flask.request.form.get('recids')))
+    recids = flask.request.form.get('recids')
     fmt = flask.request.form.get('fmt', 'fz')
-    tempfn = markup.zipit(flask.request.form.get('recids'), fmt=fmt)
-    app.logger.debug("sending {}".format(tempfn))
-    response = flask.send_file(tempfn, as_attachment=True)
+    filename = 'fits_{}.zip'.format(time.strftime('%Y-%m-%d'))
+    files, size = markup.downloadSize(recids)
+    if (jobs.isLarge(files, size)):
+        # Too big to build inside the request; hand it to a background job and poll it
+        job = jobs.submit(recids, fmt=fmt, filename=filename)
+        return flask.render_template('download.html', title='RFO Image Library', job=job, files=files)
+    stream = markup.zipstream(recids, fmt=fmt)
+    return flask.Response(flask.stream_with_context(stream), mimetype='application/zip',
+                          headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+@app.route('/download/status/<job>', methods=['GET'])
+def download_status(job):
+    status = jobs.status(job)
+    if (status is None):
+        flask.abort(404)
+    response = flask.jsonify(status)
+    response.cache_control.no_store = True
     return response
-    # unlink(tempfn)
+
+@app.route('/download/fetch/<job>', methods=['GET'])
+def download_fetch(job):
+    archive = jobs.archive(job)
+    status = jobs.status(job)
+    if (archive is None or status is None):
+        flask.abort(404)
+    return flask.send_file(archive, mimetype='application/zip', as_attachment=True,
+                           download_name=status['filename'])
+
+@app.route('/tiles/<int:recid>/info', methods=['GET'])
+def tiles_info(recid):
+    filename = markup.fetchTilesPath(recid)
+    try:
+        info = tiles.TilePyramid().info(filename)
+        info['version'] = '{:x}'.format(os.stat(filename).st_mtime_ns)  # tile URLs carry it; see tiles_tile()
+    except (TypeError, OSError, ValueError):
+        flask.abort(404)  # no pyramid for this frame; the page falls back to the preview png
+    response = flask.jsonify(info)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(flask.request)
+
+@app.route('/tiles/<int:recid>/<int:z>/<int:x>/<int:y>', methods=['GET'])
+def tiles_tile(recid, z, x, y):
+    filename = markup.fetchTilesPath(recid)
+    try:
+        data = tiles.TilePyramid().read(filename, z, x, y)
+    except (TypeError, OSError, ValueError):
+        data = None
+    if (data is None):
+        flask.abort(404)
+    response = flask.Response(data, mimetype='image/png')
+    response.cache_control.private = True
+    if (flask.request.args.get('v')):
+        # Versioned by the pyramid's mtime, so a re-rendered frame gets new URLs
+        response.cache_control.max_age = png_max_age
+        response.cache_control.immutable = True
+    response.add_etag()
+    return response.make_conditional(flask.request)
 
 @app.route('/deets', methods=['GET'])
 def deets():
@@ -88,15 +191,43 @@ def deets():
 def favicon():
     return flask.send_file('static/dob16.png')
 
-# DEBUG HACK; should make it so Apache deals with this
 @app.route('/fits/<path:path>')
 def fits(path):
-    return flask.send_file('fits/' + path)
+    return send_tree('fits', path)
 
-# FLASK HACK; should make it so Apache deals with this
 @app.route('/Eagle/<path:path>')
 def eagle(path):
-    return flask.send_file('Eagle/' + path)
+    return send_tree('Eagle', path)
+
+def send_tree(root, path):
+    '''Send file `path` from the `root` tree, or hand it to the front end server to send (see `sendfile`).'''
+    filename = werkzeug.utils.safe_join(root, path)
+    if (filename is None):
+        flask.abort(404)
+    immutable = filename.endswith('.png')
+    if (sendfile in ('accel', 'xsendfile')):
+        # Only here, not app-wide (USE_X_SENDFILE): Apache only whitelists the fits and Eagle trees
+        path = os.path.join(app.root_path, filename)
+        try:
+            st = os.stat(path)
+        except OSError:
+            flask.abort(404)
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        if (sendfile == 'accel'):
+            response.headers['X-Accel-Redirect'] = urllib.parse.quote('{}/{}'.format(accel_prefix, filename))
+        else:
+            response.headers['X-Sendfile'] = path
+        response.set_etag('{:x}-{:x}'.format(st.st_mtime_ns, st.st_size))
+        response.last_modified = st.st_mtime
+        if (immutable):
+            response.cache_control.max_age = png_max_age
+        response.make_conditional(flask.request)
+    else:
+        response = flask.send_file(filename, max_age=png_max_age if immutable else None)
+    response.cache_control.private = True  # behind basic auth
+    if (immutable):
+        response.cache_control.immutable = True
+    return response
 
 
 # For testing by hand
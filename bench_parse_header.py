@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+bench_parse_header.py -- Benchmark FitsFiles.parseFitsHeader() header scanning.
+
+Compares the header-only scanner (fitsheader.py, now used by parseFitsHeader())
+against the parseFitsHeader() it replaced, copied below as it was, and checks
+that both return identical headers (for the keywords the old one read).
+
+Run from the imagelib directory with the virtualenv active:
+    python3 bench_parse_header.py [directory]
+
+With a directory, every *.fits, *.fit and *.fits.fz file under it is used.
+Without one, a handful of real-sized 16 megapixel frames (Atik 16200, 4498 x 3598,
+both plain and Rice-compressed) are synthesized in a temp directory.
+"""
+
+import fnmatch
+import os
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits
+
+import fitsfiles
+
+FRAMES = 4          # Synthesized frames of each flavor
+REPEAT = 3          # Timing passes over the file set (best is reported)
+
+
+def synthesize(directory):
+    """Write FRAMES plain and FRAMES Rice-compressed 4498 x 3598 frames into `directory`."""
+    rng = np.random.default_rng(16200)
+    paths = []
+    for i in range(FRAMES):
+        data = rng.normal(1000, 30, size=(3598, 4498)).astype(np.int16)
+        header = fits.Header()
+        header['OBJECT']   = 'M 51'
+        header['DATE-OBS'] = '2024-06-01T04:30:00.000'
+        header['EXPTIME']  = 300.0
+        header['IMAGETYP'] = 'Light Frame'
+        header['XBINNING'] = 1
+        header['YBINNING'] = 1
+        header['FILTER']   = 'Clear'
+        header['OBJCTRA']  = '13 29 52.7'
+        header['OBJCTDEC'] = '+47 11 43'
+
+        plain = os.path.join(directory, 'frame_{:03d}.fits'.format(i))
+        fits.PrimaryHDU(data, header=header).writeto(plain)
+        packed = os.path.join(directory, 'frame_{:03d}.fits.fz'.format(i))
+        fits.HDUList([fits.PrimaryHDU(),
+                      fits.CompImageHDU(data, header=header, compression_type='RICE_1')]).writeto(packed)
+        paths += [plain, packed]
+    return paths
+
+
+def collect(directory):
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if any(fnmatch.fnmatchcase(name, p) for p in fitsfiles.FitsFiles.FILE_PATTERNS):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def best_of(fn, paths):
+    best = None
+    for _ in range(REPEAT):
+        t0 = time.perf_counter()
+        for path in paths:
+            fn(path)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    ff = fitsfiles.FitsFiles()
+    with tempfile.TemporaryDirectory(prefix='imglib_bench_') as tmpdir:
+        if len(sys.argv) > 1:
+            paths = collect(sys.argv[1])
+        else:
+            print("Synthesizing {} plain + {} .fits.fz 4498x3598 frames in {}".format(FRAMES, FRAMES, tmpdir))
+            paths = synthesize(tmpdir)
+        if not paths:
+            print("No FITS files found")
+            sys.exit(1)
+        total_mb = sum(os.path.getsize(p) for p in paths) / 1e6
+        print("{} files, {:.0f} MB".format(len(paths), total_mb))
+
+        mismatches = 0
+        for path in paths:
+            old = _old_parseFitsHeader(ff, path)
+            new = ff.parseFitsHeader(path)
+            if new is not None:
+                new = {k: v for k, v in new.items() if k in OLD_KEYWORDS}
+            if new != old:
+                print("  MISMATCH: {}".format(path))
+                mismatches += 1
+
+        for label, pattern in (('all', '*'), ('.fits', '*.fits'), ('.fits.fz', '*.fits.fz')):
+            subset = [p for p in paths if fnmatch.fnmatchcase(p, pattern)]
+            if not subset:
+                continue
+            slow = best_of(lambda p: _old_parseFitsHeader(ff, p), subset)
+            fast = best_of(ff.parseFitsHeader, subset)
+            print("  {:9s} old {:8.2f} ms/file   scanner {:6.3f} ms/file   {:6.1f}x".format(
+                label, slow * 1000 / len(subset), fast * 1000 / len(subset), slow / fast))
+
+    print("{} header mismatches".format(mismatches))
+    sys.exit(1 if mismatches else 0)
+
+
+# Keywords read by the old parseFitsHeader(); the new one reads a few more
+OLD_KEYWORDS = ('NAXIS1', 'NAXIS2', 'EXPTIME', 'IMAGETYP', 'XBINNING', 'YBINNING', 'OBJCTRA', 'OBJCTDEC', 'FILTER', 'OBJECT', 'DATE-OBS', 'SSPROJ', 'INSTABBR', 'OBSERVAT', 'OBSERVER')
+
+
+def _old_parseFitsHeader(self, filename):
+    """FitsFiles.parseFitsHeader() before fitsheader.py, verbatim (called with a FitsFiles as `self`)."""
+    with fits.open(filename) as fitsfile:
+        # Find our first HDU with a 2-axis image (see https://docs.astropy.org/en/stable/io/fits/)
+        i = 0
+        for hdu in fitsfile:
+            if (hdu.header['NAXIS'] == 2):
+                break
+            i += 1
+
+        headers = dict()
+        for hdr in 'NAXIS1', 'NAXIS2', 'EXPTIME', 'IMAGETYP', 'XBINNING', 'YBINNING', 'OBJCTRA', 'OBJCTDEC', 'FILTER', 'OBJECT', 'DATE-OBS', 'SSPROJ', 'INSTABBR', 'OBSERVAT', 'OBSERVER':
+            if hdr in list(hdu.header.keys()):
+                headers[hdr] = hdu.header[hdr]
+
+    # Clean up headers
+    if ('OBJECT' in headers):
+        headers['OBJECT'] = re.sub(self.whitespace, ' ', headers['OBJECT']).strip()
+    if ('DATE-OBS' in headers):
+        if (self.broken_iso.search(headers['DATE-OBS'])):
+            headers['DATE-OBS'] += '0'  # Maixm reports hundreths of seconds (.xx); iso requires thousandths (.xxx)
+    else:
+        print("No DATE-OBS header in {}; skipping".format(filename))
+        return(None)
+
+    return(headers)
+
+
+if __name__ == '__main__':
+    main()
@@ -107,11 +107,57 @@ except Exception as e:
 EOF
 }
 
+needs_schema() {
+    # Returns 0 (true) if the named index, table or trigger is absent
+    python3 - "$DB" "$1" <<'EOF'
+import sqlite3, sys
+db_path, name = sys.argv[1], sys.argv[2]
+try:
+    con = sqlite3.connect(db_path)
+    found = con.execute("SELECT 1 FROM sqlite_master WHERE name = ?", [name]).fetchone()
+    con.close()
+    sys.exit(0 if not found else 1)
+except Exception as e:
+    print(f"    WARNING: could not read DB schema: {e}", file=sys.stderr)
+    sys.exit(1)
+EOF
+}
+
 PENDING=0
+MIGRATIONS=()
 if needs_migration organization; then
     echo "    PENDING: update:orgproject"
     echo "             adds organization, project, observatory, observer columns"
     PENDING=1
+    MIGRATIONS+=(update:orgproject)
+fi
+
+if needs_schema fits_date_id_index || needs_schema fits_target_nocase_index; then
+    echo "    PENDING: update:indexes"
+    echo "             adds the indexes used for gallery paging and target autocomplete"
+    PENDING=1
+    MIGRATIONS+=(update:indexes)
+fi
+
+if needs_schema target_fts; then
+    echo "    PENDING: update:search"
+    echo "             adds and backfills the trigram index for fuzzy target search"
+    PENDING=1
+    MIGRATIONS+=(update:search)
+fi
+
+if needs_migration sprite; then
+    echo "    PENDING: update:sprites"
+    echo "             adds the sprite columns and builds thumbnail sprite sheets for every night"
+    PENDING=1
+    MIGRATIONS+=(update:sprites)
+fi
+
+if needs_migration ra || needs_schema fits_radec; then
+    echo "    PENDING: update:radec"
+    echo "             adds RA/Dec columns and the cone search index, backfilled from fits headers"
+    PENDING=1
+    MIGRATIONS+=(update:radec)
 fi
 
 if [ "$PENDING" -eq 0 ]; then
@@ -126,12 +172,16 @@ if [ "$PENDING" -eq 1 ]; then
         DB_BACKUP="$DB.$(date +%Y%m%d-%H%M%S).bak"
         echo "    Backing up DB to $DB_BACKUP"
         cp "$DB" "$DB_BACKUP"
-        echo "    Running update:orgproject"
-        echo "    (Answer 'y' at the prompt — DB is already backed up above)"
-        python3 "$REPO/fitsdb.py" update:orgproject
+        for migration in "${MIGRATIONS[@]}"; do
+            echo "    Running $migration"
+            echo "    (Answer 'y' at any prompt — DB is already backed up above)"
+            python3 "$REPO/fitsdb.py" "$migration"
+        done
     else
         echo "    Skipped. Run manually when ready:"
-        echo "      python3 $REPO/fitsdb.py update:orgproject"
+        for migration in "${MIGRATIONS[@]}"; do
+            echo "      python3 $REPO/fitsdb.py $migration"
+        done
     fi
 fi
 
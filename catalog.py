@@ -5,14 +5,22 @@
 #
 
 import argparse
+import collections
+import csv
 import datetime
+import json
 import logging
+import math
 import os
 import re
 import sqlite3
 import sys
+import time
+
+import numpy as np
 
 import fitsdb
+import skycoords
 
 # Original thoughts on CNAME
 #               (1) the Messier number (based on finding `object` in the SAC catalog)
@@ -28,7 +36,11 @@ class Catalog:
 
     re_messier = re.compile('^M \d+$')
 
+    fov_default = 0.5   # Radius (degrees) matched around a frame whose headers don't give its field of view
+
     db = None
+    aliases = None      # (exact, normalized, dbfile, schema_version, checked) alias dicts; see resolver()
+    recheck = 60        # Seconds between resolver() checks that the catalog hasn't been recreated
 
     def init(self):
         logging.debug(">>> Connecting to database")
@@ -42,19 +54,215 @@ class Catalog:
         return(string)
 
     @classmethod
-    def cname(cls, object):
-        '''Return the canonical name for `object`.'''
-        logging.debug(">>> cname({})".format(object))
+    def normalize(cls, name):
+        '''Return `name` as an alias lookup key: prettyspace()d and case folded.'''
+        return(cls.prettyspace(name).casefold())
+
+    @classmethod
+    def resolver(cls, db=None):
+        '''Return the (exact, normalized) {name: cname} dicts of every catalog_by_target alias.
+
+        Loaded from `db` (default Catalog.db) on first use and shared by every connection to
+        the same file.  Looking up is then dict-only: the database's schema_version, which
+        changes when the catalog is (re)created, is checked at most every `recheck` seconds,
+        and `create` drops the dicts outright.  Without a catalog both are empty.'''
+        if db is None:
+            if cls.db is None:
+                cls.db = fitsdb.Fitsdb()
+            db = cls.db
+        aliases = cls.aliases
+        now = time.monotonic()
+        if (aliases is not None and aliases[2] == db.dbfile and now - aliases[4] < cls.recheck):
+            return(aliases[0], aliases[1])
+        cur = db.con.cursor()
+        version = cur.execute("PRAGMA schema_version").fetchone()[0]
+        if (aliases is None or aliases[2] != db.dbfile or aliases[3] != version):
+            exact = dict()
+            normalized = dict()
+            try:
+                rows = cur.execute("SELECT target, cname FROM catalog_by_target ORDER BY rowid").fetchall()
+            except sqlite3.OperationalError as e:
+                logging.debug(">>> resolver: no catalog: {}".format(e))
+                rows = list()
+            for target, cname in rows:
+                if (target):
+                    exact.setdefault(target, cname)  # First one wins, as with the old SELECT
+                    normalized.setdefault(cls.normalize(target), cname)
+            logging.debug(">>> resolver: loaded {} aliases".format(len(exact)))
+        else:
+            exact, normalized = aliases[0], aliases[1]
+        cls.aliases = (exact, normalized, db.dbfile, version, now)  # One assignment, so other threads see old or new, never half
+        return(exact, normalized)
+
+    @classmethod
+    def alias(cls, name, db=None):
+        '''Return the canonical name of catalog alias `name` (matched exactly, else ignoring spacing and case), or None.
+
+        Pass `db` to load the aliases through the caller's connection rather than Catalog.db.'''
+        exact, normalized = cls.resolver(db)
+        cname = exact.get(name)
+        if (cname is None and isinstance(name, str)):
+            cname = normalized.get(cls.normalize(name))
+        return(cname)
+
+    @classmethod
+    def cname(cls, object, headers=None):
+        '''Return the canonical name for `object`.
+
+        If `object` isn't a catalog name but the FITS `headers` give where the frame was
+        pointed, it is the catalog object nearest the centre of the field (see nearest()).'''
+        cname = cls.alias(object)
+        if (cname):
+            return(cname)
+        radec = skycoords.fromHeaders(headers) if headers else None
+        if (radec):
+            match = cls.nearest(radec[0], radec[1], cls.fov(headers))
+            if (match):
+                logging.debug(">>> cname: {} at {} is {}".format(object, radec, match))
+                return(match)
+        return(object)
+
+    @classmethod
+    def fov(cls, headers):
+        '''Return the radius in degrees (half the diagonal) of the field of a frame with FITS `headers`.
+
+        Worked out from FOCALLEN (mm), XPIXSZ/YPIXSZ (binned pixel size, um) and NAXIS1/NAXIS2;
+        `fov_default` if any are missing.'''
+        try:
+            focallen = float(headers['FOCALLEN'])
+            xpixsz = float(headers['XPIXSZ'])
+            ypixsz = float(headers.get('YPIXSZ', xpixsz))
+            diagonal = math.hypot(int(headers['NAXIS1']) * xpixsz, int(headers['NAXIS2']) * ypixsz) / 1000.0  # mm
+            radius = math.degrees(math.atan2(diagonal / 2, focallen))
+        except (KeyError, ValueError, TypeError):
+            return(cls.fov_default)
+        if (not 0.0 < radius < 90.0):
+            return(cls.fov_default)
+        return(radius)
+
+    @classmethod
+    def nearest(cls, ra, dec, radius):
+        '''Return the canonical name of the catalog object nearest (`ra`, `dec`) within `radius` degrees, or None.
+
+        The `catalog_radec` R*Tree (see createRadec()) picks the objects in the bounding box of
+        the cone; their distances are then worked out in one go with numpy.'''
         if cls.db is None:
             cls.db = fitsdb.Fitsdb()
+        if (not cls.db.hasTable('catalog_radec')):
+            return(None)
+        boxes = skycoords.bounds(ra, dec, radius)
+        sql = "SELECT id, (min_ra + max_ra) / 2, (min_dec + max_dec) / 2 FROM catalog_radec WHERE {}".format(
+            ' OR '.join(['(max_ra >= ? AND min_ra <= ? AND max_dec >= ? AND min_dec <= ?)'] * len(boxes)))
+        params = [ bound for box in boxes for bound in box ]
         cur = cls.db.con.cursor()
-        sql = "select cname from catalog_by_target where target = ?"
-        logging.debug(">>> {} WITH {}".format(sql, object))
-        row = cur.execute(sql, [ object ]).fetchone()
-        if (row):
-            return(row[0])
+        rows = cur.execute(sql, params).fetchall()
+        if (not rows):
+            return(None)
+        candidates = np.array(rows)
+        seps = skycoords.angsepArray(ra, dec, candidates[:, 1], candidates[:, 2])
+        best = int(np.argmin(seps))
+        if (seps[best] > radius):
+            return(None)
+        row = cur.execute("SELECT cname FROM catalog_by_target WHERE id = ? LIMIT 1", [ int(candidates[best, 0]) ]).fetchone()
+        return(row[0] if row else None)
+
+    @classmethod
+    def createSearch(cls, db):
+        '''(Re)build `catalog_fts`, the trigram index over every catalog alias behind fuzzy query()s.'''
+        cur = db.con.cursor()
+        cur.execute("DROP TABLE IF EXISTS catalog_fts")
+        cur.execute("CREATE VIRTUAL TABLE catalog_fts USING fts5(target, id UNINDEXED, tokenize='trigram')")
+        cur.execute("INSERT INTO catalog_fts (target, id) SELECT target, id FROM catalog_by_target")
+        db.con.commit()
+
+    @classmethod
+    def query(cls, term=None, mode='exact', type=None, con=None, limit=50, db=None):
+        '''Return up to `limit` catalog objects whose name or an alias matches `term`.
+
+        `mode` is exact or prefix (both ignoring case), or fuzzy (the alias contains `term`).
+        `type` and `con` (also ignoring case) narrow the results, or stand in for `term`.  Each
+        object is a dict of its catalog columns plus `cname` and the `alias` that matched.
+
+        Names are looked up in the catalog_by_target indexes (fuzzy: the catalog_fts trigram
+        index; terms under 3 characters are taken as prefixes), then catalog rows by id.  Pass
+        `db` to use a connection other than Catalog.db (eg: a web thread's own).'''
+        if (mode not in ('exact', 'prefix', 'fuzzy')):
+            raise ValueError("unknown query mode {!r}".format(mode))
+        if db is None:
+            if cls.db is None:
+                cls.db = fitsdb.Fitsdb()
+            db = cls.db
+        term = ' '.join(term.split()) if term else None
+        if (not (term or type or con) or not db.hasTable('catalog')):
+            return(list())
+
+        columns = "(SELECT cname FROM catalog_by_target WHERE id = c.id LIMIT 1) AS cname, c.*"
+        where = list()
+        params = list()
+        if (term):
+            if (mode == 'fuzzy' and len(term) < 3):
+                mode = 'prefix'  # Too short for a trigram
+            if (mode == 'exact'):
+                matches = "SELECT target, id FROM catalog_by_target WHERE target = ? COLLATE NOCASE"
+                params += [ term ]
+                order = 'c.id'
+            elif (mode == 'prefix'):
+                matches = ("SELECT target, id FROM catalog_by_target"
+                           " WHERE target >= ? COLLATE NOCASE AND target < ? COLLATE NOCASE")
+                params += [ term, term + '\U0010ffff' ]
+                order = 'alias COLLATE NOCASE'
+            else:
+                table = 'catalog_fts' if db.hasTable('catalog_fts') else 'catalog_by_target'  # Scans without the index
+                matches = "SELECT target, id FROM {} WHERE target LIKE ?".format(table)
+                params += [ '%' + term + '%' ]
+                order = 'length(alias), alias COLLATE NOCASE'
+            sql = "SELECT min(m.target) AS alias, {} FROM ({}) m JOIN catalog c ON c.id = m.id".format(columns, matches)
         else:
-            return(object)
+            sql = "SELECT NULL AS alias, {} FROM catalog c".format(columns)
+            order = 'c.id'
+        if (type):
+            where.append('c.type = ? COLLATE NOCASE')
+            params.append(type)
+        if (con):
+            where.append('c.con = ? COLLATE NOCASE')
+            params.append(con)
+        if (where):
+            sql += " WHERE " + ' AND '.join(where)
+        if (term):
+            sql += " GROUP BY c.id"
+        sql += " ORDER BY {} LIMIT ?".format(order)
+        params.append(limit)
+        logging.debug(">>> {} WITH {}".format(sql, params))
+
+        cur = db.con.cursor()
+        rows = cur.execute(sql, params).fetchall()
+        cols = [ d[0] for d in cur.description ]
+        return([ dict(zip(cols, row)) for row in rows ])
+
+    @classmethod
+    def createRadec(cls, db):
+        '''(Re)build the `catalog_radec` R*Tree of catalog positions from the SAC `ra` and `dec` columns.
+
+        SAC gives RA as "HH MM.m" and Dec as "+DD MM".  Returns the number of objects indexed,
+        or None if the catalog has no ra/dec columns.'''
+        cur = db.con.cursor()
+        cols = [ row[1] for row in cur.execute("PRAGMA table_info(catalog)") ]
+        cur.execute("DROP TABLE IF EXISTS catalog_radec")
+        if ('ra' not in cols or 'dec' not in cols):
+            db.con.commit()
+            return(None)
+        cur.execute("CREATE VIRTUAL TABLE catalog_radec USING rtree(id, min_ra, max_ra, min_dec, max_dec)")
+        positions = list()
+        for id, ra, dec in cur.execute("SELECT id, ra, dec FROM catalog").fetchall():
+            try:
+                ra, dec = skycoords.parseRA(ra), skycoords.parseDec(dec)
+            except (ValueError, TypeError, AttributeError):
+                logging.debug(">>> createRadec: no position for catalog id {}: {} {}".format(id, ra, dec))
+                continue
+            positions.append((id, ra, ra, dec, dec))
+        cur.executemany("INSERT INTO catalog_radec VALUES (?,?,?,?,?)", positions)
+        db.con.commit()
+        return(len(positions))
 
 
 if (__name__ == "__main__"):
@@ -65,8 +273,10 @@ if (__name__ == "__main__"):
         {} create catalog_file      Creates and populates the catalog from `catalog_file`
         {} recreate catalog_file    Drops existing catalog and recreates (see `create`)
         {} stats                    Prints some statistics about the catalog
-        {} query [field] term       Looks up `term` in catalog `field` (default: target)
-                                            Fields may be target | type (default: target)'''.format(prog,prog,prog,prog,prog)
+        {} query [--prefix|--fuzzy] [--type T] [--con C] [--json] [term]
+                                    Looks up objects by name or alias (see `query --help`)
+        {} rematch                  Renames frames whose object isn't in the catalog after
+                                            the nearest catalog object in their field'''.format(prog,prog,prog,prog,prog,prog)
 
     cmd = None
     args = [ None ]
@@ -93,7 +303,8 @@ if (__name__ == "__main__"):
             print(usage)
             sys.exit(1)
 
-        with open(catalogfile) as file:
+        started = time.perf_counter()
+        with open(catalogfile, newline='') as file:
             cur = db.con.cursor()
 
             if (cmd == 'recreate'):
@@ -113,16 +324,15 @@ if (__name__ == "__main__"):
                     print('You meant maybe `create` instead?')
                     sys.exit(1)
 
+            # SAC is CSV with every field quoted: "NGC 7000","North America Neb;..."
+            reader = csv.reader(file)
+
             # Parse header into a list (and build our qmarks)
-            headerline = file.readline().rstrip().replace('"','').lower()
             header = list()
-            qmarks = list()
-            for hdr in headerline.split(','):
-                header.append(cat.prettyspace(hdr).replace(' ','_'))  # boo!
-                qmarks.append('?')
-            logging.debug(">>> headerline: {}$".format(headerline))
+            for hdr in next(reader, []):
+                header.append(' '.join(hdr.lower().split()).replace(' ','_'))  # boo!
+            qmarks = [ '?' ] * len(header)
             logging.debug(">>> header: ({}) {}".format(len(header), header))
-            logging.debug(">>> qmarks: ({}) {}".format(len(qmarks), qmarks))
 
             # Build sql CREATE statement based on columns called out in headerfile
             # Note that `object`, `other` and `type` have to exist or Bad Things will happen
@@ -133,15 +343,10 @@ if (__name__ == "__main__"):
             sql = 'CREATE TABLE catalog ({}\n)'.format(',\n  '.join(cols))
             logging.debug(">>> {}".format(sql))
 
-            # Intentionally fail if table exists
+            # Intentionally fail if table exists; the indexes come after the load, which is faster
             try:
                 cur.execute(sql)
-                cur.execute("CREATE UNIQUE INDEX catalog_object_index ON catalog (object)")
-                cur.execute("CREATE INDEX catalog_type_index ON catalog (type)")
                 cur.execute("CREATE TABLE catalog_by_target ( target TEXT, id INTEGER, cname TEXT )")
-                cur.execute("CREATE INDEX catalog_by_target_target_index ON catalog_by_target (target)")
-                cur.execute("CREATE INDEX catalog_by_target_id_index ON catalog_by_target (id)")
-                db.con.commit()
             except sqlite3.Error as er:
                 print('ERROR: ' + ' '.join(er.args))
                 if (er.args[0] == 'table catalog already exists'):
@@ -150,44 +355,27 @@ if (__name__ == "__main__"):
 
             print("Tables catalog, catalog_by_target created")
 
-            # Insert data
-            linenum = 1  # We already processed header
-            insertCount = 0
-            aliasCount = 0
-            datalines = file.readlines()
-            for dataline in datalines:
-                linenum += 1
-
-                # Twiddle the data
-                logging.debug(">>> dataline: {}".format(dataline))
-                data = list()
-                for d in dataline.rstrip().split('","'):
-                    data.append(cat.prettyspace(d))
-                logging.debug(">>> data: {}".format(data))
+            # Parse everything first: duplicates are caught here rather than by the unique index
+            rows = list()
+            aliases = list()
+            seen = set()
+            for data in reader:
+                linenum = reader.line_num
+                data = [ ' '.join(d.split()) for d in data ]  # What prettyspace() does, sans regexes
                 if (len(data) != len(header)):
                     print("Not enough fields at line {}; skipping (found {} expected {})".format(linenum, len(data), len(header)))
                     continue
-
-                # Insert into catalog
-                sql = 'INSERT INTO catalog ({}) VALUES ({})'.format(','.join(header), ','.join(qmarks))
-                logging.debug(">>> {}".format(sql))
-                try:
-                    cur.execute(sql, data)
-                    # db.con.commit()
-                    id = cur.lastrowid
-                    insertCount += 1
-                except sqlite3.Error as er:
-                    if (er.args[0] == 'UNIQUE constraint failed: catalog.object'):
-                        print("Duplicate {} entry found at line {}; skipping".format(data[0], linenum))
-                        insertCount -= 1
-                    else:
-                        print('ERROR: ' + ' '.join(er.args))
-                        sys.exit(1)
+                if (data[0] in seen):
+                    print("Duplicate {} entry found at line {}; skipping".format(data[0], linenum))
+                    continue
+                seen.add(data[0])
+                id = len(rows) + 1
+                rows.append([ id ] + data)
 
                 # Get all our possible names
                 targets = [ data[0] ]           # [0] is object
                 for alt in data[1].split(';'):  # [1] is `other` name(s) for object
-                    targets.append(alt)
+                    targets.append(alt.strip())
 
                 # Figure out canonical name
                 cname = data[0]                 # default to `object`
@@ -199,14 +387,51 @@ if (__name__ == "__main__"):
                 # Add all our names to lookup table
                 for target in targets:
                     if (target):
-                        sql = "insert into catalog_by_target (target, id, cname) values (?,?,?)"
-                        logging.debug(">>> {} {}".format(sql, [ target, id, cname ]))
-                        cur.execute(sql, [ target, id, cname ])
-                        aliasCount += 1
+                        aliases.append((target, id, cname))
+            parsed = time.perf_counter()
 
-            db.con.commit()
-            print("{} catalog entries added".format(insertCount))
-            print("{} target aliases added".format(aliasCount))
+            # One transaction: rows, aliases, then indexes
+            try:
+                sql = 'INSERT INTO catalog (id,{}) VALUES (?,{})'.format(','.join(header), ','.join(qmarks))
+                logging.debug(">>> {}".format(sql))
+                cur.executemany(sql, rows)
+                cur.executemany("INSERT INTO catalog_by_target (target, id, cname) VALUES (?,?,?)", aliases)
+                inserted = time.perf_counter()
+                cur.execute("CREATE UNIQUE INDEX catalog_object_index ON catalog (object)")
+                cur.execute("CREATE INDEX catalog_type_index ON catalog (type COLLATE NOCASE)")
+                cur.execute("CREATE INDEX catalog_con_index ON catalog (con COLLATE NOCASE)")
+                cur.execute("CREATE INDEX catalog_by_target_target_index ON catalog_by_target (target)")
+                cur.execute("CREATE INDEX catalog_by_target_nocase_index ON catalog_by_target (target COLLATE NOCASE)")
+                cur.execute("CREATE INDEX catalog_by_target_id_index ON catalog_by_target (id)")
+                db.con.commit()
+                Catalog.aliases = None  # Any loaded before this are stale
+            except sqlite3.Error as er:
+                print('ERROR: ' + ' '.join(er.args))
+                sys.exit(1)
+            indexed = time.perf_counter()
+            print("{} catalog entries added".format(len(rows)))
+            print("{} target aliases added".format(len(aliases)))
+
+            # Positions for matching frames whose object isn't a catalog name (see Catalog.nearest)
+            try:
+                positions = cat.createRadec(db)
+                if (positions is not None):
+                    print("{} catalog positions indexed".format(positions))
+            except sqlite3.Error as er:
+                print('WARNING: positions not indexed: ' + ' '.join(er.args))  # eg: SQLite built without R*Tree
+            try:
+                cat.createSearch(db)
+            except sqlite3.Error as er:
+                print('WARNING: fuzzy query index not built: ' + ' '.join(er.args))
+
+            # Wire the new aliases into the fuzzy target search (see fitsdb.createSearch)
+            if (db.hasTable('fits')):
+                try:
+                    db.createSearch()
+                except sqlite3.Error as er:
+                    print('WARNING: search index not updated: ' + ' '.join(er.args))
+            print("Loaded in {:.3f}s (parse {:.3f}s, insert {:.3f}s, index {:.3f}s, positions/search indexes {:.3f}s)".format(
+                time.perf_counter() - started, parsed - started, inserted - parsed, indexed - inserted, time.perf_counter() - indexed))
             db.con.close()
             sys.exit()
 
@@ -248,12 +473,84 @@ if (__name__ == "__main__"):
 
         sys.exit(0)
 
+    elif (cmd == 'rematch'):
+        import fitsheader
+        Catalog.db = db
+        if (not db.hasTable('catalog_radec') and cat.createRadec(db) is None):
+            print("ERROR: catalog has no ra/dec columns; reload it with `recreate`")
+            sys.exit(1)
+
+        # Target frames with a position whose target didn't come from the catalog
+        cur = db.con.cursor()
+        sql = '''SELECT id, path, object, target, ra, dec, x, y FROM fits
+                 WHERE imagetype = 'tgt' AND ra IS NOT NULL AND dec IS NOT NULL
+                   AND target NOT IN (SELECT cname FROM catalog_by_target)'''
+        rows = cur.execute(sql).fetchall()
+        print("Matching {} frames by position".format(len(rows)))
+
+        updates = list()
+        renamed = collections.Counter()
+        matches = dict()  # Frames of a target mostly share a pointing and optics
+        for id, path, object, target, ra, dec, x, y in rows:
+            headers = dict(NAXIS1=x, NAXIS2=y)
+            try:
+                headers.update(fitsheader.FitsHeader.scan(path, ('FOCALLEN', 'XPIXSZ', 'YPIXSZ')) or {})
+            except (OSError, ValueError) as e:
+                logging.debug(">>> rematch: {}: {}".format(path, e))
+            radius = cat.fov(headers)
+            key = (ra, dec, round(radius, 4))
+            if (key not in matches):
+                matches[key] = cat.nearest(ra, dec, radius)
+            if (matches[key] and matches[key] != target):
+                updates.append((matches[key], id))
+                renamed[(target, matches[key])] += 1
+
+        for (target, match), count in sorted(renamed.items()):
+            print("{:-5d} {} -> {}".format(count, target, match))
+        cur.executemany("UPDATE fits SET target = ? WHERE id = ?", updates)
+        db.con.commit()
+        if (updates and db.hasTable('target_fts')):
+            db.createSearch()  # so the old names find the new targets
+        print("{} frames renamed".format(len(updates)))
+        db.con.close()
+        sys.exit()
+
     elif (cmd == 'query'):
-        print("Query not yet implemented.")
-        #  object TEXT,
-        #  other TEXT,
-        #  type TEXT,
-        #  con TEXT,
+        parser = argparse.ArgumentParser(prog='{} query'.format(prog), description='Look up objects in the catalog.')
+        parser.add_argument('term', nargs='*', help='object name or alias (eg: M 51); may be omitted with --type/--con')
+        modes = parser.add_mutually_exclusive_group()
+        modes.add_argument('--prefix', '-p', dest='mode', action='store_const', const='prefix', help='names starting with `term`')
+        modes.add_argument('--fuzzy', '-f', dest='mode', action='store_const', const='fuzzy', help='names containing `term`')
+        parser.add_argument('--type', '-t', help='only objects of this type (eg: GALXY; see `stats`)')
+        parser.add_argument('--con', '-c', help='only objects in this constellation (eg: UMA)')
+        parser.add_argument('--limit', '-n', type=int, default=50, help='most objects to print (default: 50)')
+        parser.add_argument('--json', action='store_true', help='print JSON instead of a table')
+        opts = parser.parse_args(args if args != [ None ] else [])
+        term = ' '.join(opts.term)
+        if (not (term or opts.type or opts.con)):
+            parser.error('a term, --type or --con is needed')
+        mode = opts.mode or 'exact'
+
+        if (mode == 'fuzzy' and not db.hasTable('catalog_fts')):
+            print("Building fuzzy query index (catalog loaded before it existed)", file=sys.stderr)
+            cat.createSearch(db)
+
+        started = time.perf_counter()
+        try:
+            results = cat.query(term, mode, opts.type, opts.con, opts.limit, db=db)
+        except sqlite3.Error as er:
+            print('ERROR: ' + ' '.join(er.args))
+            sys.exit(1)
+        elapsed = time.perf_counter() - started
+
+        if (opts.json):
+            print(json.dumps(results, indent=2))
+        else:
+            for r in results:
+                print("{:14s} {:10s} {:6s} {:4s} {:>8s} {:>7s}  {}".format(r['object'] or '', r['cname'] or '', r.get('type') or '',
+                      r.get('con') or '', r.get('ra') or '', r.get('dec') or '', r.get('other') or ''))
+            print("{} objects ({:.1f}ms)".format(len(results), elapsed * 1000))
+        sys.exit(0 if results else 1)
 
     else:
         if (cmd):
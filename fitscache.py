@@ -0,0 +1,90 @@
+#
+# fitscache.py -- on-disk cache of decompressed .fits.fz files
+#
+#   Downloads with fmt=fits decompress every .fits.fz they include.  Popular nights get
+#   downloaded again and again, so the decompressed output is kept here, keyed by the
+#   source path, size and mtime (so a rewritten source is never served stale), and
+#   trimmed least-recently-used first once the cache outgrows `max_bytes`.
+#
+
+import hashlib
+import logging
+import os
+import tempfile
+
+class FitsCache:
+
+    if os.environ.get('IMAGELIB_FITSCACHE'):
+        cachedir = os.environ['IMAGELIB_FITSCACHE']
+    elif os.path.exists('/home/nas/data'):
+        cachedir = '/home/nas/data/fitscache'
+    else:
+        cachedir = 'fitscache'
+
+    max_bytes = 10 * 1024**3  # 10 GiB; roughly 300 decompressed 16MP frames
+
+    def __init__(self, cachedir=None, max_bytes=None):
+        if (cachedir):
+            self.cachedir = cachedir
+        if (max_bytes is not None):
+            self.max_bytes = max_bytes
+
+    def key(self, path):
+        '''Return the cache key for `path` as it is right now.'''
+        st = os.stat(path)
+        ident = "{}\0{}\0{}".format(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        return(hashlib.sha1(ident.encode('utf-8', 'surrogateescape')).hexdigest())
+
+    def filename(self, path):
+        return(os.path.join(self.cachedir, self.key(path) + '.fits'))
+
+    def get(self, path):
+        '''Return the cached decompressed file for `path`, or None on a miss.'''
+        try:
+            cached = self.filename(path)
+            os.utime(cached)  # mtime is the LRU clock
+        except OSError:
+            return(None)
+        logging.debug(">>> FitsCache hit: {} --> {}".format(path, cached))
+        return(cached)
+
+    def put(self, path, data):
+        '''Store `data` as the decompressed contents of `path`; return the cached file, or None if it couldn't be written.'''
+        try:
+            cached = self.filename(path)
+            os.makedirs(self.cachedir, exist_ok=True)
+            fd, temp = tempfile.mkstemp(prefix='.fitscache_', dir=self.cachedir)
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    file.write(data)
+                os.replace(temp, cached)  # readers never see a partial file
+            finally:
+                if os.path.exists(temp):
+                    os.unlink(temp)
+        except OSError as e:
+            logging.warning("FitsCache: cannot cache {}: {}".format(path, e))
+            return(None)
+        logging.debug(">>> FitsCache put: {} --> {}".format(path, cached))
+        self.evict()
+        return(cached)
+
+    def evict(self):
+        '''Delete least recently used files until the cache is no bigger than max_bytes.'''
+        entries = list()
+        total = 0
+        with os.scandir(self.cachedir) as it:
+            for entry in it:
+                if (entry.name.endswith('.fits') and entry.is_file()):
+                    st = entry.stat()
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                    total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if (total <= self.max_bytes):
+                break
+            try:
+                os.unlink(path)
+                total -= size
+                logging.debug(">>> FitsCache evicted {}".format(path))
+            except FileNotFoundError:
+                pass  # another thread or process got there first
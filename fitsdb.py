@@ -2,28 +2,30 @@
 # Database routeines using SQLite database
 #
 
+import itertools
 import logging
 import os
 import re
 import sys
 import sqlite3
 
+import skycoords
+
 class Fitsdb:
 
     if os.environ.get('FITSDB_FILE'):
         dbfile = os.environ['FITSDB_FILE']
-        tsfile = os.environ.get('FITSDB_TSFILE', os.environ['FITSDB_FILE'] + '.last_run')
     elif os.path.exists('/home/nas/data'):
         dbfile = '/home/nas/data/fits.db'
-        tsfile = '/home/nas/data/fits.last_run'
     else:
         dbfile = 'fits.db'
-        tsfile = 'fits.last_run'
 
 
     def __init__(self):
-        # All threads use a single connection, so care must be taken when writing!
+        # Web threads each open their own (see markup.Markup); check_same_thread is off so a
+        # connection can still be shared deliberately (eg: catalog.Catalog.db), so take care writing!
         self.con = sqlite3.connect(self.dbfile, check_same_thread=False)
+        self.con.create_function('angsep', 4, skycoords.angsep, deterministic=True)  # degrees; see cone searches
 
     def __del__(self):
         self.con.close()
@@ -53,6 +55,154 @@ class Fitsdb:
 
         return(1)
 
+    def insert_many(self, images):
+        '''Insert a list of images (dictionaries) in a single transaction; return (count, failures).
+
+        Runs of consecutive images with the same columns share one executemany(), keeping
+        insertion order (and so row ids) the same as calling insert() on each.  If a run hits
+        an error, eg: a duplicate `path`, it is retried row by row so only the offending images
+        are dropped; each lands in `failures` as an (image, message) tuple.'''
+        count = 0
+        failures = list()
+        cur = self.con.cursor()
+        if (not self.con.in_transaction):
+            cur.execute('BEGIN')
+        for cols, group in itertools.groupby(images, key=lambda image: tuple(image.keys())):
+            group = list(group)
+            rows = [ list(image.values()) for image in group ]
+            sql = 'insert into fits ({}) values ({})'.format(', '.join(cols), ', '.join(['?'] * len(cols)))
+            logging.debug(">>> {} WITH {} rows".format(sql, len(rows)))
+            cur.execute('SAVEPOINT insert_many')
+            try:
+                cur.executemany(sql, rows)
+                count += len(rows)
+            except sqlite3.Error:
+                cur.execute('ROLLBACK TO insert_many')
+                for image, vals in zip(group, rows):
+                    try:
+                        cur.execute(sql, vals)
+                        count += 1
+                    except sqlite3.Error as er:
+                        print('WARNING: {}: {}'.format(image.get('path'), ' '.join(er.args)))
+                        failures.append((image, ' '.join(er.args)))
+            cur.execute('RELEASE insert_many')
+        self.con.commit()
+        return(count, failures)
+
+    def batch(self, size=100):
+        '''Return a FitsdbBatch context manager that inserts images `size` at a time.'''
+        return(FitsdbBatch(self, size))
+
+    def hasTable(self, name):
+        '''Return True if table (or virtual table) `name` exists.'''
+        cur = self.con.cursor()
+        return(cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", [name]).fetchone() is not None)
+
+    def createSearch(self):
+        '''Create (or refresh) the trigram search index used for fuzzy target lookups.
+
+        `target_terms` holds distinct (term, target) pairs -- every target, every FITS `object`,
+        and every catalog alias of a target -- and `target_fts` is an FTS5 trigram index over
+        the terms.  Triggers keep both current as images are inserted.  Rerun after the catalog
+        is (re)loaded so the alias lookup is wired in.'''
+        cur = self.con.cursor()
+        has_catalog = self.hasTable('catalog_by_target')
+        cur.execute("CREATE TABLE IF NOT EXISTS target_terms (term TEXT, target TEXT, PRIMARY KEY (term, target))")
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS target_fts USING fts5(term, target UNINDEXED, tokenize='trigram')")
+        cur.execute('''
+            CREATE TRIGGER IF NOT EXISTS target_terms_insert AFTER INSERT ON target_terms BEGIN
+                INSERT INTO target_fts (term, target) VALUES (NEW.term, NEW.target);
+            END
+        ''')
+        aliases = ''
+        if (has_catalog):
+            cur.execute("CREATE INDEX IF NOT EXISTS catalog_by_target_cname_index ON catalog_by_target (cname)")
+            aliases = "INSERT OR IGNORE INTO target_terms (term, target) SELECT target, cname FROM catalog_by_target WHERE cname = NEW.target;"
+        cur.execute("DROP TRIGGER IF EXISTS fits_search_insert")
+        cur.execute('''
+            CREATE TRIGGER fits_search_insert AFTER INSERT ON fits WHEN NEW.target IS NOT NULL BEGIN
+                INSERT OR IGNORE INTO target_terms (term, target) VALUES (NEW.target, NEW.target);
+                INSERT OR IGNORE INTO target_terms (term, target) SELECT NEW.object, NEW.target WHERE NEW.object IS NOT NULL;
+                {}
+            END
+        '''.format(aliases))
+
+        # Backfill from what's already there
+        cur.execute("INSERT OR IGNORE INTO target_terms (term, target) SELECT DISTINCT target, target FROM fits WHERE target IS NOT NULL")
+        cur.execute("INSERT OR IGNORE INTO target_terms (term, target) SELECT DISTINCT object, target FROM fits WHERE object IS NOT NULL AND target IS NOT NULL")
+        if (has_catalog):
+            cur.execute("INSERT OR IGNORE INTO target_terms (term, target) SELECT c.target, c.cname FROM catalog_by_target c"
+                        " WHERE c.cname IN (SELECT DISTINCT target FROM fits)")
+        self.con.commit()
+
+
+    def createRadec(self):
+        '''Create (or refresh) the `fits_radec` R*Tree over fits (ra, dec), used for cone searches.
+
+        Triggers keep it current as rows are inserted, updated and deleted.  The R*Tree keeps
+        32-bit bounds (rounded outward), so it only narrows the candidates: callers still
+        test angsep() on the exact fits.ra and fits.dec.'''
+        cur = self.con.cursor()
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS fits_radec USING rtree(id, min_ra, max_ra, min_dec, max_dec)")
+        cur.execute('''
+            CREATE TRIGGER IF NOT EXISTS fits_radec_insert AFTER INSERT ON fits
+            WHEN NEW.ra IS NOT NULL AND NEW.dec IS NOT NULL BEGIN
+                INSERT INTO fits_radec VALUES (NEW.id, NEW.ra, NEW.ra, NEW.dec, NEW.dec);
+            END
+        ''')
+        cur.execute('''
+            CREATE TRIGGER IF NOT EXISTS fits_radec_update AFTER UPDATE OF ra, dec ON fits BEGIN
+                DELETE FROM fits_radec WHERE id = OLD.id;
+                INSERT INTO fits_radec SELECT NEW.id, NEW.ra, NEW.ra, NEW.dec, NEW.dec
+                    WHERE NEW.ra IS NOT NULL AND NEW.dec IS NOT NULL;
+            END
+        ''')
+        cur.execute('''
+            CREATE TRIGGER IF NOT EXISTS fits_radec_delete AFTER DELETE ON fits BEGIN
+                DELETE FROM fits_radec WHERE id = OLD.id;
+            END
+        ''')
+
+        # Backfill from what's already there
+        cur.execute("INSERT OR REPLACE INTO fits_radec SELECT id, ra, ra, dec, dec FROM fits WHERE ra IS NOT NULL AND dec IS NOT NULL")
+        self.con.commit()
+
+
+class FitsdbBatch:
+    '''Collects images and writes them with Fitsdb.insert_many(), committing once per `size` images.
+
+        with db.batch() as batch:
+            for image in images:
+                batch.add(image)
+        print(batch.count, batch.failures)
+    '''
+
+    def __init__(self, db, size=100):
+        self.db = db
+        self.size = size
+        self.pending = list()
+        self.count = 0          # Images inserted so far
+        self.failures = list()  # (image, message) for images that could not be inserted
+
+    def add(self, image):
+        self.pending.append(image)
+        if (len(self.pending) >= self.size):
+            self.flush()
+
+    def flush(self):
+        if (self.pending):
+            count, failures = self.db.insert_many(self.pending)
+            self.count += count
+            self.failures += failures
+            self.pending = list()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()  # Images already prepared are worth keeping even if the caller blew up
+        return(False)
+
 
 
 # Stand-alone adminy stuff
@@ -100,7 +250,14 @@ if (__name__ == "__main__"):
                     organization TEXT,
                     project TEXT,
                     observatory TEXT,
-                    observer TEXT
+                    observer TEXT,
+                    ra REAL,
+                    dec REAL,
+                    sprite TEXT,
+                    sprite_x INTEGER,
+                    sprite_y INTEGER,
+                    sprite_w INTEGER,
+                    sprite_h INTEGER
                 )
             ''')
         except sqlite3.Error as er:
@@ -110,7 +267,18 @@ if (__name__ == "__main__"):
         cur.execute("CREATE UNIQUE INDEX fits_path_index ON fits (path)")
         cur.execute("CREATE INDEX fits_date_name_index ON fits (date, target)")
         cur.execute("CREATE INDEX fits_name_date_index ON fits (target, date)")
+        cur.execute("CREATE INDEX fits_date_id_index ON fits (date DESC, id)")  # gallery page order
+        cur.execute("CREATE INDEX fits_target_nocase_index ON fits (target COLLATE NOCASE)")  # /api/targets
         db.con.commit()
+        # Optional extras: without them target search falls back to LIKE and cone search to angsep() alone
+        try:
+            db.createSearch()
+        except sqlite3.Error as er:
+            print('WARNING: search index not created: ' + ' '.join(er.args))  # eg: SQLite built without FTS5
+        try:
+            db.createRadec()
+        except sqlite3.Error as er:
+            print('WARNING: cone search index not created: ' + ' '.join(er.args))  # eg: SQLite built without R*Tree
 
         try:
             cur.execute('''
@@ -220,6 +388,94 @@ if (__name__ == "__main__"):
         db.con.close()
         sys.exit()
 
+    Commands.append('update:sprites')
+    if (command == 'update:sprites'):
+        import sprites
+        cur = db.con.cursor()
+
+        print("Adding sprite columns and building sprite sheets; have you backed up fits.db? ", end='')
+        if (input()[0].lower() != 'y'):
+            exit(1)
+
+        for col in ['sprite TEXT', 'sprite_x INTEGER', 'sprite_y INTEGER', 'sprite_w INTEGER', 'sprite_h INTEGER']:
+            sql = 'ALTER TABLE fits ADD COLUMN {}'.format(col)
+            print(">>> {}".format(sql))
+            try:
+                cur.execute(sql)
+            except sqlite3.Error as er:
+                print('ERROR: ' + ' '.join(er.args))
+                sys.exit(1)
+        db.con.commit()
+
+        sheets = sprites.SpriteSheets(db)
+        print("Wrote {} sprite sheets".format(sheets.update(sheets.groups())))
+        db.con.close()
+        sys.exit()
+
+    Commands.append('update:indexes')
+    if (command == 'update:indexes'):
+        # Add any indexes missing from older databases; safe to run repeatedly
+        cur = db.con.cursor()
+        for sql in [ "CREATE INDEX IF NOT EXISTS fits_date_id_index ON fits (date DESC, id)",
+                     "CREATE INDEX IF NOT EXISTS fits_target_nocase_index ON fits (target COLLATE NOCASE)",
+                     "CREATE INDEX IF NOT EXISTS catalog_by_target_nocase_index ON catalog_by_target (target COLLATE NOCASE)" ]:
+            print(">>> {}".format(sql))
+            try:
+                cur.execute(sql)
+            except sqlite3.Error as er:
+                print('WARNING: ' + ' '.join(er.args))  # eg: no catalog yet
+        db.con.commit()
+        db.con.close()
+        sys.exit()
+
+    Commands.append('update:search')
+    if (command == 'update:search'):
+        # Create the fuzzy search index (or rewire it after a catalog reload) and backfill it; safe to run repeatedly
+        try:
+            db.createSearch()
+        except sqlite3.Error as er:
+            print('ERROR: ' + ' '.join(er.args))  # eg: SQLite built without FTS5
+            sys.exit(1)
+        cur = db.con.cursor()
+        print("{} search terms indexed".format(cur.execute("SELECT count(*) FROM target_terms").fetchone()[0]))
+        db.con.close()
+        sys.exit()
+
+    Commands.append('update:radec')
+    if (command == 'update:radec'):
+        # Add ra/dec and the cone search index, and fill them in from the FITS headers; safe to run repeatedly
+        import fitsheader
+        cur = db.con.cursor()
+        cols = [ row[1] for row in cur.execute("PRAGMA table_info(fits)") ]
+        for col in ['ra', 'dec']:
+            if (col not in cols):
+                sql = 'ALTER TABLE fits ADD COLUMN {} REAL'.format(col)
+                print(">>> {}".format(sql))
+                cur.execute(sql)
+        try:
+            db.createRadec()
+        except sqlite3.Error as er:
+            print('ERROR: ' + ' '.join(er.args))  # eg: SQLite built without R*Tree
+            sys.exit(1)
+
+        rows = cur.execute("SELECT id, path FROM fits WHERE ra IS NULL").fetchall()
+        print("Reading coordinates from {} FITS headers".format(len(rows)))
+        count = 0
+        for recid, path in rows:
+            try:
+                headers = fitsheader.FitsHeader.scan(path, ('OBJCTRA', 'OBJCTDEC', 'RA', 'DEC'))
+            except (OSError, ValueError) as e:
+                print('WARNING: {}: {}'.format(path, e))
+                continue
+            radec = skycoords.fromHeaders(headers or {})
+            if (radec):
+                cur.execute("UPDATE fits SET ra = ?, dec = ? WHERE id = ?", list(radec) + [recid])
+                count += 1
+        db.con.commit()
+        print("{} images have coordinates".format(count))
+        db.con.close()
+        sys.exit()
+
     if (command):
         print("Unknown command: {}".format(command))
     else:
@@ -3,6 +3,7 @@
 #
 
 import argparse
+import concurrent.futures
 import datetime
 import logging
 import json
@@ -11,11 +12,18 @@ import re
 import sys
 import shutil
 import subprocess   # Use subprocess for safer command execution
+import tempfile
 
 from astropy.io import fits
 
 import catalog
 import fitsdb
+import fitsheader
+import manifest
+import pngrender
+import skycoords
+import sprites
+import watcher
 
 class FitsFiles:
 
@@ -25,8 +33,10 @@ class FitsFiles:
         fitspath = 'Eagle'
 
     forcepng = False
+    jobs = 1          # Number of worker processes used for header parsing and png generation
+    renderer = 'numpy'  # png backend: 'numpy' (in-process, see pngrender.py) or 'fitspng'
 
-    # Patterns of FITS filenames to search for (used to build `find` args dynamically)
+    # Patterns of FITS filenames to search for (see manifest.py and watcher.py)
     FILE_PATTERNS = ['*.fits', '*.fit', '*.fits.fz']
 
     # Flat drop folder for Asterism uploads; files here are moved into date subfolders on ingest
@@ -52,20 +62,18 @@ class FitsFiles:
     whitespace = re.compile(r'\s+')
     broken_iso = re.compile('\.\d\d$')
 
+    # FITS header keywords we care about
+    HEADER_KEYWORDS = ('NAXIS1', 'NAXIS2', 'EXPTIME', 'IMAGETYP', 'XBINNING', 'YBINNING', 'OBJCTRA', 'OBJCTDEC', 'RA', 'DEC', 'FOCALLEN', 'XPIXSZ', 'YPIXSZ', 'FILTER', 'OBJECT', 'DATE-OBS', 'SSPROJ', 'INSTABBR', 'OBSERVAT', 'OBSERVER')
+
     def parseFitsHeader(self, filename):
         '''Parse the salient bits out of the FITS file header.'''
-        with fits.open(filename) as fitsfile:
-            # Find our first HDU with a 2-axis image (see https://docs.astropy.org/en/stable/io/fits/)
-            i = 0
-            for hdu in fitsfile:
-                if (hdu.header['NAXIS'] == 2):
-                    break
-                i += 1
-
-            headers = dict()
-            for hdr in 'NAXIS1', 'NAXIS2', 'EXPTIME', 'IMAGETYP', 'XBINNING', 'YBINNING', 'OBJCTRA', 'OBJCTDEC', 'FILTER', 'OBJECT', 'DATE-OBS', 'SSPROJ', 'INSTABBR', 'OBSERVAT', 'OBSERVER':
-                if hdr in list(hdu.header.keys()):
-                    headers[hdr] = hdu.header[hdr]
+        try:
+            headers = fitsheader.FitsHeader.scan(filename, self.HEADER_KEYWORDS)
+        except ValueError as e:
+            logging.warning("Header scan failed for {} ({}); falling back to astropy".format(filename, e))
+            headers = None
+        if (headers is None):
+            headers = self._parseFitsHeaderAstropy(filename)
 
         # Clean up headers
         if ('OBJECT' in headers):
@@ -79,6 +87,20 @@ class FitsFiles:
 
         return(headers)
 
+    def _parseFitsHeaderAstropy(self, filename):
+        '''Slow path for parseFitsHeader(): let astropy open the file and find the image HDU.'''
+        with fits.open(filename) as fitsfile:
+            # Find our first HDU with a 2-axis image (see https://docs.astropy.org/en/stable/io/fits/)
+            for hdu in fitsfile:
+                if (hdu.header['NAXIS'] == 2):
+                    break
+
+            headers = dict()
+            for hdr in self.HEADER_KEYWORDS:
+                if hdr in hdu.header:
+                    headers[hdr] = hdu.header[hdr]
+        return(headers)
+
     def buildDatabaseRecord(self, filename, headers):
         '''Translate FITS headers into database record fields.'''
         record = dict()
@@ -95,7 +117,7 @@ class FitsFiles:
             record['target'] = "{} {}s".format(self.CFrames[headers['IMAGETYP'].lower()], int(headers['EXPTIME']))
             record['imagetype'] = 'cal'
         else:
-            record['target'] = catalog.Catalog.cname(record['object'])
+            record['target'] = catalog.Catalog.cname(record['object'], headers)  # falls back to what's in the field
             record['imagetype'] = 'tgt'
 
         if record['imagetype'] == 'cal':
@@ -127,6 +149,9 @@ class FitsFiles:
         if ('NAXIS1' in headers and 'NAXIS2' in headers):
             record['x'] = headers['NAXIS1']
             record['y'] = headers['NAXIS2']
+        radec = skycoords.fromHeaders(headers)  # where the telescope pointed; calibration frames too, if given
+        if (radec):
+            record['ra'], record['dec'] = radec
         return(record)
 
     def _maybe_organize(self, filename, headers):
@@ -146,11 +171,9 @@ class FitsFiles:
         return dest
 
     def fits2png(self, record):
-        '''Generate and png preview and thumbnail images; return updated database record.'''
+        '''Generate and png preview and thumbnail images, and the preview tile pyramid; return updated database record.'''
 
         fits_path_abs = record['path']
-        fits_dir = os.path.dirname(fits_path_abs)
-        fits_filename = os.path.basename(fits_path_abs)
 
         if not os.path.exists(fits_path_abs) or not os.access(fits_path_abs, os.R_OK):
             logging.error(f"FATAL: FITS file not found or unreadable: {fits_path_abs}")
@@ -159,140 +182,209 @@ class FitsFiles:
         # Define the intended final absolute paths
         if fits_path_abs.endswith('.fits.fz'):
             stem = fits_path_abs[:-8]
-            temp_ext = '.fits.fz'
         elif fits_path_abs.endswith('.fits'):
             stem = fits_path_abs[:-5]
-            temp_ext = '.fits'
         else:  # .fit
             stem = fits_path_abs[:-4]
-            temp_ext = '.fit'
         preview_final_abs = stem + '.png'
         thumb_final_abs = stem + '-thumb.png'
+        tiles_final_abs = stem + '.tiles'  # preview tile pyramid (see tiles.py)
+        scaling = int(record['x'] / 128) + 1
 
-        # --- WORKAROUND: Rename the file temporarily to a simple name ---
-        # Create a safe, temporary filename within the same directory
-        temp_safe_fits_path = os.path.join(fits_dir, "temp_safe_image" + temp_ext)
-        temp_safe_preview = None
-        temp_safe_thumb = None
+        preview = preview_final_abs if (self.forcepng or not os.path.exists(preview_final_abs)) else None
+        thumb = thumb_final_abs if (self.forcepng or not os.path.exists(thumb_final_abs)) else None
+        tiles_abs = tiles_final_abs if (self.forcepng or not os.path.exists(tiles_final_abs)) else None
 
-        try:
-            # Rename the complex file path to the simple file path
-            os.rename(fits_path_abs, temp_safe_fits_path)
-            logging.info(f"Temporarily renamed file for fitspng compatibility.")
-
-            # --- Now process using the simple name ---
-            # The preview and thumb will also use simple names temporarily
-            temp_safe_preview = os.path.join(fits_dir, "temp_safe_image.png")
-            temp_safe_thumb = os.path.join(fits_dir, "temp_safe_image-thumb.png")
-
-            # Preview Generation
-            if (self.forcepng or not os.path.exists(preview_final_abs)):
-                cmd = ['fitspng', '-o', temp_safe_preview, temp_safe_fits_path]
+        if (self.renderer == 'fitspng'):
+            self._fitspng(fits_path_abs, preview, thumb, scaling)
+            if (tiles_abs and os.path.exists(preview_final_abs)):
+                # From the FITS data: decoding fitspng's full size png in Python would take minutes
                 try:
-                    subprocess.run(cmd, check=True, capture_output=True, text=True)
-                    # Move result to final name
-                    os.rename(temp_safe_preview, preview_final_abs)
-                    logging.info(f"Generated preview: {preview_final_abs}")
-                except subprocess.CalledProcessError as e:
-                    logging.error(f"fitspng failed for preview (temp file used): {e.stderr}")
-            record['preview'] = preview_final_abs
+                    pngrender.PngRender().render(fits_path_abs, tiles=tiles_abs)
+                except Exception as e:
+                    logging.error(f"tile pyramid failed for {fits_path_abs}: {e}")
+        elif (preview or thumb or tiles_abs):
+            try:
+                pngrender.PngRender().render(fits_path_abs, preview=preview, thumbnail=thumb, scaling=scaling, tiles=tiles_abs)
+            except Exception as e:
+                logging.error(f"png rendering failed for {fits_path_abs}: {e}")
+
+        record['preview'] = preview_final_abs
+        record['thumbnail'] = thumb_final_abs
+        return record
 
-            # Thumbnail Generation
-            scaling = int(record['x'] / 128) + 1
-            if (self.forcepng or not os.path.exists(thumb_final_abs)):
-                cmd = ['fitspng', '-s', str(scaling), '-o', temp_safe_thumb, temp_safe_fits_path]
-                try:
-                    subprocess.run(cmd, check=True, capture_output=True, text=True)
-                    # Move result to final name
-                    os.rename(temp_safe_thumb, thumb_final_abs)
-                    logging.info(f"Generated thumbnail: {thumb_final_abs}")
-                except subprocess.CalledProcessError as e:
-                    logging.error(f"fitspng failed for thumbnail (temp file used): {e.stderr}")
-            record['thumbnail'] = thumb_final_abs
+    def _fitspng(self, fits_path_abs, preview_final_abs, thumb_final_abs, scaling):
+        '''Render the requested preview/thumbnail (None to skip) by running the `fitspng` binary.
 
-        finally:
-            # --- CRITICAL: Always rename the original file back ---
-            if os.path.exists(temp_safe_fits_path):
-                os.rename(temp_safe_fits_path, fits_path_abs)
-                logging.info(f"Restored original filename: {fits_path_abs}")
+        fitspng (cfitsio) chokes on names with spaces, brackets and the like, so it is handed a
+        simply named symlink in a private temp directory.  The original file is never touched,
+        and each png is written under a unique temp name and moved into place atomically, so
+        overlapping ingest runs in the same directory cannot trip over each other.'''
 
-            # Clean up temp files if they somehow got left behind (optional but good practice)
-            if os.path.exists(temp_safe_preview) : os.unlink(temp_safe_preview)
-            if os.path.exists(temp_safe_thumb) : os.unlink(temp_safe_thumb)
+        if fits_path_abs.endswith('.fits.fz'):
+            temp_ext = '.fits.fz'
+        elif fits_path_abs.endswith('.fits'):
+            temp_ext = '.fits'
+        else:  # .fit
+            temp_ext = '.fit'
 
+        with tempfile.TemporaryDirectory(prefix='imagelib_fitspng_') as work_dir:
+            safe_fits_path = os.path.join(work_dir, "image" + temp_ext)
+            try:
+                os.symlink(os.path.abspath(fits_path_abs), safe_fits_path)
+            except OSError:
+                shutil.copyfile(fits_path_abs, safe_fits_path)  # no symlinks here; pay for a copy
+
+            for final, opts in ((preview_final_abs, []), (thumb_final_abs, ['-s', str(scaling)])):
+                if (not final):
+                    continue
+                fd, temp_png = tempfile.mkstemp(prefix='.imagelib_', suffix='.png', dir=os.path.dirname(final))
+                os.close(fd)
+                try:
+                    subprocess.run(['fitspng'] + opts + ['-o', temp_png, safe_fits_path],
+                                   check=True, capture_output=True, text=True)
+                    os.chmod(temp_png, 0o644)
+                    os.replace(temp_png, final)
+                    logging.info(f"Generated {'thumbnail' if opts else 'preview'}: {final}")
+                except subprocess.CalledProcessError as e:
+                    logging.error(f"fitspng failed for {final}: {e.stderr}")
+                finally:
+                    if os.path.exists(temp_png):
+                        os.unlink(temp_png)
 
-        return record
+    def prepareFitsFile(self, filename):
+        '''Parse, organize and render `filename`; return its database record, or None to skip it.
 
-    def addFitsFile(self, filename, db):
+        Nothing here touches the fits database, so it is safe to run in a worker process.'''
         filename = filename.rstrip()
         if (not os.path.exists(filename)):
             print("Skipping {}: File not found!".format(filename))
-            return(0)
+            return(None)
 
         basename = os.path.basename(filename)
         if basename.startswith('MN') and not basename.startswith('MNc'):
             logging.info("Skipping uncalibrated RFO image: {}".format(filename))
-            return(0)
+            return(None)
 
         logging.info("Importing {}".format(filename))
         headers = self.parseFitsHeader(filename)
         if (not headers):
-            return(0)
+            return(None)
         filename = self._maybe_organize(filename, headers)
         record = self.buildDatabaseRecord(filename, headers)
-        logging.debug(">>> addFitsFile: imagetype: {}".format(record['imagetype']))
+        logging.debug(">>> prepareFitsFile: imagetype: {}".format(record['imagetype']))
         record = self.fits2png(record)
+        return(record)
+
+    def addFitsFile(self, filename, db):
+        record = self.prepareFitsFile(filename)
+        if (not record):
+            return(0)
         rowid = db.insert(record)
         if (rowid):
             return(1)
         else:
             return(0)
 
+    def addFitsFiles(self, filenames, db):
+        '''Add each of `filenames` to `db`; return the number added.
+
+        Records are written through a Fitsdb batch, so there is one commit per batch rather
+        than per image.  With `jobs` > 1 the files are prepared in a pool of worker processes,
+        but records are still inserted only from this process, in the order given, so the
+        resulting rows are identical to a serial run.  The new thumbnails are appended to the
+        sprite sheets of their (date, filter) groups at the end.'''
+        groups = set()
+        with db.batch() as batch:
+            if (self.jobs <= 1):
+                for filename in filenames:
+                    record = self.prepareFitsFile(filename)
+                    if (record):
+                        batch.add(record)
+                        groups.add((record['date'], record.get('filter')))
+            else:
+                logging.info("Preparing {} files with {} workers".format(len(filenames), self.jobs))
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs, initializer=_initWorker) as pool:
+                    for record in pool.map(self.prepareFitsFile, filenames):
+                        if (record):
+                            batch.add(record)
+                            groups.add((record['date'], record.get('filter')))
+        if (batch.failures):
+            logging.warning("{} images could not be added".format(len(batch.failures)))
+        self.updateSprites(groups, db)
+        return(batch.count)
+
+    def updateSprites(self, groups, db):
+        '''Append new thumbnails to the sprite sheets (see sprites.py) of the (date, filter) `groups`.'''
+        sheets = sprites.SpriteSheets(db)
+        if (groups and sheets.enabled()):
+            count = sheets.update(groups)
+            logging.info("Updated {} sprite sheets".format(count))
+
+    def _unknownFiles(self, filenames, db):
+        '''Return `filenames` less those already in the database (eg: touched, or moved there by _maybe_organize).'''
+        cur = db.con.cursor()
+        return([ f for f in filenames if not cur.execute("SELECT 1 FROM fits WHERE path = ?", [f]).fetchone() ])
+
     def findNewFits(self, path, fitsdb, files):
-        '''Find new FITS files since last time we were run.  Runs the `find` system command on `path` to locate *.fits newer than `ts_file`.'''
+        '''Find FITS files under `path` that are new or changed since the last scan and add them.
+
+        The tree is compared against the persistent manifest (see manifest.py) rather than a
+        last-run timestamp, so files copied in with their original mtime are still found.'''
 
         if (files):
-            # Skip all the find logic and just add files
-            count = 0
-            for filename in files:
-                count += self.addFitsFile(filename, fitsdb)
-            return(count)
-
-        # Build the find command
-        start_time = datetime.datetime.now()  # On the off chance new files come in during find
-        find_cmd = ['find', path]
-        if os.path.exists(fitsdb.tsfile):
-            find_cmd += ['-newer', fitsdb.tsfile]
-        name_args = []
-        for pattern in self.FILE_PATTERNS:
-            if name_args:
-                name_args.append('-o')
-            name_args += ['-name', pattern]
-        find_cmd += ['-type', 'f', '-a', '('] + name_args + [')']
-        logging.debug(">>> {}".format(find_cmd))
-
-        # Do the find comamand
-        count = 0
-        result = subprocess.run(find_cmd, capture_output=True, text=True)
-        for filename in result.stdout.splitlines():
-            if filename:
-                count += self.addFitsFile(filename, fitsdb)
-
-        # Update the timestamp with our start time, but only if successful
-        if (count > 0):
-            timestamp = start_time.strftime("%Y%m%d%H%M.%S")  # [[CC]YY]MMDDhhmm[.ss]
-            subprocess.run(['touch', '-t', timestamp, fitsdb.tsfile])
+            # Skip all the discovery logic and just add files
+            return(self.addFitsFiles(files, fitsdb))
+
+        files_manifest = manifest.Manifest(fitsdb)
+        filenames = files_manifest.scan(path, self.FILE_PATTERNS)
 
+        filenames = self._unknownFiles(filenames, fitsdb)
+        logging.debug(">>> findNewFits({}): {} candidate files".format(path, len(filenames)))
+
+        count = self.addFitsFiles(filenames, fitsdb)
+
+        # Only remember what we've seen once ingest has finished, so a crash rescans the same files
+        files_manifest.save()
         return(count)
 
 
+    def watch(self, db):
+        '''Stay resident, adding FITS files under `fitspath` and `ASTERISM_DROP` within seconds of them landing.'''
+        paths = [ self.fitspath ]
+        drop = os.path.abspath(self.ASTERISM_DROP)
+        if (os.path.isdir(drop) and not drop.startswith(os.path.join(os.path.abspath(self.fitspath), ''))):
+            paths.append(self.ASTERISM_DROP)
+
+        # Watch first, then catch up on anything that landed while we weren't running
+        files_watcher = watcher.Watcher(paths, self.FILE_PATTERNS, db)
+        logging.info("Watching {}".format(', '.join(paths)))
+        count = self.findNewFits(self.fitspath, db, None)
+        logging.info("Added {} images on startup".format(count))
+        try:
+            while True:
+                filenames = self._unknownFiles(files_watcher.ready(), db)
+                if (filenames):
+                    count = self.addFitsFiles(filenames, db)
+                    logging.info("Added {} images".format(count))
+        finally:
+            files_watcher.close()
+
+
+def _initWorker():
+    '''Worker process initializer: never share the parent's catalog connection across a fork.'''
+    catalog.Catalog.db = None
+
+
 if (__name__ == "__main__"):
 
     parser = argparse.ArgumentParser(description='FITS file utilities.')
     parser.add_argument('--debug', '-d', dest='debug', action='store_true', help='print diabolocal debugging dregs')
     parser.add_argument('--fitspath', '-f', dest='fitspath', action='store', help='path to fits files')
     parser.add_argument('--forcepng', '-p', dest='forcepng', action='store_true', help='force regeneration of PNG files even if they exist')
-    parser.add_argument('file', nargs='*', help='full path to file to add (may be repeated)')
+    parser.add_argument('--renderer', '-r', dest='renderer', action='store', choices=['numpy', 'fitspng'], default='numpy', help='png rendering backend (default: numpy)')
+    parser.add_argument('--jobs', '-j', dest='jobs', action='store', type=int, default=1, help='number of worker processes for header parsing and png generation (default: 1)')
+    parser.add_argument('file', nargs='*', help='full path to file to add (may be repeated), or `watch` to run as a daemon')
     args = parser.parse_args()
 
     if (args.debug):
@@ -306,6 +398,18 @@ if (__name__ == "__main__"):
         fitsfiles.fitspath = args.fitspath
     if (args.forcepng):
         fitsfiles.forcepng = args.forcepng
+    fitsfiles.jobs = args.jobs
+    fitsfiles.renderer = args.renderer
+
+    if (args.file == ['watch']):
+        if (not args.debug):
+            logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+        try:
+            fitsfiles.watch(fitsdb)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
     count = fitsfiles.findNewFits(fitsfiles.fitspath, fitsdb, files=args.file)
 
     print("Successfully added {} images".format(count))
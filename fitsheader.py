@@ -0,0 +1,118 @@
+#
+# fitsheader.py -- header-only FITS scanner
+#
+#   Reads just the 2880-byte header blocks of a FITS file, skipping over data units
+#   with a seek, so parsing headers never touches (or decompresses) pixel data.
+#   Understands tile-compressed images (.fits.fz), whose image header lives in a
+#   BINTABLE extension with ZIMAGE = T and the real geometry in ZNAXIS/ZNAXISn.
+#
+
+import re
+
+class FitsHeader:
+
+    BLOCK = 2880    # FITS logical record size
+    CARD = 80       # Header card size
+
+    re_int = re.compile(r'^[+-]?\d+$')
+
+    @classmethod
+    def parseValue(cls, field):
+        '''Return the Python value of the value/comment `field` of a card (columns 11-80).'''
+        field = field.strip()
+        if (field.startswith("'")):
+            # String: runs to the first lone quote; '' is an escaped quote
+            value = list()
+            i = 1
+            while (i < len(field)):
+                if (field[i] == "'"):
+                    if (field[i+1:i+2] == "'"):
+                        value.append("'")
+                        i += 2
+                        continue
+                    break
+                value.append(field[i])
+                i += 1
+            return(''.join(value).rstrip())
+
+        token = field.split('/', 1)[0].strip()
+        if (token == 'T'):
+            return(True)
+        if (token == 'F'):
+            return(False)
+        if (cls.re_int.match(token)):
+            return(int(token))
+        try:
+            return(float(token.replace('D', 'E')))
+        except ValueError:
+            return(token or None)
+
+    @classmethod
+    def readHeader(cls, file):
+        '''Read one header from `file` (positioned at a block boundary); return dict of first-seen keywords.'''
+        cards = dict()
+        last = None
+        while True:
+            block = file.read(cls.BLOCK)
+            if (len(block) < cls.BLOCK):
+                if (not block and not cards):
+                    return(None)  # clean end of file
+                raise ValueError("Truncated FITS header")
+            for i in range(0, cls.BLOCK, cls.CARD):
+                card = block[i:i + cls.CARD].decode('ascii', 'replace')
+                keyword = card[:8].rstrip()
+                if (keyword == 'END'):
+                    return(cards)
+                if (keyword == 'CONTINUE' and last is not None and isinstance(cards[last], str)):
+                    # Long string convention: previous value ends with '&'
+                    if (cards[last].endswith('&')):
+                        cards[last] = cards[last][:-1] + cls.parseValue(card[8:])
+                    continue
+                if (card[8:10] != '= ' or not keyword):
+                    last = None
+                    continue
+                if (keyword not in cards):
+                    cards[keyword] = cls.parseValue(card[10:])
+                    last = keyword
+                else:
+                    last = None
+
+    @classmethod
+    def dataSize(cls, cards):
+        '''Return the size in bytes (padded to whole blocks) of the data unit following `cards`.'''
+        naxis = cards.get('NAXIS', 0)
+        if (naxis == 0):
+            return(0)
+        pixels = 1
+        for n in range(1, naxis + 1):
+            pixels *= cards.get('NAXIS{}'.format(n), 0)
+        size = abs(cards.get('BITPIX', 8)) // 8 * cards.get('GCOUNT', 1) * (cards.get('PCOUNT', 0) + pixels)
+        return(-(-size // cls.BLOCK) * cls.BLOCK)
+
+    @classmethod
+    def scan(cls, filename, keywords):
+        '''Return {keyword: value} for `keywords` from the first 2-axis image HDU of `filename`.
+
+        Returns None if the file has no such HDU; raises ValueError if it is not FITS.'''
+        with open(filename, 'rb') as file:
+            if (file.read(9) != b'SIMPLE  ='):
+                raise ValueError("{} is not a FITS file".format(filename))
+            file.seek(0)
+            while True:
+                cards = cls.readHeader(file)
+                if (cards is None):
+                    return(None)
+
+                if (cards.get('ZIMAGE') is True):
+                    # Tile-compressed image: present the header the way astropy's CompImageHDU does
+                    image = dict(cards)
+                    image['NAXIS'] = cards.get('ZNAXIS', 0)
+                    for n in range(1, image['NAXIS'] + 1):
+                        image['NAXIS{}'.format(n)] = cards.get('ZNAXIS{}'.format(n))
+                else:
+                    image = cards
+
+                if (image.get('NAXIS') == 2):
+                    return({ k: image[k] for k in keywords if k in image })
+
+                file.seek(cls.dataSize(cards), 1)
@@ -0,0 +1,168 @@
+#
+# jobs.py -- background download jobs for large selections
+#
+#   A big /download would hold a mod_wsgi thread for minutes (and trip Apache's timeout),
+#   so past `max_stream_files`/`max_stream_bytes` the archive is built here instead: a
+#   runner thread drains Markup.zipstream() into <jobdir>/<job>/, keeping a status.json
+#   up to date as it goes, and the page polls that and fetches the zip once it's done.
+#   Everything lives on disk, so any mod_wsgi process can answer for any job.  Jobs are
+#   swept `ttl` seconds after they were last touched, by whichever of submit(), status()
+#   or archive() runs next (the latter two at most once a `sweep`).
+#
+
+import concurrent.futures
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+class DownloadJobs:
+
+    if os.environ.get('IMAGELIB_JOBDIR'):
+        jobdir = os.environ['IMAGELIB_JOBDIR']
+    else:
+        jobdir = os.path.join(tempfile.gettempdir(), 'imagelib_jobs')
+
+    max_stream_files = 50               # Selections bigger than this (or than max_stream_bytes) become jobs
+    max_stream_bytes = 512 * 1024**2
+    ttl = 6 * 3600                      # Seconds a job (and its archive) is kept after its last update
+    stall = 15 * 60                     # Seconds without progress before a running job is reported failed
+    report = 2                          # Seconds between status.json updates while bytes are written
+    sweep = 60                          # Seconds between expire() sweeps made from status()/archive()
+    swept = 0.0                         # When this process last swept
+
+    runner = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='download')
+
+    JOB_RE = re.compile('^[0-9a-f]{32}$')
+
+    def __init__(self, markup, jobdir=None):
+        self.markup = markup
+        if (jobdir):
+            self.jobdir = jobdir
+
+    def isLarge(self, files, size):
+        '''Return True if a selection of `files` files totalling `size` bytes should be a job.'''
+        return(files > self.max_stream_files or size > self.max_stream_bytes)
+
+    def path(self, job, name=''):
+        '''Return the path of `name` in the directory of `job`, or None if `job` isn't a valid job id.'''
+        if (not job or not self.JOB_RE.match(job)):
+            return(None)
+        return(os.path.join(self.jobdir, job, name))
+
+    def submit(self, recidstr, fmt='fz', filename='fits.zip'):
+        '''Start building the archive for `recidstr` in the background; return the job id.'''
+        self.expire()
+        job = uuid.uuid4().hex
+        os.makedirs(self.path(job))
+        files = len(self.markup.fetchZipRows(recidstr))
+        status = dict(state='queued', filename=filename, files_done=0, files_total=files, bytes=0, pid=os.getpid())
+        self._writeStatus(job, status)
+        logging.info("download job {}: {} files, fmt={}".format(job, files, fmt))
+        self.runner.submit(self._run, job, recidstr, fmt, status)
+        return(job)
+
+    def _run(self, job, recidstr, fmt, status):
+        '''Build the archive for `job`; runs on a runner thread.'''
+        partial = self.path(job, 'archive.zip.partial')
+        status['state'] = 'running'
+        self._writeStatus(job, status)
+
+        def progress(done, total):
+            status['files_done'] = done
+            self._writeStatus(job, status)
+
+        try:
+            reported = time.monotonic()
+            with open(partial, 'xb') as zip:
+                for chunk in self.markup.zipstream(recidstr, fmt, progress=progress):
+                    zip.write(chunk)
+                    status['bytes'] += len(chunk)
+                    if (time.monotonic() - reported >= self.report):  # a big member can take minutes
+                        self._writeStatus(job, status)
+                        reported = time.monotonic()
+            os.replace(partial, self.path(job, 'archive.zip'))
+            status['state'] = 'done'
+            logging.info("download job {}: done, {} bytes".format(job, status['bytes']))
+        except Exception as e:
+            logging.exception("download job {} failed".format(job))
+            status['state'] = 'error'
+            status['error'] = str(e)
+        self._writeStatus(job, status)
+
+    def _writeStatus(self, job, status):
+        status['updated'] = time.time()
+        fd, temp = tempfile.mkstemp(prefix='.status_', dir=self.path(job))
+        with os.fdopen(fd, 'w') as file:
+            json.dump(status, file)
+        os.replace(temp, self.path(job, 'status.json'))  # pollers never see a partial file
+
+    def status(self, job):
+        '''Return the status dict of `job`, or None if there is no such job.'''
+        self.sweepIfDue()
+        statusfile = self.path(job, 'status.json')
+        if (statusfile is None):
+            return(None)
+        try:
+            with open(statusfile) as file:
+                status = json.load(file)
+        except (OSError, ValueError):
+            return(None)
+        if (status['state'] == 'running' and time.time() - status['updated'] > self.stall):
+            # The process running it was most likely restarted
+            status['state'] = 'error'
+            status['error'] = 'stalled'
+        elif (status['state'] == 'queued' and not self.alive(status.get('pid'))):
+            # Queued jobs may wait a long time behind others, but not for a process that's gone
+            status['state'] = 'error'
+            status['error'] = 'runner gone'
+        return(status)
+
+    @staticmethod
+    def alive(pid):
+        '''Return False if there is no process `pid` (True if it can't be told).'''
+        if (not pid):
+            return(True)
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return(False)
+        except OSError:
+            pass  # eg: someone else's process
+        return(True)
+
+    def archive(self, job):
+        '''Return the finished archive of `job`, or None if it isn't ready (or doesn't exist).'''
+        self.sweepIfDue()
+        archive = self.path(job, 'archive.zip')
+        if (archive is None or not os.path.exists(archive)):
+            return(None)
+        return(archive)
+
+    def sweepIfDue(self):
+        '''expire() if this process hasn't in the last `sweep` seconds, so old archives go without waiting for a new job.'''
+        if (time.time() - DownloadJobs.swept >= self.sweep):
+            self.expire()
+
+    def expire(self):
+        '''Delete jobs not updated in the last `ttl` seconds.'''
+        DownloadJobs.swept = time.time()
+        cutoff = time.time() - self.ttl
+        try:
+            entries = list(os.scandir(self.jobdir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if (not self.JOB_RE.match(entry.name)):
+                continue
+            try:
+                updated = os.stat(os.path.join(entry.path, 'status.json')).st_mtime
+            except FileNotFoundError:
+                updated = entry.stat().st_mtime
+            if (updated < cutoff):
+                logging.debug(">>> expiring download job {}".format(entry.name))
+                shutil.rmtree(entry.path, ignore_errors=True)
@@ -0,0 +1,133 @@
+#
+# manifest.py -- persistent manifest of the FITS tree for incremental discovery
+#
+#   Remembers (path, size, mtime, inode) for every FITS file and the mtime of every
+#   directory under `fitspath`.  A scan lists only directories whose entries may have
+#   changed, so each run touches just the changed subtrees; and because files are
+#   compared against the manifest rather than a last-run timestamp, copies that keep
+#   an old mtime (rsync, shutil.copy2) can't slip past.
+#
+
+import fnmatch
+import logging
+import os
+import time
+
+class Manifest:
+
+    # A directory is only skipped if its mtime is unchanged AND it was last listed at least
+    # this many seconds after that mtime.  Until then it is relisted on every scan, which
+    # catches files still growing after they were created (eg: an SCP upload in progress).
+    settle = 3600
+
+    def __init__(self, db):
+        self.db = db
+        self.pending_dirs = dict()    # dir path --> (parent, mtime_ns, scanned) to save
+        self.pending_files = dict()   # file path --> (dir, size, mtime_ns, inode) to save
+        self.removed_dirs = set()
+        self.removed_files = set()
+        self.createTables()
+
+    def createTables(self):
+        '''Create the manifest tables if they don't already exist.'''
+        cur = self.db.con.cursor()
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS manifest_dirs (
+                path TEXT PRIMARY KEY,
+                parent TEXT,
+                mtime_ns INTEGER,
+                scanned REAL
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS manifest (
+                path TEXT PRIMARY KEY,
+                dir TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                inode INTEGER
+            )
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS manifest_dir_index ON manifest (dir)")
+        self.db.con.commit()
+
+    def _knownDirs(self, root):
+        '''Return ({dir: (mtime_ns, scanned)}, {parent: [subdirs]}) for the manifest under `root`.'''
+        known = dict()
+        children = dict()
+        cur = self.db.con.cursor()
+        sql = "SELECT path, parent, mtime_ns, scanned FROM manifest_dirs WHERE path = ? OR path LIKE ? ESCAPE '\\'"
+        prefix = os.path.join(root, '').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        for path, parent, mtime_ns, scanned in cur.execute(sql, [root, prefix + '%']):
+            known[path] = (mtime_ns, scanned)
+            children.setdefault(parent, list()).append(path)
+        return(known, children)
+
+    def scan(self, root, patterns):
+        '''Walk `root` and return the sorted paths of files matching `patterns` that are new or changed.
+
+        Changes are held in memory until save(), so a run that dies part way through will
+        rediscover the same files next time.'''
+        start = time.time()
+        known, children = self._knownDirs(root)
+        cur = self.db.con.cursor()
+        changed = list()
+        seen = set()
+        listed = 0
+
+        stack = [ root ]
+        while stack:
+            path = stack.pop()
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            seen.add(path)
+
+            prev = known.get(path)
+            if (prev and prev[0] == st.st_mtime_ns and prev[1] - st.st_mtime_ns / 1e9 >= self.settle):
+                # No entries added, removed or renamed since a listing well after the last change
+                stack.extend(children.get(path, []))
+                continue
+
+            listed += 1
+            files = dict()
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if (entry.is_dir(follow_symlinks=False)):
+                        stack.append(entry.path)
+                    elif (entry.is_file(follow_symlinks=False)
+                          and any(fnmatch.fnmatchcase(entry.name, pattern) for pattern in patterns)):
+                        est = entry.stat(follow_symlinks=False)
+                        files[entry.path] = (est.st_size, est.st_mtime_ns, est.st_ino)
+
+            sql = "SELECT path, size, mtime_ns, inode FROM manifest WHERE dir = ?"
+            old = { row[0]: tuple(row[1:]) for row in cur.execute(sql, [path]) }
+            for filename, sig in files.items():
+                if (old.get(filename) != sig):
+                    changed.append(filename)
+                    self.pending_files[filename] = (path,) + sig
+            self.removed_files.update(set(old) - set(files))
+            parent = os.path.dirname(path) if path != root else None
+            self.pending_dirs[path] = (parent, st.st_mtime_ns, start)
+
+        self.removed_dirs.update(set(known) - seen)
+        logging.info("Manifest scan of {}: listed {} of {} directories, {} new or changed files in {:.2f}s".format(
+            root, listed, len(seen), len(changed), time.time() - start))
+        return(sorted(changed))
+
+    def save(self):
+        '''Commit everything learned by scan() to the manifest tables.'''
+        cur = self.db.con.cursor()
+        cur.executemany("DELETE FROM manifest WHERE path = ?", [ [p] for p in self.removed_files ])
+        cur.executemany("DELETE FROM manifest WHERE dir = ?", [ [d] for d in self.removed_dirs ])
+        cur.executemany("DELETE FROM manifest_dirs WHERE path = ?", [ [d] for d in self.removed_dirs ])
+        cur.executemany("INSERT OR REPLACE INTO manifest (path, dir, size, mtime_ns, inode) VALUES (?,?,?,?,?)",
+                        [ (p,) + v for p, v in self.pending_files.items() ])
+        cur.executemany("INSERT OR REPLACE INTO manifest_dirs (path, parent, mtime_ns, scanned) VALUES (?,?,?,?)",
+                        [ (p,) + v for p, v in self.pending_dirs.items() ])
+        self.db.con.commit()
+        self.pending_dirs = dict()
+        self.pending_files = dict()
+        self.removed_dirs = set()
+        self.removed_files = set()
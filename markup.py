@@ -2,27 +2,41 @@
 # markup.py -- django markup routines
 #
 
+import atexit
+import concurrent.futures
 import flask
 import io
 import logging
 import json
+import multiprocessing
 import os
 import re
+import sqlite3
 import sys
+import threading
 import time
 import zipfile
 
 from astropy.io import fits as astrofits
 
+import catalog
+import fitscache
 import fitsdb
+import skycoords
 
-class Markup:
+class Markup(threading.local):
+    '''Page builder.  A threading.local, so every WSGI thread gets its own connection and query state.
+
+    __init__ runs again the first time each new thread touches the (module-level) instance.'''
 
     thumb_max = 64    # Number of thumbnails to display (rounded up to fill the grouping)
-    sequence = 0      # To prevent download file collisions
+    zip_workers = min(4, os.cpu_count() or 1)  # Processes decompressing .fits.fz for fmt=fits downloads
+    cone_radius = 0.5  # Default radius (degrees) of /search?ra=&dec= cone searches
 
     def __init__(self):
         self.db = fitsdb.Fitsdb()
+        self.fitscache = fitscache.FitsCache()
+        self.stats_version = None  # dataVersion() when stats_cache was computed
         version_fn = 'VERSION' if os.path.exists('VERSION') else '/home/nas/flask/imagelib/VERSION'
         with open(version_fn, 'r') as vfile:
             self.version = vfile.readline().strip()
@@ -36,12 +50,48 @@ class Markup:
         self.what_list = list()   # Human description for page title
 
         # Collect some stats
+        stats = self.libraryStats()
+        self.total_rows = stats['total_rows']
+        self.total_cals = stats['total_cals']
+        self.total_tgts = stats['total_tgts']
+        self.distinct_tgts = stats['distinct_tgts']
+        self.has_any_compressed = stats['has_compressed']
+
+    def dataVersion(self):
+        '''Return a value that changes whenever the database has been written, by any connection.'''
+        # data_version only moves for commits made by *other* connections, so add our own changes
+        cur = self.db.con.cursor()
+        return((cur.execute("PRAGMA data_version").fetchone()[0], self.db.con.total_changes))
+
+    def libraryStats(self):
+        '''Return the unfiltered stats and dropdown lists, recomputed only when the database has changed.'''
+        version = self.dataVersion()
+        if (version != self.stats_version):
+            logging.debug(">>> libraryStats(): data_version {}; recomputing".format(version))
+            self.stats_cache = self.fetchStats()
+            self.stats_cache['orgProjects'] = self.fetchOrgProjects()
+            self.stats_cache['observatories'] = self.fetchObservatories()
+            self.stats_cache['observers'] = self.fetchObservers()
+            self.stats_version = version
+        return(self.stats_cache)
+
+    def fetchStats(self, where=None, params=[]):
+        '''Return dict of image counts (restricted by `where` if given) in a single pass over fits.'''
+        sql = ("SELECT COUNT(*), SUM(imagetype = 'cal'), SUM(imagetype = 'tgt'),"
+               " COUNT(DISTINCT CASE WHEN imagetype = 'tgt' THEN target END),"
+               " MAX(path LIKE '%.fits.fz') FROM fits")
+        if (where):
+            sql += " WHERE {}".format(where)
+        logging.debug(">>> {}".format(sql))
         cur = self.db.con.cursor()
-        self.total_rows = cur.execute("select count(*) from fits").fetchone()[0]
-        self.total_cals = cur.execute("select count(*) from fits where imagetype = 'cal'").fetchone()[0]
-        self.total_tgts = cur.execute("select count(*) from fits where imagetype = 'tgt'").fetchone()[0]
-        self.distinct_tgts = cur.execute("select count(distinct(target)) from fits where imagetype = 'tgt'").fetchone()[0]
-        self.has_any_compressed = cur.execute("SELECT COUNT(*) FROM fits WHERE path LIKE '%.fits.fz' LIMIT 1").fetchone()[0] > 0
+        total_rows, total_cals, total_tgts, distinct_tgts, has_compressed = cur.execute(sql, params).fetchone()
+        return({
+            'total_rows': total_rows,
+            'total_cals': total_cals or 0,
+            'total_tgts': total_tgts or 0,
+            'distinct_tgts': distinct_tgts,
+            'has_compressed': bool(has_compressed),
+        })
 
     def add_where(self, clause, params=None):
         self.where_list.append((clause, params or []))
@@ -79,34 +129,99 @@ class Markup:
             if (self.where_list):
                 sql += " and {}".format(self.get_where())
                 params += self.get_params()
+            cname = catalog.Catalog.alias(target, self.db)  # eg: 'ngc  5194' is M 51
             if (cur.execute(sql, params).fetchone()[0] > 0):
                 self.add_where('target = ?', [target])
                 self.add_what(target)
+            elif (cname and cname != target and cur.execute(sql, [cname] + params[1:]).fetchone()[0] > 0):
+                self.add_where('target = ?', [cname])
+                self.add_what(cname)
             else:
-                self.add_where('target like ?', ['%' + target + '%'])
+                targets = self.fetchFuzzyTargets(target)
+                if (targets is None):
+                    self.add_where('target like ?', ['%' + target + '%'])
+                elif (targets):
+                    self.add_where('target IN ({})'.format(', '.join(['?'] * len(targets))), targets)
+                else:
+                    self.add_where('0')  # nothing matches
                 self.add_what('matching <{}>'.format(target))
 
         if (not self.what_list):
                 self.add_what('ALL')
 
-    def fetchTargets(self, target=None):
-        '''Return list of distinct targets that match, handling empty target and fuzzy matches.'''
-        sql = "SELECT DISTINCT(target) FROM fits"
-        params = []
-        if (self.where_list):
-            sql += " WHERE {}".format(self.get_where())
-            params = self.get_params()
-        sql += ' ORDER BY target'
-
-        logging.debug(">>> {}".format(sql))
+    def buildWhere_cone(self, ra, dec, radius=None):
+        '''Update where clause to match frames within `radius` degrees of (`ra`, `dec`).
+
+        RA is decimal degrees or sexagesimal hours, Dec decimal or sexagesimal degrees.  Returns
+        the parsed (ra, dec, radius), or None (and leaves the where clause alone) if they don't parse.'''
+        try:
+            ra = skycoords.parseRA(ra)
+            dec = skycoords.parseDec(dec)
+            radius = float(radius) if radius else self.cone_radius
+        except (ValueError, TypeError):
+            return(None)
+        if (not 0.0 < radius <= 180.0):
+            return(None)
+        if (self.db.hasTable('fits_radec')):
+            # The R*Tree narrows it down to a box or two; angsep() trims the corners
+            boxes = skycoords.bounds(ra, dec, radius)
+            clause = ' OR '.join(['(max_ra >= ? AND min_ra <= ? AND max_dec >= ? AND min_dec <= ?)'] * len(boxes))
+            params = list()
+            for min_ra, max_ra, min_dec, max_dec in boxes:
+                params += [min_ra, max_ra, min_dec, max_dec]
+            self.add_where('id IN (SELECT id FROM fits_radec WHERE {})'.format(clause), params)
+        self.add_where('angsep(ra, dec, ?, ?) <= ?', [ra, dec, radius])
+        self.add_what('within {:g}° of RA {:.4f} Dec {:+.4f}'.format(radius, ra, dec))
+        return((ra, dec, radius))
+
+    def fetchFuzzyTargets(self, term):
+        '''Return the targets whose name, FITS object or catalog alias contains `term`, or None without a search index.'''
+        if (not self.db.hasTable('target_fts')):
+            return(None)
+        sql = "SELECT DISTINCT target FROM target_fts WHERE term LIKE ?"
+        logging.debug(">>> {} with ({})".format(sql, term))
         cur = self.db.con.cursor()
-        cur.execute(sql, params)
-        targets = list()
-        for row in cur.fetchall():
-            targets.append(row[0])
-        logging.debug("fetchTargets({}) ==> {} rows".format(target, len(targets)))
+        targets = [ row[0] for row in cur.execute(sql, ['%' + term + '%']) ]
+        logging.debug("fetchFuzzyTargets({}) ==> {} targets".format(term, len(targets)))
         return(targets)
 
+    def fetchTargetSuggestions(self, prefix, limit=25):
+        '''Return up to `limit` {label, value} dicts for targets (and catalog aliases of them) starting with `prefix`.
+
+        Both lookups are case-insensitive index range scans; an alias is only offered if its
+        canonical name is in the library, and its value is that canonical name.'''
+        if (not prefix):
+            return(list())
+        bounds = [ prefix, prefix + '\U0010ffff' ]
+        cur = self.db.con.cursor()
+        suggestions = list()
+        seen = set()
+
+        sql = ("SELECT DISTINCT target FROM fits"
+               " WHERE target >= ? COLLATE NOCASE AND target < ? COLLATE NOCASE"
+               " ORDER BY target COLLATE NOCASE LIMIT ?")
+        logging.debug(">>> {} with {}".format(sql, bounds))
+        for (target,) in cur.execute(sql, bounds + [limit]):
+            suggestions.append({ 'label': target, 'value': target })
+            seen.add(target)
+
+        sql = ("SELECT DISTINCT c.target, c.cname FROM catalog_by_target c"
+               " WHERE c.target >= ? COLLATE NOCASE AND c.target < ? COLLATE NOCASE"
+               " AND EXISTS (SELECT 1 FROM fits WHERE fits.target = c.cname)"
+               " ORDER BY c.target COLLATE NOCASE LIMIT ?")
+        logging.debug(">>> {} with {}".format(sql, bounds))
+        try:
+            for alias, cname in cur.execute(sql, bounds + [limit]):
+                if (alias not in seen):
+                    suggestions.append({ 'label': "{} ({})".format(alias, cname), 'value': cname })
+                    seen.add(alias)
+        except sqlite3.OperationalError as e:
+            logging.warning("fetchTargetSuggestions: no catalog aliases: {}".format(e))
+
+        suggestions.sort(key=lambda s: s['label'].lower())
+        logging.debug("fetchTargetSuggestions({}) ==> {} rows".format(prefix, len(suggestions[:limit])))
+        return(suggestions[:limit])
+
     def fetchDates(self, target=None):
         '''Return list of distinct dates for this target, handling empty target and fuzzy matches.'''
         sql = "SELECT DISTINCT(date) FROM fits"
@@ -164,42 +279,69 @@ class Markup:
             self.add_where('observer = ?', [observer])
             self.add_what('observer:{}'.format(observer))
 
-    def fetchDetails(self, target=None, date=None):
-        '''Return list of details (tuple) that match target and date.'''
-        cur = self.db.con.cursor()
-        sql = "SELECT id, target, thumbnail, preview, path FROM fits"
-        params = []
-        if (self.where_list):
-            sql += " WHERE {}".format(self.get_where())
-            sql += " AND date = ?"
-            params = self.get_params() + [date]
-        else:
-            sql += " WHERE date = ?"
-            params = [date]
-        sql += " ORDER BY id"
+    def fetchPage(self, start=None, start_id=None):
+        '''Return ([(date, [rows])...], next) for one page of thumbnails, from a single query.
+
+        Rows are (id, target, thumbnail, preview, path, sprite, sprite_x, sprite_y, sprite_w, sprite_h)
+        in `date DESC, id` order, seeking straight to
+        the (`start`, `start_id`) cursor.  Whole dates are kept together: the page ends at the first
+        date boundary after `thumb_max` rows, and `next` is the (date, id) cursor of the following
+        page (None on the last page).'''
+        sql = "SELECT id, target, thumbnail, preview, path, date, sprite, sprite_x, sprite_y, sprite_w, sprite_h FROM fits"
+        clauses = [ clause for clause, _ in self.where_list ]
+        params = self.get_params()
+        if (start):
+            clauses.append("date <= ? AND (date < ? OR id >= ?)")  # The date bound lets SQLite seek the index
+            params = params + [start, start, start_id or 0]
+        if (clauses):
+            sql += " WHERE {}".format(' AND '.join(clauses))
+        sql += " ORDER BY date DESC, id"
 
-        logging.debug(">>> {} with ({})".format(sql, date))
+        logging.debug(">>> {} with ({}, {})".format(sql, start, start_id))
         cur = self.db.con.cursor()
-        cur.execute(sql, params)
-        details = list()
-        for row in cur.fetchall():
-            details.append(row)
-        logging.debug("fetchDetails(t:{}, d:{}) ==> {} rows".format(target, date, len(details)))
-        return(details)
+        page = list()
+        count = 0
+        for row in cur.execute(sql, params):
+            date = row[5]
+            if (not page or page[-1][0] != date):
+                if (count >= self.thumb_max):
+                    logging.debug("fetchPage({}, {}) ==> {} rows, next ({}, {})".format(start, start_id, count, date, row[0]))
+                    return(page, (date, row[0]))
+                page.append((date, list()))
+            page[-1][1].append(row[:5] + row[6:])
+            count += 1
+        logging.debug("fetchPage({}, {}) ==> {} rows".format(start, start_id, count))
+        return(page, None)
+
+    def fetchPrev(self, start):
+        '''Return the (date, id) cursor of the page ending just before the page starting on date `start`.
+
+        Walks backwards (oldest first) from `start` until `thumb_max` rows have been passed at a
+        date boundary; returns None if `start` is already on the first page.'''
+        if (not start):
+            return(None)
+        sql = "SELECT id, date FROM fits"
+        clauses = [ clause for clause, _ in self.where_list ] + [ "date > ?" ]
+        params = self.get_params() + [start]
+        sql += " WHERE {} ORDER BY date, id DESC".format(' AND '.join(clauses))
+
+        logging.debug(">>> {} with ({})".format(sql, start))
+        cur = self.db.con.cursor()
+        count = 0
+        prev = None
+        for recid, date in cur.execute(sql, params):
+            if (prev and prev[0] != date and count >= self.thumb_max):
+                break
+            prev = (date, recid)  # ends on the lowest id of the date, which is where its page starts
+            count += 1
+        logging.debug("fetchPrev({}) ==> {}".format(start, prev))
+        return(prev)
 
-    def findStartDate(self, dates, start):
-        '''Return index of dates closest to start.'''
-        startX = 0
-        if (start):
-            for date in dates:
-                if (date <= start):
-                    break
-                startX += 1
-        if (startX >= len(dates)):
-            logging.warning("start date {} not found".format(start))
-            startX = 0
-        logging.debug("findStartDate({}) ==> {}".format([len(dates), start], startX))
-        return(startX)
+    def webPath(self, path):
+        '''Return the (page relative) URL of a file under /home/nas/Eagle, which is served as Eagle/...'''
+        if (path and path[0:15] == '/home/nas/Eagle'):
+            return(path[10:])
+        return(path)
 
     def noneify(self, var):
         '''Make it easy to compare None to <emptystring>.'''
@@ -211,7 +353,8 @@ class Markup:
 
     # Main UI entrypoint
     def build_images(self, start=None, target=None, imgfilter='both', lastTarget=None,
-                     orgproject=None, observatory=None, observer=None):
+                     orgproject=None, observatory=None, observer=None, start_id=None,
+                     ra=None, dec=None, radius=None):
         '''Build a template (dictionary) of which images to display.'''
         logging.debug("build_images(start={}, target={}, imgfilter={}, lastTarget={})".format(start,target,imgfilter,lastTarget))
         self.reset()
@@ -220,8 +363,6 @@ class Markup:
         self.buildWhere_imgfilter(imgfilter)
         images['version'] = self.version
 
-        images['allTargets'] = self.fetchTargets(None)  # for autofill
-
         images['imgfilter'] = imgfilter
         images['imgfilter_checked'] = dict()
         for filter in [ 'cal', 'tgt', 'both' ]:
@@ -233,19 +374,19 @@ class Markup:
             self.buildWhere_observatory(observatory)
         if observer:
             self.buildWhere_observer(observer)
+        cone = None
+        if (ra or dec):
+            cone = self.buildWhere_cone(ra, dec, radius)
+            if (cone):
+                images['cone'] = dict(ra=cone[0], dec=cone[1], radius=cone[2])
+            else:
+                flask.flash("Cannot search around RA '{}' Dec '{}' radius '{}'".format(ra, dec, radius))
 
         self.buildWhere_target(target)
 
         # Compute stats filtered to the current search criteria
-        _cur = self.db.con.cursor()
-        _where = self.get_where()
-        _params = self.get_params()
-        if _where:
-            images['total_rows'] = _cur.execute("SELECT COUNT(*) FROM fits WHERE {}".format(_where), _params).fetchone()[0]
-            images['total_cals'] = _cur.execute("SELECT COUNT(*) FROM fits WHERE imagetype='cal' AND {}".format(_where), _params).fetchone()[0]
-            images['total_tgts'] = _cur.execute("SELECT COUNT(*) FROM fits WHERE imagetype='tgt' AND {}".format(_where), _params).fetchone()[0]
-            images['distinct_tgts'] = _cur.execute("SELECT COUNT(DISTINCT target) FROM fits WHERE imagetype='tgt' AND {}".format(_where), _params).fetchone()[0]
-            images['has_compressed'] = _cur.execute("SELECT COUNT(*) FROM fits WHERE path LIKE '%.fits.fz' AND {}".format(_where), _params).fetchone()[0] > 0
+        if (self.where_list):
+            images.update(self.fetchStats(self.get_where(), self.get_params()))
         else:
             images['total_rows'] = self.total_rows
             images['total_cals'] = self.total_cals
@@ -253,13 +394,13 @@ class Markup:
             images['distinct_tgts'] = self.distinct_tgts
             images['has_compressed'] = self.has_any_compressed
 
-        targets = self.fetchTargets(target)
-        if (len(targets) == 0):
-            # Flash an error and refetch lastTarget
+        if (images['total_rows'] == 0 and cone and not target):
+            flask.flash("No images {}".format(self.what_list[-1]))
+        elif (images['total_rows'] == 0):
+            # Flash an error and fall back to lastTarget
             logging.warning("target not found")
             flask.flash("Target '{}' not found".format(target))
             target = lastTarget
-            targets = self.fetchTargets(target)
         if (target):
             images['target'] = target
             images['last_target'] = target
@@ -270,25 +411,25 @@ class Markup:
             images['start'] = ''
             start = None
 
-        dates = self.fetchDates(target)
-        startX = self.findStartDate(dates, start)
+        page, next_cursor = self.fetchPage(start, start_id)
+        if (start and not page):
+            logging.warning("start ({}, {}) not found".format(start, start_id))
+            start = None
+            page, next_cursor = self.fetchPage()
         if (start):
-            images['date'] = dates[startX]
-        if (startX > 0):
-            images['prev'] = dates[startX - 1]
-        images['obsDates'] = dates
-
-        logging.debug("dates: ({} of 'em)".format(len(dates)))
-        logging.debug("start: {}".format(start))
+            images['date'] = page[0][0]
+            prev_cursor = self.fetchPrev(page[0][0])
+            if (prev_cursor):
+                images['prev'], images['prev_id'] = prev_cursor
+        if (next_cursor):
+            images['next'], images['next_id'] = next_cursor
+        images['obsDates'] = self.fetchDates(target)  # for the date dropdown
+
+        logging.debug("start: ({}, {})".format(start, start_id))
         images['title'] = "RFO Image Library"
 
-        thumb_count = 0
         images['collections'] = list()
-        for date in dates[startX:]:
-
-            if (thumb_count >= self.thumb_max):
-                images['next'] = date
-                break
+        for date, rows in page:
 
             # Build a collection for each date
             collection = dict()
@@ -301,41 +442,44 @@ class Markup:
                 collection['title'] = date
             collection['pics'] = list()
 
-            # Fetch pic details for this date
             sequence = 0
-            rows = self.fetchDetails(target, date)
             for row in rows:
-                thumb_count += 1
                 sequence += 1
-                recid, thisTarget, thumbnail, preview, path = row
-                if (thumbnail[0:15] == '/home/nas/Eagle'):
-                    thumbnail = thumbnail[10:]
+                recid, thisTarget, thumbnail, preview, path, sprite, sprite_x, sprite_y, sprite_w, sprite_h = row
                 pic = dict()
                 pic['id'] = "{}_{:03d}".format(prefix, sequence)
                 pic['recid'] = recid
                 pic['title'] = thisTarget
-                pic['src'] = thumbnail
+                pic['src'] = self.webPath(thumbnail)
+                pic['preview'] = self.webPath(preview)
+                if (sprite):
+                    # Drawn from the night's sprite sheet (see sprites.py) rather than fetched alone
+                    pic['sprite'] = self.webPath(sprite)
+                    pic['sprite_x'] = sprite_x
+                    pic['sprite_y'] = sprite_y
+                    pic['sprite_w'] = sprite_w
+                    pic['sprite_h'] = sprite_h
                 collection['pics'].append(pic)
 
             images['collections'].append(collection)
 
-        images['orgProjects'] = self.fetchOrgProjects()
-        images['observatories'] = self.fetchObservatories()
-        images['observers'] = self.fetchObservers()
+        stats = self.libraryStats()
+        images['orgProjects'] = stats['orgProjects']
+        images['observatories'] = stats['observatories']
+        images['observers'] = stats['observers']
         images['orgproject'] = orgproject or ''
         images['observatory'] = observatory or ''
         images['observer'] = observer or ''
 
-        for thang in [ 'target', 'date', 'start', 'prev', 'next' ]:
+        for thang in [ 'target', 'date', 'start', 'prev', 'prev_id', 'next', 'next_id' ]:
             if (thang in images):
                 logging.debug("images[{}]: {}".format(thang, images[thang]))
 
         # print(json.dumps(images, indent=4))
         return(images)
 
-    def zipit(self, recidstr, fmt='fz'):
-        '''Query the database for specified record IDs, zip up the fits files and return zip file path.'''
-        logging.debug("zipit({}, fmt={})".format(recidstr, fmt))
+    def fetchZipRows(self, recidstr):
+        '''Return [(id, path)...] for the comma separated record IDs in `recidstr`.'''
         recids = recidstr.split(',')
         qmarks = list()
         for x in recids:
@@ -345,69 +489,106 @@ class Markup:
         cur = self.db.con.cursor()
         sql = "select id, path from fits where id in ({}) order by id".format(questionmarks)
         logging.debug("{} [{}]".format(sql, recids))
-        rows = cur.execute(sql, recids)
-        logging.debug("returned {} rows".format(rows.rowcount))
-
-        # Experiments show that at compressionlevel=1, the zip file is 3% larger than at =9, but 9 takes 5 times as long
-        self.sequence += 1
-        datestr = time.strftime('%Y-%m-%d')
-        tempfn = '/tmp/fits_{}_{:04d}.zip'.format(datestr, self.sequence)
-        if (os.path.exists(tempfn)):
-            os.remove(tempfn)
-        with zipfile.ZipFile(tempfn, mode='x', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zip:
-            for row in rows:
-                logging.debug("adding {}".format(row))
-                id, path = row
-                if fmt == 'fits' and path.endswith('.fits.fz'):
-                    with astrofits.open(path, memmap=False,
-                                        do_not_scale_image_data=True) as hdul:
-                        # Decompress Rice-compressed images. do_not_scale_image_data
-                        # keeps native integers + BSCALE/BZERO in the header,
-                        # matching funpack output exactly.
-                        decomp_hdus = []
-                        found_comp = False
-                        for hdu in hdul:
-                            is_comp = isinstance(hdu, astrofits.CompImageHDU)
-                            if is_comp:
-                                found_comp = True
-                                try:
-                                    decomp_hdus.append(astrofits.ImageHDU(
-                                        data=hdu.data, header=hdu.header))
-                                except Exception as e:
-                                    logging.warning("zipit: decompress failed for {}: {}".format(
-                                        os.path.basename(path), e))
-                                    decomp_hdus.append(hdu.copy())
-                            elif (isinstance(hdu, astrofits.PrimaryHDU)
-                                  and hdu.header.get('NAXIS', 0) == 0):
-                                pass  # skip fpack's empty placeholder primary
-                            else:
-                                decomp_hdus.append(hdu.copy())
-
-                    arcname = os.path.basename(path)[:-3]  # strip .fz → .fits
-
-                    if found_comp:
-                        # Simple FITS readers only inspect HDU[0]. Promote the
-                        # first decompressed ImageHDU to PrimaryHDU so the output
-                        # is readable by readers that don't handle extensions.
-                        if not decomp_hdus:
-                            final_hdus = [astrofits.PrimaryHDU()]
-                        elif isinstance(decomp_hdus[0], astrofits.ImageHDU):
-                            first = decomp_hdus[0]
-                            final_hdus = ([astrofits.PrimaryHDU(
-                                               data=first.data, header=first.header)]
-                                          + decomp_hdus[1:])
-                        else:
-                            final_hdus = decomp_hdus
-                        buf = io.BytesIO()
-                        astrofits.HDUList(final_hdus).writeto(buf, output_verify='silentfix')
-                        buf.seek(0)
-                        zip.writestr(arcname, buf.read())
+        rows = cur.execute(sql, recids).fetchall()
+        logging.debug("returned {} rows".format(len(rows)))
+        return(rows)
+
+    def zipstream(self, recidstr, fmt='fz', progress=None):
+        '''Generate a zip of the fits files for the specified record IDs, a piece at a time.
+
+        Nothing is staged on disk: each member is compressed as it is read (or decompressed, for
+        fmt='fits') and its bytes are yielded as soon as it is done, so the first bytes go out
+        after the first member rather than the whole archive.
+        Decompression runs in the shared pool of `zip_workers` processes (see zipPool()), at most `zip_workers` files ahead
+        of the writer (bounding memory), and members are still written in order.
+        If given, progress(files_done, files_total) is called after each member.'''
+        logging.debug("zipstream({}, fmt={})".format(recidstr, fmt))
+        rows = self.fetchZipRows(recidstr)
+        sink = ZipSink()
+
+        # Decompressed files already in the cache are copied; only the rest go to the pool
+        todo = list()
+        cached = dict()  # row index --> cached decompressed file
+        for i, (id, path) in enumerate(rows):
+            if fmt == 'fits' and path.endswith('.fits.fz'):
+                cached[i] = self.fitscache.get(path)
+                if (cached[i] is None):
+                    todo.append(i)
+        pool = None
+        if (self.zip_workers > 1 and len(todo) > 1):
+            pool = zipPool(self.zip_workers)
+        todo = iter(todo)
+        futures = dict()  # row index --> Future of decompressFits()
+
+        try:
+            # Experiments show that at compressionlevel=1, the zip file is 3% larger than at =9, but 9 takes 5 times as long
+            with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zip:
+                for i, row in enumerate(rows):
+                    if (progress and i):
+                        progress(i, len(rows))
+                    logging.debug("adding {}".format(row))
+                    id, path = row
+                    while (pool and len(futures) < self.zip_workers):
+                        j = next(todo, None)
+                        if (j is None):
+                            break
+                        futures[j] = pool.submit(decompressFits, rows[j][1])
+
+                    if fmt == 'fits' and path.endswith('.fits.fz'):
+                        arcname = os.path.basename(path)[:-3]  # strip .fz → .fits
+                        if (cached[i]):
+                            try:
+                                yield from self._zipMember(zip, sink, arcname, filename=cached[i])
+                                continue
+                            except FileNotFoundError:
+                                logging.warning("zipstream: {} evicted from cache; decompressing".format(cached[i]))
+                        data = futures.pop(i).result() if i in futures else decompressFits(path)
+                        if data is not None:
+                            self.fitscache.put(path, data)
+                            yield from self._zipMember(zip, sink, arcname, data=data)
+                            del data
+                            continue
+                        # No compressed image in it after all: send the file as is, under the .fits name
                     else:
-                        zip.write(path, arcname=arcname)
-                else:
-                    zip.write(path, arcname=os.path.basename(path))
-        logging.debug("return({})".format(tempfn))
-        return(tempfn)
+                        arcname = os.path.basename(path)
+                    yield from self._zipMember(zip, sink, arcname, filename=path)
+            yield sink.take()  # central directory
+            if (progress):
+                progress(len(rows), len(rows))
+        finally:
+            for future in futures.values():
+                future.cancel()  # Download abandoned part way; the pool is shared, so leave it running
+
+    def _zipMember(self, zip, sink, arcname, data=None, filename=None):
+        '''Write member `arcname` from `data` (bytes) or `filename` into `zip`, then yield what that added to `sink`.
+
+        writestr() and write() compress at the level `zip` was opened with; ZipFile.open() would
+        take it from a ZipInfo, which has no public way to set one.  So each member is compressed
+        whole (it is already in memory for fmt='fits') before its bytes go out.'''
+        if data is not None:
+            zip.writestr(arcname, data)  # dated now, as the decompressed file is new
+        else:
+            zip.write(filename, arcname)
+        yield sink.take()
+
+    def downloadSize(self, recidstr):
+        '''Return (files, bytes on disk) for the specified record IDs.'''
+        rows = self.fetchZipRows(recidstr)
+        size = 0
+        for id, path in rows:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return((len(rows), size))
+
+    def fetchTilesPath(self, recid):
+        '''Return the tile pyramid file of `recid` (see tiles.py; it sits beside the preview png), or None.'''
+        cur = self.db.con.cursor()
+        row = cur.execute("SELECT preview FROM fits WHERE id = ?", [recid]).fetchone()
+        if (not row or not row[0] or not row[0].endswith('.png')):
+            return(None)
+        return(row[0][:-4] + '.tiles')
 
     def fetchDeets(self, recid):
         '''Return formatted HTML of the FITS details for `recid`.'''
@@ -427,6 +608,107 @@ class Markup:
         return(deets)
 
 
+_zip_pool = None
+_zip_pool_lock = threading.Lock()
+
+def zipPool(workers):
+    '''Return the process pool that decompresses .fits.fz for every download, starting it on first use.
+
+    One per process rather than one per request, and spawned rather than forked: a fork of a
+    threaded mod_wsgi daemon copies whatever locks its other threads hold, and can deadlock.
+    Spawning runs sys.executable, which under mod_wsgi is httpd, so imagelib.wsgi points
+    multiprocessing.set_executable() at python first.  The pool is shut down at exit.'''
+    global _zip_pool
+    with _zip_pool_lock:
+        if (_zip_pool is None):
+            _zip_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            atexit.register(shutdownZipPool)
+        return(_zip_pool)
+
+
+def shutdownZipPool():
+    '''Stop the zipPool() workers, if started, so a restarted daemon leaves none behind.'''
+    global _zip_pool
+    with _zip_pool_lock:
+        if (_zip_pool is not None):
+            logging.debug(">>> shutting down zip pool")
+            _zip_pool.shutdown(wait=True)
+            _zip_pool = None
+
+
+def decompressFits(path):
+    '''Return the bytes of .fits.fz `path` as a plain FITS file, or None if it holds no compressed image.
+
+    Module level so that Markup.zipstream() can run it in worker processes.'''
+    with astrofits.open(path, memmap=False,
+                        do_not_scale_image_data=True) as hdul:
+        # Decompress Rice-compressed images. do_not_scale_image_data
+        # keeps native integers + BSCALE/BZERO in the header,
+        # matching funpack output exactly.
+        decomp_hdus = []
+        found_comp = False
+        for hdu in hdul:
+            is_comp = isinstance(hdu, astrofits.CompImageHDU)
+            if is_comp:
+                found_comp = True
+                try:
+                    decomp_hdus.append(astrofits.ImageHDU(
+                        data=hdu.data, header=hdu.header))
+                except Exception as e:
+                    logging.warning("zipstream: decompress failed for {}: {}".format(
+                        os.path.basename(path), e))
+                    decomp_hdus.append(hdu.copy())
+            elif (isinstance(hdu, astrofits.PrimaryHDU)
+                  and hdu.header.get('NAXIS', 0) == 0):
+                pass  # skip fpack's empty placeholder primary
+            else:
+                decomp_hdus.append(hdu.copy())
+
+    if not found_comp:
+        return(None)
+
+    # Simple FITS readers only inspect HDU[0]. Promote the
+    # first decompressed ImageHDU to PrimaryHDU so the output
+    # is readable by readers that don't handle extensions.
+    if not decomp_hdus:
+        final_hdus = [astrofits.PrimaryHDU()]
+    elif isinstance(decomp_hdus[0], astrofits.ImageHDU):
+        first = decomp_hdus[0]
+        final_hdus = ([astrofits.PrimaryHDU(
+                           data=first.data, header=first.header)]
+                      + decomp_hdus[1:])
+    else:
+        final_hdus = decomp_hdus
+    buf = io.BytesIO()
+    astrofits.HDUList(final_hdus).writeto(buf, output_verify='silentfix')
+    return(buf.getvalue())
+
+
+class ZipSink:
+    '''Unseekable file-like target for zipfile.ZipFile that hands back whatever has been written so far.
+
+    ZipFile notices it can't seek and writes data descriptors instead of rewinding to patch headers.'''
+
+    def __init__(self):
+        self.chunks = list()
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return(len(data))
+
+    def flush(self):
+        pass
+
+    def take(self):
+        '''Return (and forget) everything written since the last take().'''
+        data = b''.join(self.chunks)
+        self.chunks = list()
+        self.size = 0
+        return(data)
+
+
 if (__name__ == "__main__"):
 
     if ((len(sys.argv) > 1) and (sys.argv[1] == '--debug')):
@@ -0,0 +1,195 @@
+#
+# pngrender.py -- in-process png preview and thumbnail rendering
+#
+#   A pure NumPy/astropy stand-in for the `fitspng` binary: the FITS pixel array is
+#   decoded once and both the full size preview and the scaled thumbnail are written
+#   from it, instead of forking fitspng (and re-decompressing the file) once per image.
+#
+
+import logging
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+from astropy.io import fits
+
+class PngRender:
+
+    # fitspng-style linear tone mapping: black is a low quantile of the pixel values
+    # (the sky background) and white sits `white_sigmas` noise levels above it
+    black_quantile = 0.25
+    white_sigmas = 20.0
+
+    # Statistics are estimated from every `stat_step`th pixel in each axis; plenty for 16MP frames
+    stat_step = 4
+
+    compresslevel = 6  # zlib level for png IDAT data
+
+    def readImage(self, filename):
+        '''Return the pixels of the first 2-axis HDU of `filename` as a float32 array.'''
+        with fits.open(filename, memmap=False) as hdul:
+            for hdu in hdul:
+                if (hdu.header.get('NAXIS') == 2 and hdu.data is not None):
+                    return(np.asarray(hdu.data, dtype=np.float32))
+        raise ValueError("No 2-axis image HDU in {}".format(filename))
+
+    def levels(self, data):
+        '''Return the (black, white) levels used to stretch `data`.'''
+        sample = data[::self.stat_step, ::self.stat_step]
+        sample = sample[np.isfinite(sample)]
+        if (sample.size == 0):
+            return(0.0, 1.0)
+        black = float(np.quantile(sample, self.black_quantile))
+        median = float(np.median(sample))
+        sigma = 1.4826 * float(np.median(np.abs(sample - median)))  # MAD estimate of the noise
+        white = black + self.white_sigmas * sigma
+        if (white <= black):
+            white = black + 1.0  # flat frame of constant value; avoid dividing by zero
+        return(black, white)
+
+    def stretch(self, data, black, white):
+        '''Map `data` linearly from [black, white] onto 8-bit grey, top row first.'''
+        scaled = (data - black) * (255.0 / (white - black))
+        scaled = np.nan_to_num(scaled, nan=0.0, posinf=255.0, neginf=0.0)
+        pixels = np.clip(scaled, 0, 255).astype(np.uint8)
+        return(np.flipud(pixels))  # FITS row 0 is the bottom of the image
+
+    def shrink(self, data, factor):
+        '''Scale `data` down by an integer `factor`, averaging each factor x factor block.'''
+        if (factor <= 1):
+            return(data)
+        rows = data.shape[0] // factor
+        cols = data.shape[1] // factor
+        if (rows == 0 or cols == 0):
+            return(data)
+        blocks = data[:rows * factor, :cols * factor].reshape(rows, factor, cols, factor)
+        return(blocks.mean(axis=(1, 3), dtype=np.float32))
+
+    @classmethod
+    def _chunk(cls, kind, payload):
+        return(struct.pack('>I', len(payload)) + kind + payload
+               + struct.pack('>I', zlib.crc32(kind + payload) & 0xffffffff))
+
+    def encodePng(self, pixels):
+        '''Return a 2-D uint8 array encoded as an 8-bit greyscale png.'''
+        height, width = pixels.shape
+        raw = np.zeros((height, width + 1), dtype=np.uint8)  # leading 0 per row == filter type None
+        raw[:, 1:] = pixels
+        return(b'\x89PNG\r\n\x1a\n'
+               + self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+               + self._chunk(b'IDAT', zlib.compress(raw.tobytes(), self.compresslevel))
+               + self._chunk(b'IEND', b''))
+
+    def writePng(self, filename, pixels):
+        '''Write a 2-D uint8 array as an 8-bit greyscale png.
+
+        The png is written under a unique temp name beside `filename` and then moved into
+        place, so readers and concurrent ingest runs never see a partial file.'''
+        fd, temp_png = tempfile.mkstemp(prefix='.imagelib_', suffix='.png', dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(fd, 'wb') as png:
+                png.write(self.encodePng(pixels))
+            os.chmod(temp_png, 0o644)  # mkstemp creates 0600; apache must be able to read it
+            os.replace(temp_png, filename)
+        finally:
+            if os.path.exists(temp_png):
+                os.unlink(temp_png)
+
+    # Channels per pixel of each 8-bit png colour type we can read
+    CHANNELS = { 0: 1, 2: 3, 4: 2, 6: 4 }  # grey, RGB, grey+alpha, RGBA
+
+    def readPng(self, filename):
+        '''Return an 8-bit png (as written by writePng() or fitspng) as a 2-D uint8 array of grey.
+
+        Just enough of a decoder to read thumbnails back for sprite sheets (see sprites.py):
+        8-bit, non-interlaced, any row filter; colour is averaged down to grey and alpha dropped.
+        Average and Paeth rows are unfiltered a byte at a time, so keep it away from full size
+        previews: work from the FITS data instead (see render()).'''
+        with open(filename, 'rb') as png:
+            data = png.read()
+        if (data[:8] != b'\x89PNG\r\n\x1a\n'):
+            raise ValueError("{} is not a png".format(filename))
+        offset = 8
+        idat = list()
+        header = None
+        while (offset < len(data)):
+            length, kind = struct.unpack_from('>I4s', data, offset)
+            payload = data[offset + 8:offset + 8 + length]
+            offset += 12 + length
+            if (kind == b'IHDR'):
+                header = struct.unpack('>IIBBBBB', payload)
+            elif (kind == b'IDAT'):
+                idat.append(payload)
+            elif (kind == b'IEND'):
+                break
+        if (header is None):
+            raise ValueError("{}: no IHDR".format(filename))
+        width, height, depth, colortype, compression, filtermethod, interlace = header
+        if (depth != 8 or colortype not in self.CHANNELS or interlace != 0):
+            raise ValueError("{}: unsupported png (depth {}, colour type {}, interlace {})".format(filename, depth, colortype, interlace))
+
+        bpp = self.CHANNELS[colortype]
+        stride = width * bpp
+        raw = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8)
+        raw = raw[:height * (stride + 1)].reshape(height, stride + 1)
+        pixels = np.zeros((height, stride), dtype=np.uint8)
+        prior = np.zeros(stride, dtype=np.uint8)
+        for y in range(height):
+            kind, line = raw[y, 0], raw[y, 1:]
+            if (kind == 0):    # None
+                row = line.copy()
+            elif (kind == 2):  # Up
+                row = line + prior
+            elif (kind == 1):  # Sub: running sum (mod 256) within each channel
+                row = np.empty(stride, dtype=np.uint8)
+                for c in range(bpp):
+                    row[c::bpp] = np.cumsum(line[c::bpp], dtype=np.uint64).astype(np.uint8)
+            else:              # Average and Paeth depend on the pixel just decoded, so go slowly
+                row = line.astype(np.int32)
+                up = prior.astype(np.int32)
+                for x in range(stride):
+                    left = row[x - bpp] if x >= bpp else 0
+                    if (kind == 3):
+                        row[x] = (row[x] + ((left + up[x]) >> 1)) & 0xff
+                    elif (kind == 4):
+                        upleft = up[x - bpp] if x >= bpp else 0
+                        p = left + up[x] - upleft
+                        pa, pb, pc = abs(p - left), abs(p - up[x]), abs(p - upleft)
+                        if (pa <= pb and pa <= pc):
+                            predictor = left
+                        elif (pb <= pc):
+                            predictor = up[x]
+                        else:
+                            predictor = upleft
+                        row[x] = (row[x] + predictor) & 0xff
+                    else:
+                        raise ValueError("{}: bad filter type {}".format(filename, kind))
+                row = row.astype(np.uint8)
+            pixels[y] = row
+            prior = row
+
+        pixels = pixels.reshape(height, width, bpp)
+        if (bpp >= 3):
+            return(pixels[:, :, :3].mean(axis=2).round().astype(np.uint8))
+        return(pixels[:, :, 0].copy())
+
+    def render(self, filename, preview=None, thumbnail=None, scaling=1, tiles=None):
+        '''Decode `filename` once and write the `preview` and/or `thumbnail` (shrunk by `scaling`) pngs,
+        and/or the `tiles` pyramid (see tiles.py).'''
+        data = self.readImage(filename)
+        black, white = self.levels(data)
+        logging.debug(">>> render({}): black={} white={}".format(filename, black, white))
+        if (preview or tiles):
+            pixels = self.stretch(data, black, white)
+        if (preview):
+            self.writePng(preview, pixels)
+            logging.info("Generated preview: {}".format(preview))
+        if (tiles):
+            import tiles as pyramid  # here, not at the top: tiles.py imports this module
+            pyramid.TilePyramid().write(tiles, pixels)
+            logging.info("Generated tiles: {}".format(tiles))
+        if (thumbnail):
+            self.writePng(thumbnail, self.stretch(self.shrink(data, scaling), black, white))
+            logging.info("Generated thumbnail: {}".format(thumbnail))
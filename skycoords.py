@@ -0,0 +1,96 @@
+#
+# skycoords.py -- sky coordinate parsing and angular distance
+#
+#   Just what the library needs, without pulling in astropy.coordinates: sexagesimal
+#   (or decimal) RA/Dec strings from FITS headers and the catalog to decimal degrees,
+#   and great circle distances, both one at a time (also registered with SQLite as
+#   angsep(); see fitsdb.py) and vectorised over numpy arrays.
+#
+
+import math
+import re
+
+import numpy as np
+
+SEPARATORS = re.compile(r'[\s:hmsd°\'"]+')
+
+def _sexagesimal(value):
+    '''Return (sign, [fields]) for a "12 34 56.7", "12:34:56.7" or "12h34m56.7s" style string.'''
+    value = value.strip()
+    sign = -1.0 if value.startswith('-') else 1.0
+    fields = [ float(f) for f in SEPARATORS.split(value.lstrip('+-')) if f ]
+    if (not fields or len(fields) > 3):
+        raise ValueError("cannot parse {!r}".format(value))
+    return(sign, fields)
+
+def parseRA(value):
+    '''Return right ascension `value` in decimal degrees.
+
+    Numbers (and strings of a single number) are taken as degrees; anything with
+    separators as sexagesimal hours, eg: OBJCTRA = '05 35 17.3'.'''
+    if (isinstance(value, (int, float))):
+        ra = float(value)
+    else:
+        sign, fields = _sexagesimal(value)
+        if (len(fields) == 1 and 'h' not in value.lower()):
+            ra = sign * fields[0]
+        else:
+            ra = sign * 15.0 * sum(f / 60.0**i for i, f in enumerate(fields))
+    if (not 0.0 <= ra <= 360.0):
+        raise ValueError("RA {!r} out of range".format(value))
+    return(ra % 360.0)
+
+def parseDec(value):
+    '''Return declination `value` (degrees, decimal or sexagesimal) in decimal degrees.'''
+    if (isinstance(value, (int, float))):
+        dec = float(value)
+    else:
+        sign, fields = _sexagesimal(value)
+        dec = sign * sum(f / 60.0**i for i, f in enumerate(fields))
+    if (not -90.0 <= dec <= 90.0):
+        raise ValueError("Dec {!r} out of range".format(value))
+    return(dec)
+
+def fromHeaders(headers):
+    '''Return (ra, dec) in degrees from OBJCTRA/OBJCTDEC (or RA/DEC) FITS headers, or None.'''
+    for ra_key, dec_key in (('OBJCTRA', 'OBJCTDEC'), ('RA', 'DEC')):
+        if (ra_key in headers and dec_key in headers):
+            try:
+                return((parseRA(headers[ra_key]), parseDec(headers[dec_key])))
+            except (ValueError, TypeError):
+                pass
+    return(None)
+
+def angsep(ra1, dec1, ra2, dec2):
+    '''Return the angle in degrees between (ra1, dec1) and (ra2, dec2), or None if any is NULL.'''
+    if (ra1 is None or dec1 is None or ra2 is None or dec2 is None):
+        return(None)
+    ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+    # Haversine: well conditioned for the small separations we care about
+    h = math.sin((dec2 - dec1) / 2)**2 + math.cos(dec1) * math.cos(dec2) * math.sin((ra2 - ra1) / 2)**2
+    return(math.degrees(2 * math.asin(min(1.0, math.sqrt(h)))))
+
+def angsepArray(ra, dec, ras, decs):
+    '''Return the angles in degrees between (ra, dec) and each of numpy arrays (ras, decs).'''
+    ra, dec = math.radians(ra), math.radians(dec)
+    ras, decs = np.radians(ras), np.radians(decs)
+    h = np.sin((decs - dec) / 2)**2 + math.cos(dec) * np.cos(decs) * np.sin((ras - ra) / 2)**2
+    return(np.degrees(2 * np.arcsin(np.minimum(1.0, np.sqrt(h)))))
+
+def bounds(ra, dec, radius):
+    '''Return [(min_ra, max_ra, min_dec, max_dec)...] boxes covering the cone of `radius` degrees about (ra, dec).
+
+    Two boxes when the cone straddles RA 0/360; the whole RA range when it covers a pole.'''
+    min_dec = max(-90.0, dec - radius)
+    max_dec = min(90.0, dec + radius)
+    if (min_dec <= -90.0 or max_dec >= 90.0):
+        return([ (0.0, 360.0, min_dec, max_dec) ])
+    # Widest RA extent of the circle (it's at a declination nearer the pole than its centre);
+    # the cone doesn't reach the pole, so sin(radius) < cos(dec)
+    half = math.degrees(math.asin(math.sin(math.radians(radius)) / math.cos(math.radians(dec))))
+    lo, hi = ra - half, ra + half
+    if (lo < 0.0):
+        return([ (0.0, hi, min_dec, max_dec), (lo + 360.0, 360.0, min_dec, max_dec) ])
+    if (hi > 360.0):
+        return([ (lo, 360.0, min_dec, max_dec), (0.0, hi - 360.0, min_dec, max_dec) ])
+    return([ (lo, hi, min_dec, max_dec) ])
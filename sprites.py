@@ -0,0 +1,207 @@
+#
+# sprites.py -- thumbnail sprite sheets, one per observing night and filter
+#
+#   A gallery page shows up to 64 thumbnails; fetched one by one that is 64 requests and
+#   64 file opens on the NAS.  Instead ingest packs the thumbnails of each (date, filter)
+#   group into one png sheet and records where each one landed in the fits table
+#   (sprite, sprite_x, sprite_y, sprite_w, sprite_h), and the page draws them as CSS
+#   background offsets into the sheet.  Sheet names carry a hash of their contents, so a
+#   rebuilt sheet is a new URL and the old one can be cached as immutable.
+#
+#   Ingest only appends the thumbnails of new frames to their group's sheet; the others are
+#   not read again.  A full repack, eg: after thumbnails were re-rendered, is by hand:
+#
+#   python3 sprites.py [date...]    rebuilds the sheets for `date`s, or for every date
+#
+
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sys
+
+import numpy as np
+
+import fitsdb
+import pngrender
+
+class SpriteSheets:
+
+    if (os.path.exists('/home/nas/Eagle')):
+        spritedir = '/home/nas/Eagle/sprites'  # under /Eagle so the web server can send them
+    else:
+        spritedir = 'Eagle/sprites'
+
+    cell = 128     # Thumbnails are at most 128 pixels wide (see FitsFiles.fits2png)
+    columns = 16   # Thumbnails per row of a sheet
+
+    COLUMNS = ['sprite', 'sprite_x', 'sprite_y', 'sprite_w', 'sprite_h']
+
+    def __init__(self, db, spritedir=None):
+        self.db = db
+        if (spritedir):
+            self.spritedir = spritedir
+
+    def enabled(self):
+        '''Return True if the fits table has the sprite columns (see `fitsdb.py update:sprites`).'''
+        cur = self.db.con.cursor()
+        cols = [ row[1] for row in cur.execute("PRAGMA table_info(fits)") ]
+        return(all(col in cols for col in self.COLUMNS))
+
+    def groups(self, dates=None):
+        '''Return the distinct (date, filter) groups, for `dates` if given.'''
+        cur = self.db.con.cursor()
+        sql = "SELECT DISTINCT date, filter FROM fits"
+        params = list()
+        if (dates):
+            sql += " WHERE date IN ({})".format(', '.join(['?'] * len(dates)))
+            params = list(dates)
+        return(cur.execute(sql + " ORDER BY date, filter", params).fetchall())
+
+    def sheetName(self, date, filter):
+        '''Return the sheet name prefix (without the version) for a (date, filter) group.'''
+        return("{}_{}".format(date, re.sub(r'[^A-Za-z0-9.-]+', '_', filter or 'none')))
+
+    def update(self, groups, rebuild=False):
+        '''Bring the sheet of each (date, filter) in `groups` up to date; return the number written.
+
+        Thumbnails not yet on their group's sheet are appended to it (see build()); with
+        `rebuild` every sheet is packed afresh from all of its thumbnails.'''
+        count = 0
+        for date, filter in sorted(set(groups), key=lambda g: (g[0] or '', g[1] or '')):
+            try:
+                if (self.build(date, filter, rebuild)):
+                    count += 1
+            except OSError as e:
+                logging.error("Cannot build sprite sheet for {} {}: {}".format(date, filter, e))
+        return(count)
+
+    def build(self, date, filter, rebuild=False):
+        '''Pack the thumbnails of one (date, filter) group into a sheet and record their offsets.
+
+        Only thumbnails without a sprite are read: they are appended after the last one on the
+        group's current sheet, which is read back as is (it is ours, so unfiltered and quick),
+        and only their rows get new offsets; the rest are just pointed at the new version.
+        The whole group is packed afresh with `rebuild`, or if its sheet has gone missing.
+
+        Returns True if a new sheet was written; False if it was already up to date.  Thumbnails
+        that are missing or unreadable are left out (their sprite is NULL), and the page falls
+        back to fetching them individually.'''
+        cur = self.db.con.cursor()
+        rows = cur.execute("SELECT id, thumbnail, sprite, sprite_x, sprite_y FROM fits WHERE date = ? AND filter IS ? ORDER BY id",
+                           [date, filter]).fetchall()
+        renderer = pngrender.PngRender()
+        name = self.sheetName(date, filter)
+
+        placed = [ row for row in rows if row[2] ]
+        current = { row[2] for row in placed }
+        current = current.pop() if len(current) == 1 else None
+        if (rebuild or (placed and (current is None or not os.path.exists(current)))):
+            current = None
+            placed = list()
+            pending = rows
+            version = hashlib.sha1("{} {}\n".format(self.cell, self.columns).encode())
+        else:
+            pending = [ row for row in rows if not row[2] ]
+            if (not pending):
+                return(False)
+            version = hashlib.sha1(os.path.basename(current or '').encode('utf-8', 'surrogateescape'))
+
+        # Read the new thumbnails first: the sheet's version is a hash of what goes into it
+        thumbs = list()
+        for recid, thumbnail, *_ in pending:
+            try:
+                st = os.stat(thumbnail)
+                pixels = renderer.readPng(thumbnail)
+            except (OSError, ValueError, TypeError) as e:
+                logging.debug(">>> sprite: skipping {}: {}".format(thumbnail, e))
+                continue
+            thumbs.append((recid, pixels))
+            version.update("{}\0{}\0{}\0{}\n".format(recid, thumbnail, st.st_size, st.st_mtime_ns).encode('utf-8', 'surrogateescape'))
+
+        if (not thumbs):
+            if (current is None):
+                self._record([ (None, None, None, None, None, row[0]) for row in rows ])
+                self._prune(name, None)
+            return(False)
+        sheet = os.path.join(self.spritedir, "{}_{}.png".format(name, version.hexdigest()[:10]))
+
+        # Lay thumbnails out left to right, `columns` to a row, each row as tall as its tallest,
+        # carrying on from the last row of the current sheet
+        base = renderer.readPng(current) if current else np.zeros((0, 0), dtype=np.uint8)
+        x = y = height = count = 0
+        if (placed):
+            y = max(row[4] for row in placed)
+            count = sum(1 for row in placed if row[4] == y)
+            x = count * self.cell
+            height = base.shape[0] - y
+        offsets = dict()
+        for recid, pixels in thumbs:
+            if (count == self.columns):
+                x, y, height, count = 0, y + height, 0, 0
+            h, w = pixels.shape
+            offsets[recid] = (x, y, w, h)
+            x += self.cell
+            height = max(height, h)
+            count += 1
+        width = max(base.shape[1], min(len(placed) + len(thumbs), self.columns) * self.cell)
+
+        written = False
+        if (not os.path.exists(sheet)):
+            pixels = np.zeros((y + height, width), dtype=np.uint8)
+            pixels[:base.shape[0], :base.shape[1]] = base
+            for recid, thumb in thumbs:
+                tx, ty, tw, th = offsets[recid]
+                pixels[ty:ty + th, tx:tx + tw] = thumb
+            os.makedirs(self.spritedir, exist_ok=True)
+            renderer.writePng(sheet, pixels)
+            logging.info("Generated sprite sheet: {} ({} thumbnails{})".format(sheet, len(thumbs), ' added' if current else ''))
+            written = True
+
+        if (current):
+            cur.execute("UPDATE fits SET sprite = ? WHERE sprite = ?", [sheet, current])
+        self._record([ (sheet,) + offsets[row[0]] + (row[0],) if row[0] in offsets else (None, None, None, None, None, row[0])
+                       for row in pending ])
+        self._prune(name, sheet)
+        return(written)
+
+    def _record(self, updates):
+        '''Store (sprite, x, y, w, h, id) tuples in the fits table.'''
+        cur = self.db.con.cursor()
+        sql = "UPDATE fits SET {} WHERE id = ?".format(', '.join("{} = ?".format(col) for col in self.COLUMNS))
+        cur.executemany(sql, updates)
+        self.db.con.commit()
+
+    def _prune(self, name, keep):
+        '''Delete superseded versions of sheet `name`, other than `keep`.'''
+        pattern = re.compile('^{}_[0-9a-f]{{10}}\\.png$'.format(re.escape(name)))
+        try:
+            entries = os.listdir(self.spritedir)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            path = os.path.join(self.spritedir, entry)
+            if (pattern.match(entry) and path != keep):
+                logging.debug(">>> sprite: removing old sheet {}".format(path))
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+
+if (__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser(description='Build thumbnail sprite sheets.')
+    parser.add_argument('--debug', '-d', dest='debug', action='store_true', help='print diabolocal debugging dregs')
+    parser.add_argument('date', nargs='*', help='observing date (YYYY-MM-DD) to rebuild (may be repeated; default: all)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    sheets = SpriteSheets(fitsdb.Fitsdb())
+    if (not sheets.enabled()):
+        print("ERROR: fits table has no sprite columns; run `python3 fitsdb.py update:sprites` first")
+        sys.exit(1)
+    count = sheets.update(sheets.groups(args.date), rebuild=True)
+    print("Wrote {} sprite sheets".format(count))
@@ -9,13 +9,40 @@ var color_downloading  = 'orange';
 /* Element that is currently being previewed (global so that keydownHandler() can access) */
 var previewElement = 0;
 
-/* Initialize Awesomplete for Target search */
+/* State of the tiled preview (see showTiles()); null when showing the whole png */
+var tileView = null;
+
+/* Initialize Awesomplete for Target search; suggestions are fetched from /api/targets as the user types */
 document.addEventListener("DOMContentLoaded", function() {
-    new Awesomplete(document.getElementById("awesomeTarget"), {
-        list: "#targetlist",
+    var input = document.getElementById("awesomeTarget");
+    if (!input) {
+        return;  /* not the library page (e.g. download.html) */
+    }
+    var awesomplete = new Awesomplete(input, {
+        list: [],
         maxItems: 25,
         minChars: 1,
     });
+    var suggestions = {};  /* prefix --> suggestion list, so backspacing doesn't refetch */
+    input.addEventListener("input", function() {
+        var prefix = input.value.trim();
+        if (prefix.length < 1) {
+            return;
+        }
+        if (suggestions[prefix]) {
+            awesomplete.list = suggestions[prefix];
+            return;
+        }
+        fetch("/api/targets?prefix=" + encodeURIComponent(prefix))
+            .then(function(response) { return response.json(); })
+            .then(function(list) {
+                suggestions[prefix] = list;
+                if (input.value.trim() == prefix) {  /* ignore replies to stale keystrokes */
+                    awesomplete.list = list;
+                    awesomplete.evaluate();
+                }
+            });
+    });
 });
 
 
@@ -93,6 +120,34 @@ function setRecids() {
     }
 }
 
+/* Download page: poll the status of background download `job` until its archive can be fetched */
+function pollDownload(job) {
+    var xhttp = new XMLHttpRequest();
+    xhttp.onreadystatechange = function() {
+        if (this.readyState != 4) {
+            return;
+        }
+        var progress = document.getElementById("download-progress");
+        if (this.status != 200) {
+            progress.innerHTML = "Download not found; it may have expired.";
+            return;
+        }
+        var status = JSON.parse(xhttp.responseText);
+        console.log("download " + job + ": " + status.state);
+        if (status.state == "done") {
+            progress.innerHTML = "Done: " + status.files_total + " images, " + (status.bytes / 1048576).toFixed(1) + " MB";
+            window.location = "/download/fetch/" + job;
+        } else if (status.state == "error") {
+            progress.innerHTML = "Zoinks! The download failed: " + status.error;
+        } else {
+            progress.innerHTML = status.files_done + " of " + status.files_total + " images, " + (status.bytes / 1048576).toFixed(1) + " MB so far";
+            setTimeout(pollDownload, 2000, job);
+        }
+    };
+    xhttp.open("GET", "/download/status/" + job, true);
+    xhttp.send();
+}
+
 /* Return just the filename component of a full path */
 function basename(path) {
    return path.split('/').reverse()[0];
@@ -123,12 +178,35 @@ function preview(el) {
     var image = document.getElementById(el+'img');
     var previewWindow = document.getElementById("preview-window");
     var previewImg = document.getElementById("preview-img");
-    var preview_src = image.src.replace("-thumb.png", ".png")
+    var preview_src = image.dataset.preview;  /* thumbnails may be drawn from a sprite sheet, so no src to go on */
 
-    /* Paint our image */
-    previewImg.src = preview_src
+    /* Paint our image: just the tiles in view if the frame has a tile pyramid, else the whole png */
+    var tilesDiv = document.getElementById("preview-tiles");
+    tileView = null;
+    tilesDiv.innerHTML = "";
+    tilesDiv.style.display = "none";
+    previewImg.style.display = "none";
     previewImg.maxWidth = previewWindow.clientWidth;
     previewImg.maxHeight = previewWindow.clientHeight;
+    fetch("/tiles/" + recid + "/info")
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error("no tiles for " + recid);
+            }
+            return response.json();
+        })
+        .then(function(info) {
+            if (previewElement == el) {  /* ignore replies for a preview already moved on from */
+                showTiles(recid, info);
+            }
+        })
+        .catch(function(error) {
+            console.log(error);
+            if (previewElement == el) {
+                previewImg.src = preview_src;
+                previewImg.style.display = "";
+            }
+        });
     document.getElementById('preview-filename').innerHTML = basename(preview_src).replaceAll("%20", " ");
     document.getElementById("preview-content").style.borderColor = document.getElementById(el).rfoIsSelected ? color_selected : color_unselected;
 
@@ -150,6 +228,104 @@ function preview(el) {
     document.getElementById("preview-container").style.display = "block";
 }
 
+/* Tiled preview: start on the largest pyramid level that fits the pane, centred */
+function showTiles(recid, info) {
+    console.log("showTiles(" + recid + ")");
+    var view = document.getElementById("preview-tiles");
+    view.style.display = "block";
+    var z = 0;
+    while (z + 1 < info.levels.length && info.levels[z + 1][0] <= view.clientWidth && info.levels[z + 1][1] <= view.clientHeight) {
+        z++;
+    }
+    tileView = {
+        recid: recid,
+        info: info,
+        z: z,
+        x: (view.clientWidth - info.levels[z][0]) / 2,  /* pane position of the level's top left corner */
+        y: (view.clientHeight - info.levels[z][1]) / 2,
+        tiles: {},  /* "z/x/y" --> <img> currently in the pane */
+        drag: null,
+    };
+    paintTiles();
+}
+
+/* Add <img>s for the tiles of the current level that are in view, and drop the rest */
+function paintTiles() {
+    var t = tileView;
+    var view = document.getElementById("preview-tiles");
+    var size = t.info.tile;
+    var level = t.info.levels[t.z];
+    var x0 = Math.max(0, Math.floor(-t.x / size));
+    var x1 = Math.min(Math.ceil(level[0] / size) - 1, Math.floor((view.clientWidth - t.x - 1) / size));
+    var y0 = Math.max(0, Math.floor(-t.y / size));
+    var y1 = Math.min(Math.ceil(level[1] / size) - 1, Math.floor((view.clientHeight - t.y - 1) / size));
+    var wanted = {};
+    for (let ty = y0; ty <= y1; ty++) {
+        for (let tx = x0; tx <= x1; tx++) {
+            var key = t.z + "/" + tx + "/" + ty;
+            wanted[key] = 1;
+            if (!t.tiles[key]) {
+                var img = document.createElement("img");
+                img.src = "/tiles/" + t.recid + "/" + key + "?v=" + t.info.version;
+                view.appendChild(img);
+                t.tiles[key] = img;
+            }
+            t.tiles[key].style.left = (t.x + tx * size) + "px";
+            t.tiles[key].style.top = (t.y + ty * size) + "px";
+        }
+    }
+    for (var key in t.tiles) {
+        if (!wanted[key]) {
+            view.removeChild(t.tiles[key]);
+            delete t.tiles[key];
+        }
+    }
+}
+
+/* Move to pyramid level `z`, keeping pane point (`cx`, `cy`) over the same spot in the image */
+function zoomTilesTo(z, cx, cy) {
+    var t = tileView;
+    if (!t || z < 0 || z >= t.info.levels.length || z == t.z) {
+        return;
+    }
+    t.x = cx - (cx - t.x) * t.info.levels[z][0] / t.info.levels[t.z][0];
+    t.y = cy - (cy - t.y) * t.info.levels[z][1] / t.info.levels[t.z][1];
+    t.z = z;
+    paintTiles();
+}
+
+/* onwheel/ondblclick for the tiled preview: zoom in or out a level around the pointer */
+function zoomTiles(event, dz) {
+    if (!tileView) {
+        return;
+    }
+    event.preventDefault();
+    var rect = document.getElementById("preview-tiles").getBoundingClientRect();
+    if (dz == undefined) {
+        dz = event.deltaY < 0 ? 1 : -1;
+    }
+    zoomTilesTo(tileView.z + dz, event.clientX - rect.left, event.clientY - rect.top);
+}
+
+/* onmousedown/onmousemove/onmouseup for the tiled preview: drag to pan */
+function panTiles(event) {
+    var t = tileView;
+    if (!t) {
+        return;
+    }
+    if (event.type == "mousedown") {
+        event.preventDefault();
+        t.drag = { x: event.clientX, y: event.clientY };
+    } else if (event.type == "mousemove" && t.drag) {
+        t.x += event.clientX - t.drag.x;
+        t.y += event.clientY - t.drag.y;
+        t.drag = { x: event.clientX, y: event.clientY };
+        paintTiles();
+    } else {
+        t.drag = null;
+    }
+}
+
 /* Special flavor of toggle() that also colors the preview border */
 function toggleSelect(el, mode) {
     select(el, mode);
@@ -159,6 +335,7 @@ function toggleSelect(el, mode) {
 /* Close the preview modal and return to our regularly scheduled display */
 function closePreview() {
     document.getElementById("preview-container").style.display = "none";
+    tileView = null;
     document.removeEventListener("keydown", keydownHandler);
 }
 
@@ -32,7 +32,15 @@ import fitsdb as _fitsdb
 _session_dir = tempfile.mkdtemp(prefix='imagelib_test_')
 _session_db_path = os.path.join(_session_dir, 'session.db')
 _fitsdb.Fitsdb.dbfile = _session_db_path
-_fitsdb.Fitsdb.tsfile = os.path.join(_session_dir, 'session.last_run')
+
+import fitscache as _fitscache
+_fitscache.FitsCache.cachedir = os.path.join(_session_dir, 'fitscache')
+
+import jobs as _jobs
+_jobs.DownloadJobs.jobdir = os.path.join(_session_dir, 'jobs')
+
+import sprites as _sprites
+_sprites.SpriteSheets.spritedir = os.path.join(_session_dir, 'sprites')
 
 # 4. Reset catalog's lazy class-level DB so it picks up the patched dbfile.
 import catalog as _catalog
@@ -51,7 +59,9 @@ def _create_fits_schema(db):
             filter TEXT, binning TEXT, exposure REAL,
             x INTEGER, y INTEGER,
             path TEXT, preview TEXT, thumbnail TEXT, imagetype TEXT,
-            organization TEXT, project TEXT, observatory TEXT, observer TEXT
+            organization TEXT, project TEXT, observatory TEXT, observer TEXT,
+            ra REAL, dec REAL,
+            sprite TEXT, sprite_x INTEGER, sprite_y INTEGER, sprite_w INTEGER, sprite_h INTEGER
         )
     ''')
     cur.execute(
@@ -154,6 +164,7 @@ def fresh_catalog_db(tmp_path, monkeypatch):
     db_path = str(tmp_path / 'test.db')
     monkeypatch.setattr(_fitsdb.Fitsdb, 'dbfile', db_path)
     monkeypatch.setattr(_catalog.Catalog, 'db', None)
+    monkeypatch.setattr(_catalog.Catalog, 'aliases', None)
     db = _fitsdb.Fitsdb()
     _create_fits_schema(db)
     _create_catalog_schema(db)
@@ -81,6 +81,71 @@ def test_cname_lazy_db_init(fresh_catalog_db, monkeypatch):
     assert catalog.Catalog.db is not None
 
 
+def test_cname_ignores_spacing_and_case(fresh_catalog_db):
+    _insert_entry(fresh_catalog_db, 'NGC 5194', other='M 51', cname='M 51')
+    assert catalog.Catalog.cname(' ngc  5194') == 'M 51'
+    assert catalog.Catalog.cname('"m 51"') == 'M 51'
+    assert catalog.Catalog.cname('M51') == 'M51'  # spacing is collapsed, not dropped
+
+
+def test_cname_exact_alias_beats_normalized(fresh_catalog_db):
+    _insert_entry(fresh_catalog_db, 'IC 1', cname='IC 1')
+    _insert_entry(fresh_catalog_db, 'ic 1', cname='Other')
+    assert catalog.Catalog.cname('ic 1') == 'Other'
+    assert catalog.Catalog.cname('IC  1') == 'IC 1'
+
+
+def test_resolver_runs_no_sql_after_warm_up(fresh_catalog_db):
+    _insert_entry(fresh_catalog_db, 'NGC 5194', other='M 51', cname='M 51')
+    catalog.Catalog.cname('M 51')
+    statements = []
+    catalog.Catalog.db.con.set_trace_callback(statements.append)
+    fresh_catalog_db.con.set_trace_callback(statements.append)
+    for _ in range(400):
+        assert catalog.Catalog.cname('NGC 5194') == 'M 51'
+        assert catalog.Catalog.alias('ngc  5194', fresh_catalog_db) == 'M 51'
+    catalog.Catalog.db.con.set_trace_callback(None)
+    fresh_catalog_db.con.set_trace_callback(None)
+    assert statements == []
+
+
+def test_resolver_uses_the_callers_connection(fresh_catalog_db):
+    _insert_entry(fresh_catalog_db, 'NGC 5194', other='M 51', cname='M 51')
+    assert catalog.Catalog.alias('NGC 5194', fresh_catalog_db) == 'M 51'
+    assert catalog.Catalog.db is None
+
+
+def test_resolver_reloads_when_catalog_recreated(fresh_catalog_db, monkeypatch):
+    _insert_entry(fresh_catalog_db, 'NGC 5194', other='M 51', cname='M 51')
+    assert catalog.Catalog.cname('NGC 5457') == 'NGC 5457'
+    cur = fresh_catalog_db.con.cursor()
+    cur.execute("DROP TABLE catalog_by_target")
+    cur.execute("CREATE TABLE catalog_by_target (target TEXT, id INTEGER, cname TEXT)")
+    cur.execute("INSERT INTO catalog_by_target VALUES ('NGC 5457', 2, 'M 101')")
+    fresh_catalog_db.con.commit()
+    assert catalog.Catalog.cname('NGC 5457') == 'NGC 5457'  # Not rechecked yet
+    monkeypatch.setattr(catalog.Catalog, 'recheck', 0)
+    assert catalog.Catalog.cname('NGC 5457') == 'M 101'
+    assert catalog.Catalog.cname('NGC 5194') == 'NGC 5194'
+
+
+def test_resolver_recheck_skips_reload_when_unchanged(fresh_catalog_db, monkeypatch):
+    _insert_entry(fresh_catalog_db, 'NGC 5194', other='M 51', cname='M 51')
+    monkeypatch.setattr(catalog.Catalog, 'recheck', 0)
+    catalog.Catalog.cname('M 51')
+    statements = []
+    catalog.Catalog.db.con.set_trace_callback(statements.append)
+    assert catalog.Catalog.cname('NGC 5194') == 'M 51'
+    catalog.Catalog.db.con.set_trace_callback(None)
+    assert statements == ['PRAGMA schema_version']
+
+
+def test_resolver_without_catalog(fresh_db, monkeypatch):
+    monkeypatch.setattr(catalog.Catalog, 'db', None)
+    assert catalog.Catalog.alias('M 51') is None
+    assert catalog.Catalog.cname('M 51') == 'M 51'
+
+
 def test_malformed_catalog_line_skipped(tmp_path):
     """The next→continue fix: a line with too few fields is skipped, not inserted."""
     import subprocess
@@ -107,3 +172,202 @@ def test_malformed_catalog_line_skipped(tmp_path):
     # Both valid entries inserted, malformed one skipped
     assert '2 catalog entries added' in result.stdout
     assert 'Not enough fields' in result.stdout
+
+
+# ---------------------------------------------------------------------------
+# Positional matching
+# ---------------------------------------------------------------------------
+
+def _positions(db):
+    """Give the catalog SAC-style ra/dec columns and two objects, and index them."""
+    cur = db.con.cursor()
+    cur.execute("ALTER TABLE catalog ADD COLUMN ra TEXT")
+    cur.execute("ALTER TABLE catalog ADD COLUMN dec TEXT")
+    _insert_entry(db, 'NGC 5194', other='M 51', cname='M 51')
+    _insert_entry(db, 'NGC 5195')
+    _insert_entry(db, 'NGC 9999')
+    cur.execute("UPDATE catalog SET ra = '13 29.9', dec = '+47 12' WHERE object = 'NGC 5194'")
+    cur.execute("UPDATE catalog SET ra = '13 30.0', dec = '+47 16' WHERE object = 'NGC 5195'")
+    cur.execute("UPDATE catalog SET ra = 'n/a', dec = '' WHERE object = 'NGC 9999'")
+    db.con.commit()
+    return catalog.Catalog.createRadec(db)
+
+
+def test_create_radec_parses_sac_positions(fresh_catalog_db):
+    assert _positions(fresh_catalog_db) == 2
+    rows = fresh_catalog_db.con.execute("SELECT min_ra, min_dec FROM catalog_radec ORDER BY min_ra").fetchall()
+    assert rows[0] == (pytest.approx(202.475, abs=1e-3), pytest.approx(47.2, abs=1e-3))
+
+
+def test_create_radec_without_position_columns(fresh_catalog_db):
+    assert catalog.Catalog.createRadec(fresh_catalog_db) is None
+    assert not fresh_catalog_db.hasTable('catalog_radec')
+
+
+def test_nearest_picks_closest_within_radius(fresh_catalog_db):
+    _positions(fresh_catalog_db)
+    assert catalog.Catalog.nearest(202.48, 47.21, 0.5) == 'M 51'
+    assert catalog.Catalog.nearest(202.50, 47.26, 0.5) == 'NGC 5195'
+    assert catalog.Catalog.nearest(202.48, 48.5, 0.5) is None
+
+
+def test_fov_from_optics():
+    headers = {'FOCALLEN': 1000.0, 'XPIXSZ': 9.0, 'NAXIS1': 3000, 'NAXIS2': 4000}
+    # 27mm x 36mm sensor: 45mm diagonal at 1000mm is ~2.58 deg across
+    assert catalog.Catalog.fov(headers) == pytest.approx(1.289, abs=1e-3)
+    assert catalog.Catalog.fov({'NAXIS1': 3000, 'NAXIS2': 4000}) == catalog.Catalog.fov_default
+    assert catalog.Catalog.fov({'FOCALLEN': 0, 'XPIXSZ': 9.0, 'NAXIS1': 1, 'NAXIS2': 1}) == catalog.Catalog.fov_default
+
+
+def test_cname_falls_back_to_position(fresh_catalog_db):
+    _positions(fresh_catalog_db)
+    headers = {'OBJCTRA': '13 29 55', 'OBJCTDEC': '+47 13 00'}
+    assert catalog.Catalog.cname('Field 3', headers) == 'M 51'
+    assert catalog.Catalog.cname('Field 3', {'OBJCTRA': '01 00 00', 'OBJCTDEC': '+10 00 00'}) == 'Field 3'
+    assert catalog.Catalog.cname('Field 3') == 'Field 3'
+
+
+def test_rematch_renames_unmatched_frames(tmp_path, monkeypatch):
+    import subprocess
+    import sys
+    from tests.conftest import _create_fits_schema, _insert_fits_record
+
+    db_path = str(tmp_path / 'cat.db')
+    cat_file = tmp_path / 'test.cat'
+    cat_file.write_text(
+        '"object","other","type","con","ra","dec"\n'
+        '"NGC 5194","M 51","Gx","CVn","13 29.9","+47 12"\n'
+        '"NGC 5457","M 101","Gx","UMa","14 03.2","+54 21"\n'
+    )
+    env = {**os.environ, 'FITSDB_FILE': db_path}
+    result = subprocess.run([sys.executable, 'catalog.py', 'create', str(cat_file)],
+                            capture_output=True, text=True, env=env)
+    assert '2 catalog positions indexed' in result.stdout
+
+    monkeypatch.setattr(catalog.fitsdb.Fitsdb, 'dbfile', db_path)
+    db = catalog.fitsdb.Fitsdb()
+    _create_fits_schema(db)
+    _insert_fits_record(db, target='Field 3', object='Field 3', path='/x/a.fits', ra=202.48, dec=47.2)
+    _insert_fits_record(db, target='Comet', object='Comet', path='/x/b.fits', ra=10.0, dec=10.0)
+    _insert_fits_record(db, target='M 101', object='M 101', path='/x/c.fits', ra=202.48, dec=47.2)
+    db.con.close()
+
+    result = subprocess.run([sys.executable, 'catalog.py', 'rematch'], capture_output=True, text=True, env=env)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert '1 frames renamed' in result.stdout
+    assert catalog.fitsdb.Fitsdb().con.execute("SELECT path, target FROM fits ORDER BY path").fetchall() == [
+        ('/x/a.fits', 'M 51'), ('/x/b.fits', 'Comet'), ('/x/c.fits', 'M 101')]
+
+
+def test_create_bulk_load(tmp_path, monkeypatch):
+    """Quoted commas, duplicate objects and the indexes built after the load."""
+    import subprocess
+    import sys
+
+    db_path = str(tmp_path / 'cat.db')
+    cat_file = tmp_path / 'test.cat'
+    cat_file.write_text(
+        '"OBJECT","OTHER","TYPE","CON","NGC DESCR"\n'
+        '"NGC 5194  ","M 51;UGC 8493","GALXY","CVN","vB, vL, pair"\n'
+        '"NGC 5194","Dup","GALXY","CVN",""\n'
+        '"NGC 5457","M 101","GALXY","UMA","pB, vL"\n'
+    )
+    result = subprocess.run(
+        [sys.executable, 'catalog.py', 'create', str(cat_file)],
+        capture_output=True, text=True,
+        env={**os.environ, 'FITSDB_FILE': db_path},
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Duplicate NGC 5194 entry found at line 3; skipping' in result.stdout
+    assert '2 catalog entries added' in result.stdout
+    assert '5 target aliases added' in result.stdout
+    assert 'Loaded in ' in result.stdout
+
+    monkeypatch.setattr(catalog.fitsdb.Fitsdb, 'dbfile', db_path)
+    db = catalog.fitsdb.Fitsdb()
+    con = db.con
+    assert con.execute("SELECT object, ngc_descr FROM catalog ORDER BY id").fetchall() == [
+        ('NGC 5194', 'vB, vL, pair'), ('NGC 5457', 'pB, vL')]
+    assert con.execute("SELECT target, id, cname FROM catalog_by_target ORDER BY rowid").fetchall() == [
+        ('NGC 5194', 1, 'M 51'), ('M 51', 1, 'M 51'), ('UGC 8493', 1, 'M 51'),
+        ('NGC 5457', 2, 'M 101'), ('M 101', 2, 'M 101')]
+    indexes = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'catalog_object_index', 'catalog_by_target_target_index', 'catalog_by_target_id_index'} <= indexes
+
+
+# ---------------------------------------------------------------------------
+# query
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def galaxies(fresh_catalog_db):
+    _insert_entry(fresh_catalog_db, 'NGC 5194', other='M 51;UGC 8493', cname='M 51')
+    _insert_entry(fresh_catalog_db, 'NGC 5195')
+    _insert_entry(fresh_catalog_db, 'NGC 7000', other='North America Nebula')
+    fresh_catalog_db.con.execute("UPDATE catalog SET type = 'BRTNB', con = 'CYG' WHERE object = 'NGC 7000'")
+    fresh_catalog_db.con.commit()
+    return fresh_catalog_db
+
+
+def test_query_exact_ignores_case_and_spacing(galaxies):
+    [m51] = catalog.Catalog.query('m  51')
+    assert (m51['object'], m51['alias'], m51['cname'], m51['con']) == ('NGC 5194', 'M 51', 'M 51', 'UMa')
+    assert catalog.Catalog.query('M 5') == []
+
+
+def test_query_prefix(galaxies):
+    results = catalog.Catalog.query('ngc 519', mode='prefix')
+    assert [r['object'] for r in results] == ['NGC 5194', 'NGC 5195']
+
+
+def test_query_fuzzy_uses_trigram_index(galaxies):
+    catalog.Catalog.createSearch(galaxies)
+    statements = []
+    galaxies.con.set_trace_callback(statements.append)
+    [nan] = catalog.Catalog.query('america', mode='fuzzy', db=galaxies)
+    galaxies.con.set_trace_callback(None)
+    assert (nan['object'], nan['alias']) == ('NGC 7000', 'North America Nebula')
+    assert any('catalog_fts' in sql for sql in statements)
+    assert [r['object'] for r in catalog.Catalog.query('849', mode='fuzzy')] == ['NGC 5194']
+    assert [r['object'] for r in catalog.Catalog.query('ug', mode='fuzzy')] == ['NGC 5194']  # too short: prefix
+
+
+def test_query_fuzzy_without_index_still_answers(galaxies):
+    assert [r['object'] for r in catalog.Catalog.query('america', mode='fuzzy')] == ['NGC 7000']
+
+
+def test_query_filters(galaxies):
+    assert [r['object'] for r in catalog.Catalog.query(type='gx')] == ['NGC 5194', 'NGC 5195']
+    assert [r['object'] for r in catalog.Catalog.query(con='cyg')] == ['NGC 7000']
+    assert catalog.Catalog.query('NGC', mode='prefix', type='BRTNB', limit=5)[0]['object'] == 'NGC 7000'
+    assert catalog.Catalog.query('NGC', mode='prefix', limit=2)[-1]['object'] == 'NGC 5195'
+
+
+def test_query_needs_something_to_look_for(galaxies):
+    assert catalog.Catalog.query('') == []
+    with pytest.raises(ValueError):
+        catalog.Catalog.query('M 51', mode='regex')
+
+
+def test_query_cli_json(tmp_path):
+    import json
+    import subprocess
+    import sys
+
+    db_path = str(tmp_path / 'cat.db')
+    cat_file = tmp_path / 'test.cat'
+    cat_file.write_text(
+        '"object","other","type","con"\n'
+        '"NGC 5194","M 51","GALXY","CVN"\n'
+        '"NGC 7000","North America Neb","BRTNB","CYG"\n'
+    )
+    env = {**os.environ, 'FITSDB_FILE': db_path}
+    subprocess.run([sys.executable, 'catalog.py', 'create', str(cat_file)], capture_output=True, env=env, check=True)
+    result = subprocess.run([sys.executable, 'catalog.py', 'query', '--fuzzy', '--json', 'america'],
+                            capture_output=True, text=True, env=env)
+    assert result.returncode == 0, result.stdout + result.stderr
+    [nan] = json.loads(result.stdout)
+    assert (nan['object'], nan['type'], nan['con']) == ('NGC 7000', 'BRTNB', 'CYG')
+    result = subprocess.run([sys.executable, 'catalog.py', 'query', '--con', 'cvn'], capture_output=True, text=True, env=env)
+    assert 'NGC 5194' in result.stdout
+    assert '1 objects' in result.stdout
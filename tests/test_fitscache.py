@@ -0,0 +1,58 @@
+"""Unit tests for fitscache.py"""
+import os
+import time
+
+import pytest
+
+import fitscache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return fitscache.FitsCache(cachedir=str(tmp_path / 'cache'), max_bytes=250)
+
+
+def _source(tmp_path, name, data=b'compressed'):
+    path = str(tmp_path / name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_miss_then_hit(cache, tmp_path):
+    src = _source(tmp_path, 'a.fits.fz')
+    assert cache.get(src) is None
+    cached = cache.put(src, b'decompressed')
+    assert cache.get(src) == cached
+    with open(cached, 'rb') as f:
+        assert f.read() == b'decompressed'
+
+
+def test_rewritten_source_misses(cache, tmp_path):
+    src = _source(tmp_path, 'a.fits.fz')
+    cache.put(src, b'old')
+    _source(tmp_path, 'a.fits.fz', b'rewritten and longer')
+    assert cache.get(src) is None
+
+
+def test_evicts_least_recently_used(cache, tmp_path):
+    a, b, c = [_source(tmp_path, n + '.fits.fz') for n in 'abc']
+    cache.put(a, b'x' * 100)
+    cache.put(b, b'x' * 100)
+    old = time.time() - 60
+    os.utime(cache.filename(b), (old, old))
+    os.utime(cache.filename(a), (old - 60, old - 60))
+    cache.get(a)  # a is now the most recently used
+    cache.put(c, b'x' * 100)
+    assert cache.get(b) is None
+    assert cache.get(a) is not None
+    assert cache.get(c) is not None
+    assert not [n for n in os.listdir(cache.cachedir) if n.startswith('.fitscache_')]
+
+
+def test_unwritable_cache_is_a_miss(tmp_path):
+    blocker = _source(tmp_path, 'not_a_dir')
+    cache = fitscache.FitsCache(cachedir=os.path.join(blocker, 'cache'))
+    src = _source(tmp_path, 'a.fits.fz')
+    assert cache.put(src, b'data') is None
+    assert cache.get(src) is None
@@ -53,3 +53,135 @@ def test_status_query(fresh_db):
     cur = fresh_db.con.cursor()
     total = cur.execute("SELECT count(*) FROM fits").fetchone()[0]
     assert total == 2
+
+
+# ---------------------------------------------------------------------------
+# insert_many / batch
+# ---------------------------------------------------------------------------
+
+def test_insert_many_inserts_all(fresh_db):
+    count, failures = fresh_db.insert_many([_rec(path='/t/a'), _rec(path='/t/b')])
+    assert (count, failures) == (2, [])
+
+
+def test_insert_many_duplicate_does_not_abort_batch(fresh_db):
+    fresh_db.insert(_rec(path='/t/dup'))
+    images = [_rec(path='/t/a'), _rec(path='/t/dup'), _rec(path='/t/b')]
+    count, failures = fresh_db.insert_many(images)
+    assert count == 2
+    assert [image['path'] for image, msg in failures] == ['/t/dup']
+    assert 'UNIQUE' in failures[0][1]
+    paths = [r[0] for r in fresh_db.con.execute("SELECT path FROM fits ORDER BY id")]
+    assert paths == ['/t/dup', '/t/a', '/t/b']
+
+
+def test_insert_many_mixed_columns_keeps_order(fresh_db):
+    """Records with different column sets are grouped but ids follow input order."""
+    cal = _rec(path='/t/cal', imagetype='cal')
+    tgt = dict(_rec(path='/t/tgt'), organization='RFO', observer='Someone')
+    images = [cal, tgt, _rec(path='/t/cal2', imagetype='cal')]
+    assert fresh_db.insert_many(images) == (3, [])
+    rows = fresh_db.con.execute("SELECT path, organization FROM fits ORDER BY id").fetchall()
+    assert rows == [('/t/cal', None), ('/t/tgt', 'RFO'), ('/t/cal2', None)]
+
+
+def test_batch_commits_per_batch(fresh_db):
+    import sqlite3
+    reader = sqlite3.connect(fresh_db.dbfile)
+    visible = lambda: reader.execute("SELECT count(*) FROM fits").fetchone()[0]
+    with fresh_db.batch(size=3) as batch:
+        batch.add(_rec(path='/t/1'))
+        batch.add(_rec(path='/t/2'))
+        assert visible() == 0
+        batch.add(_rec(path='/t/3'))
+        assert visible() == 3
+        batch.add(_rec(path='/t/4'))
+    assert visible() == 4
+    assert batch.count == 4
+    reader.close()
+
+
+def test_batch_collects_failures(fresh_db):
+    with fresh_db.batch() as batch:
+        batch.add(_rec(path='/t/1'))
+        batch.add(_rec(path='/t/1'))
+    assert batch.count == 1
+    assert len(batch.failures) == 1
+
+
+# ---------------------------------------------------------------------------
+# Fuzzy search index
+# ---------------------------------------------------------------------------
+
+def test_create_search_indexes_targets_objects_and_aliases(fresh_catalog_db):
+    db = fresh_catalog_db
+    db.insert(_rec(path='/test/old.fits'))  # before the index exists: backfilled
+    db.con.execute("INSERT INTO catalog_by_target (target, id, cname) VALUES ('Whirlpool Galaxy', 1, 'M 51')")
+    db.createSearch()
+    db.insert(_rec(target='NGC 7000', object='North America', path='/test/new.fits'))  # via trigger
+    terms = set(db.con.execute("SELECT term, target FROM target_terms"))
+    assert terms == {('M 51', 'M 51'), ('NGC 5194', 'M 51'), ('Whirlpool Galaxy', 'M 51'),
+                     ('NGC 7000', 'NGC 7000'), ('North America', 'NGC 7000')}
+    hits = db.con.execute("SELECT DISTINCT target FROM target_fts WHERE term LIKE '%america%'").fetchall()
+    assert hits == [('NGC 7000',)]
+
+
+def test_create_search_is_idempotent(fresh_db):
+    fresh_db.insert(_rec())
+    fresh_db.createSearch()
+    fresh_db.createSearch()
+    assert fresh_db.con.execute("SELECT count(*) FROM target_fts").fetchone()[0] == 2
+
+
+# ---------------------------------------------------------------------------
+# RA/Dec cone search index
+# ---------------------------------------------------------------------------
+
+def test_create_radec_indexes_positions(fresh_db):
+    db = fresh_db
+    db.insert(_rec(path='/test/old.fits', ra=202.47, dec=47.2))  # before the index exists: backfilled
+    db.insert(_rec(path='/test/nopos.fits'))
+    db.createRadec()
+    db.insert(_rec(path='/test/new.fits', ra=10.0, dec=-5.0))  # via trigger
+    rows = db.con.execute("SELECT min_ra, min_dec FROM fits_radec ORDER BY min_ra").fetchall()
+    assert [(round(ra), round(dec)) for ra, dec in rows] == [(10, -5), (202, 47)]
+    db.con.execute("UPDATE fits SET ra = NULL WHERE path = '/test/new.fits'")
+    db.con.execute("DELETE FROM fits WHERE path = '/test/old.fits'")
+    assert db.con.execute("SELECT count(*) FROM fits_radec").fetchone()[0] == 0
+
+
+def test_angsep_registered_with_sqlite(fresh_db):
+    assert fresh_db.con.execute("SELECT angsep(0, 0, 0, 1)").fetchone()[0] == pytest.approx(1.0)
+
+
+def test_create_survives_sqlite_without_fts5_or_rtree(tmp_path):
+    """`fitsdb.py create` warns and carries on when the optional virtual tables can't be made."""
+    import os
+    import sqlite3
+    import subprocess
+    import sys
+
+    db_path = str(tmp_path / 'bare.db')
+    script = '''
+import runpy, sqlite3, sys
+class Cursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        if ('USING fts5' in sql or 'USING rtree' in sql):
+            raise sqlite3.OperationalError('no such module: ' + ('fts5' if 'fts5' in sql else 'rtree'))
+        return super().execute(sql, *args)
+class Connection(sqlite3.Connection):
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+connect = sqlite3.connect
+sqlite3.connect = lambda *args, **kwargs: connect(*args, factory=Connection, **kwargs)
+sys.argv = ['fitsdb.py', 'create']
+runpy.run_path('fitsdb.py', run_name='__main__')
+'''
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                            env={**os.environ, 'FITSDB_FILE': db_path})
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'WARNING: search index not created: no such module: fts5' in result.stdout
+    assert 'WARNING: cone search index not created: no such module: rtree' in result.stdout
+    tables = {row[0] for row in sqlite3.connect(db_path).execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'fits', 'fits_by_target'} <= tables
+    assert not {'target_fts', 'fits_radec'} & tables
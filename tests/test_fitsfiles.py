@@ -5,6 +5,7 @@ from unittest.mock import patch, MagicMock
 import pytest
 
 import fitsfiles
+import tiles
 from tests.conftest import make_fits_file, make_fitsz_file
 
 
@@ -101,7 +102,7 @@ def test_build_record_calibration_flat(ff):
 
 
 # ---------------------------------------------------------------------------
-# fits2png  (subprocess mocked so fitspng binary is not required)
+# fits2png, fitspng backend  (subprocess mocked so fitspng binary is not required)
 # ---------------------------------------------------------------------------
 
 def _fake_fitspng(cmd, **kwargs):
@@ -115,6 +116,7 @@ def test_fits2png_preview_and_thumb_created(ff, fits_path):
     expected_preview = fits_path.replace('.fits', '.png')
     expected_thumb   = fits_path.replace('.fits', '-thumb.png')
 
+    ff.renderer = 'fitspng'
     with patch('subprocess.run', side_effect=_fake_fitspng):
         record = ff.fits2png({'path': fits_path, 'x': 200, 'y': 100})
 
@@ -125,7 +127,8 @@ def test_fits2png_preview_and_thumb_created(ff, fits_path):
 
 
 def test_fits2png_original_file_restored(ff, fits_path):
-    """The temp-rename workaround must always restore the original filename."""
+    """The original file must still be in place after rendering."""
+    ff.renderer = 'fitspng'
     with patch('subprocess.run', side_effect=_fake_fitspng):
         ff.fits2png({'path': fits_path, 'x': 200, 'y': 100})
 
@@ -139,6 +142,7 @@ def test_fits2png_skips_existing_preview(ff, fits_path):
     open(preview, 'wb').close()
     open(thumb,   'wb').close()
 
+    ff.renderer = 'fitspng'
     with patch('subprocess.run') as mock_run:
         ff.fits2png({'path': fits_path, 'x': 200, 'y': 100})
 
@@ -150,6 +154,7 @@ def test_fits2png_fitsz_preview_and_thumb_created(ff, fitsz_path):
     expected_preview = fitsz_path[:-8] + '.png'
     expected_thumb   = fitsz_path[:-8] + '-thumb.png'
 
+    ff.renderer = 'fitspng'
     with patch('subprocess.run', side_effect=_fake_fitspng):
         record = ff.fits2png({'path': fitsz_path, 'x': 200, 'y': 100})
 
@@ -160,13 +165,95 @@ def test_fits2png_fitsz_preview_and_thumb_created(ff, fitsz_path):
 
 
 def test_fits2png_fitsz_original_file_restored(ff, fitsz_path):
-    """.fits.fz: the temp-rename workaround must restore the original filename."""
+    """.fits.fz: the original file must still be in place after rendering."""
+    ff.renderer = 'fitspng'
     with patch('subprocess.run', side_effect=_fake_fitspng):
         ff.fits2png({'path': fitsz_path, 'x': 200, 'y': 100})
 
     assert os.path.exists(fitsz_path)
 
 
+AWKWARD_NAME = 'NGC 7000 [Ha] Cygnus – 300s (1).fits.fz'
+
+
+def test_fitspng_gets_simple_name_and_original_untouched(ff, tmp_path):
+    """fitspng sees a simple symlinked name; the awkward original is never renamed."""
+    src = str(tmp_path / AWKWARD_NAME)
+    make_fitsz_file(src)
+    before = os.stat(src)
+    seen = []
+
+    def fake(cmd, **kwargs):
+        seen.append(cmd[-1])
+        assert os.path.basename(cmd[-1]) == 'image.fits.fz'
+        assert os.path.realpath(cmd[-1]) == os.path.realpath(src)
+        assert os.path.exists(src)
+        _fake_fitspng(cmd, **kwargs)
+
+    ff.renderer = 'fitspng'
+    with patch('subprocess.run', side_effect=fake):
+        record = ff.fits2png({'path': src, 'x': 200, 'y': 100})
+
+    assert len(seen) == 2
+    after = os.stat(src)
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+    assert sorted(os.listdir(tmp_path)) == sorted([
+        AWKWARD_NAME, os.path.basename(record['preview']), os.path.basename(record['thumbnail']),
+        os.path.basename(record['preview'])[:-4] + '.tiles'])
+
+
+def test_fitspng_tiles_come_from_fits_not_preview(ff, fits_path):
+    """fitspng's full size preview is never decoded in Python to build the pyramid."""
+    import pngrender
+    ff.renderer = 'fitspng'
+    with patch('subprocess.run', side_effect=_fake_fitspng), \
+         patch.object(pngrender.PngRender, 'readPng', side_effect=AssertionError('decoded preview')):
+        record = ff.fits2png({'path': fits_path, 'x': 200, 'y': 100})
+    info = tiles.TilePyramid().info(record['preview'][:-4] + '.tiles')
+    assert (info['width'], info['height']) == (200, 100)
+
+
+def test_fitspng_failure_leaves_no_temp_files(ff, fits_path, tmp_path):
+    import subprocess as sp
+    ff.renderer = 'fitspng'
+    err = sp.CalledProcessError(1, 'fitspng', stderr='boom')
+    with patch('subprocess.run', side_effect=err):
+        ff.fits2png({'path': fits_path, 'x': 200, 'y': 100})
+    assert os.listdir(tmp_path) == ['light.fits']
+
+
+# ---------------------------------------------------------------------------
+# fits2png, numpy backend (default)
+# ---------------------------------------------------------------------------
+
+def test_fits2png_numpy_renders_fitsz(ff, fitsz_path):
+    """The in-process renderer writes both pngs without ever running fitspng."""
+    with patch('subprocess.run') as mock_run:
+        record = ff.fits2png({'path': fitsz_path, 'x': 200, 'y': 100})
+    mock_run.assert_not_called()
+    for png in record['preview'], record['thumbnail']:
+        with open(png, 'rb') as f:
+            assert f.read(8) == b'\x89PNG\r\n\x1a\n'
+
+
+def test_fits2png_numpy_awkward_name(ff, tmp_path):
+    src = str(tmp_path / AWKWARD_NAME)
+    make_fitsz_file(src)
+    record = ff.fits2png({'path': src, 'x': 200, 'y': 100})
+    assert sorted(os.listdir(tmp_path)) == sorted([
+        AWKWARD_NAME, os.path.basename(record['preview']), os.path.basename(record['thumbnail']),
+        os.path.basename(record['preview'])[:-4] + '.tiles'])
+
+
+def test_fits2png_numpy_decodes_once(ff, fits_path):
+    """Preview, thumbnail and tiles come from a single decode of the FITS data."""
+    import pngrender
+    with patch.object(pngrender.PngRender, 'readImage', autospec=True,
+                      side_effect=pngrender.PngRender.readImage) as mock_read:
+        ff.fits2png({'path': fits_path, 'x': 200, 'y': 100})
+    assert mock_read.call_count == 1
+
+
 # ---------------------------------------------------------------------------
 # addFitsFile — MN/MNc calibration filter (3d)
 # ---------------------------------------------------------------------------
@@ -219,6 +306,19 @@ def test_build_record_asterism_metadata(ff):
     assert record['observer'] == 'J. Smith'
 
 
+def test_build_record_sky_position(ff):
+    headers = {
+        'OBJECT': 'M 51', 'DATE-OBS': '2024-06-01T04:30:00.000',
+        'EXPTIME': 300.0, 'IMAGETYP': 'Light Frame',
+        'NAXIS1': 200, 'NAXIS2': 100,
+        'OBJCTRA': '13 29 52.7', 'OBJCTDEC': '+47 11 43',
+    }
+    with patch('catalog.Catalog.cname', return_value='M 51'):
+        record = ff.buildDatabaseRecord('/tmp/m51.fits', headers)
+    assert record['ra'] == pytest.approx(202.4696, abs=1e-4)
+    assert record['dec'] == pytest.approx(47.1953, abs=1e-4)
+
+
 def test_build_record_direct_rfo_metadata(ff):
     """No INSTABBR → organization='RFO', observatory/observer from headers, no project key."""
     headers = {
@@ -301,3 +401,102 @@ def test_build_record_calibration_no_metadata(ff):
     assert 'project' not in record
     assert 'observatory' not in record
     assert 'observer' not in record
+
+
+# ---------------------------------------------------------------------------
+# addFitsFiles — parallel ingest (--jobs)
+# ---------------------------------------------------------------------------
+
+def _ingest(tmp_path, monkeypatch, name, jobs):
+    """Ingest three FITS files into a fresh DB with `jobs` workers; return all fits rows."""
+    import fitsdb
+    from tests.conftest import _create_fits_schema
+    monkeypatch.setattr(fitsdb.Fitsdb, 'dbfile', str(tmp_path / (name + '.db')))
+    db = fitsdb.Fitsdb()
+    _create_fits_schema(db)
+
+    src = tmp_path / name
+    src.mkdir()
+    files = []
+    for i, obj in enumerate(['M 51', 'M 101', 'NGC 7000']):
+        p = str(src / 'light_{:03d}.fits'.format(i))
+        make_fits_file(p, object_name=obj)
+        files.append(p)
+
+    ff = fitsfiles.FitsFiles()
+    ff.jobs = jobs
+    with patch('catalog.Catalog.cname', side_effect=lambda o, headers=None: o):
+        count = ff.findNewFits(str(src), db, files=files)
+    rows = db.con.execute(
+        "SELECT id, target, object, date, x, y, path, preview, thumbnail FROM fits ORDER BY id"
+    ).fetchall()
+    return count, [tuple(str(v).replace(str(src), '') for v in row) for row in rows]
+
+
+def test_parallel_ingest_matches_serial(tmp_path, monkeypatch):
+    serial_count, serial_rows = _ingest(tmp_path, monkeypatch, 'serial', jobs=1)
+    parallel_count, parallel_rows = _ingest(tmp_path, monkeypatch, 'parallel', jobs=2)
+    assert serial_count == parallel_count == 3
+    assert parallel_rows == serial_rows
+
+
+def test_parallel_ingest_skips_unpreparable_files(ff, tmp_path, fresh_db):
+    """Files that prepare to None are skipped without inserting."""
+    ff.jobs = 2
+    missing = [str(tmp_path / 'gone_1.fits'), str(tmp_path / 'gone_2.fits')]
+    assert ff.addFitsFiles(missing, fresh_db) == 0
+    assert fresh_db.con.execute("SELECT count(*) FROM fits").fetchone()[0] == 0
+
+
+def test_reingest_reports_duplicates_without_aborting(ff, tmp_path, fresh_db):
+    """A batch with an already-ingested file still adds the new ones."""
+    old, new = str(tmp_path / 'old.fits'), str(tmp_path / 'new.fits')
+    make_fits_file(old)
+    make_fits_file(new)
+    with patch('catalog.Catalog.cname', side_effect=lambda o, headers=None: o):
+        assert ff.addFitsFiles([old], fresh_db) == 1
+        assert ff.addFitsFiles([old, new], fresh_db) == 1
+
+
+# ---------------------------------------------------------------------------
+# parseFitsHeader — header-only fast path
+# ---------------------------------------------------------------------------
+
+def test_parse_header_does_not_open_with_astropy(ff, fitsz_path):
+    with patch('fitsfiles.fits.open', side_effect=AssertionError('astropy used')):
+        headers = ff.parseFitsHeader(fitsz_path)
+    assert headers['OBJECT'] == 'M 51'
+
+
+def test_parse_header_falls_back_to_astropy(ff, fits_path):
+    with patch('fitsheader.FitsHeader.scan', side_effect=ValueError('nope')):
+        headers = ff.parseFitsHeader(fits_path)
+    assert headers['NAXIS1'] == 200
+
+
+def test_find_new_fits_uses_manifest(tmp_path, fresh_db):
+    """A tree scan ingests each file once, including copies that keep an old mtime."""
+    src = tmp_path / 'Eagle'
+    src.mkdir()
+    make_fits_file(str(src / 'a.fits'), object_name='M 51')
+    ff = fitsfiles.FitsFiles()
+    with patch('catalog.Catalog.cname', side_effect=lambda o, headers=None: o):
+        assert ff.findNewFits(str(src), fresh_db, files=None) == 1
+        assert ff.findNewFits(str(src), fresh_db, files=None) == 0
+        old = os.path.getmtime(str(src / 'a.fits')) - 86400
+        make_fits_file(str(src / 'b.fits'), object_name='M 101')
+        os.utime(str(src / 'b.fits'), (old, old))
+        assert ff.findNewFits(str(src), fresh_db, files=None) == 1
+
+
+def test_add_fits_files_builds_sprite_sheet(ff, tmp_path, fresh_db, monkeypatch):
+    import sprites
+    monkeypatch.setattr(sprites.SpriteSheets, 'spritedir', str(tmp_path / 'sprites'))
+    make_fits_file(str(tmp_path / 'a.fits'))
+    make_fits_file(str(tmp_path / 'b.fits'))
+    with patch('catalog.Catalog.cname', side_effect=lambda o, headers=None: o):
+        assert ff.addFitsFiles([str(tmp_path / 'a.fits'), str(tmp_path / 'b.fits')], fresh_db) == 2
+    rows = fresh_db.con.execute("SELECT sprite, sprite_x FROM fits ORDER BY id").fetchall()
+    assert rows[0][0] == rows[1][0]
+    assert rows[0][0].startswith(str(tmp_path / 'sprites'))
+    assert [x for _, x in rows] == [0, 128]
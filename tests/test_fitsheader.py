@@ -0,0 +1,83 @@
+"""Unit tests for fitsheader.py"""
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import fitsheader
+from tests.conftest import make_fits_file, make_fitsz_file
+
+KEYS = ('NAXIS1', 'NAXIS2', 'EXPTIME', 'IMAGETYP', 'XBINNING', 'YBINNING',
+        'FILTER', 'OBJECT', 'DATE-OBS', 'MISSING')
+
+
+def _astropy_headers(path):
+    """What the old astropy-based parseFitsHeader() would have extracted."""
+    with fits.open(path) as hdul:
+        for hdu in hdul:
+            if hdu.header['NAXIS'] == 2:
+                break
+        return {k: hdu.header[k] for k in KEYS if k in hdu.header}
+
+
+@pytest.mark.parametrize('maker,name', [(make_fits_file, 'a.fits'), (make_fitsz_file, 'a.fits.fz')])
+def test_scan_matches_astropy(tmp_path, maker, name):
+    path = str(tmp_path / name)
+    maker(path)
+    scanned = fitsheader.FitsHeader.scan(path, KEYS)
+    assert scanned == _astropy_headers(path)
+    assert scanned['NAXIS1'] == 200 and scanned['NAXIS2'] == 100
+    assert type(scanned['XBINNING']) is int
+    assert type(scanned['EXPTIME']) is float
+
+
+def test_scan_stops_at_first_2axis_hdu(tmp_path):
+    """Like the astropy loop, the first NAXIS=2 HDU wins, even if it is a table."""
+    path = str(tmp_path / 'multi.fits')
+    table = fits.BinTableHDU.from_columns([fits.Column(name='a', format='E', array=np.arange(1000.0))])
+    image = fits.ImageHDU(np.zeros((30, 40), dtype=np.int16))
+    image.header['OBJECT'] = 'Found Me'
+    fits.HDUList([fits.PrimaryHDU(), table, image]).writeto(path)
+    assert fitsheader.FitsHeader.scan(path, ['NAXIS1', 'OBJECT']) == {'NAXIS1': 4}
+
+
+def test_scan_finds_image_after_1d_primary(tmp_path):
+    path = str(tmp_path / 'oned.fits')
+    image = fits.ImageHDU(np.zeros((30, 40), dtype=np.int16))
+    image.header['OBJECT'] = 'Found Me'
+    fits.HDUList([fits.PrimaryHDU(np.zeros(5000, dtype=np.float64)), image]).writeto(path)
+    assert fitsheader.FitsHeader.scan(path, ['NAXIS1', 'OBJECT']) == {'NAXIS1': 40, 'OBJECT': 'Found Me'}
+
+
+def test_scan_no_image_returns_none(tmp_path):
+    path = str(tmp_path / 'empty.fits')
+    fits.HDUList([fits.PrimaryHDU()]).writeto(path)
+    assert fitsheader.FitsHeader.scan(path, KEYS) is None
+
+
+def test_scan_not_fits_raises(tmp_path):
+    path = tmp_path / 'junk.fits'
+    path.write_bytes(b'not a fits file at all')
+    with pytest.raises(ValueError):
+        fitsheader.FitsHeader.scan(str(path), KEYS)
+
+
+def test_scan_strings_bools_and_continue(tmp_path):
+    path = str(tmp_path / 'strings.fits')
+    hdu = fits.PrimaryHDU(np.zeros((2, 2), dtype=np.int16))
+    hdu.header['OBJECT'] = "Barnard's Loop  "
+    hdu.header['FLAG'] = True
+    hdu.header['LONGSTR'] = 'x' * 100 + 'y' * 30
+    hdu.header['EXPTIME'] = 1.5e3
+    fits.HDUList([hdu]).writeto(path)
+    scanned = fitsheader.FitsHeader.scan(path, ['OBJECT', 'FLAG', 'LONGSTR', 'EXPTIME'])
+    assert scanned == {'OBJECT': "Barnard's Loop", 'FLAG': True,
+                       'LONGSTR': 'x' * 100 + 'y' * 30, 'EXPTIME': 1500.0}
+
+
+def test_parse_value_forms():
+    pv = fitsheader.FitsHeader.parseValue
+    assert pv("                 -20. / comment") == -20.0
+    assert pv("               1.0D2") == 100.0
+    assert pv("                   F") is False
+    assert pv("'It''s   '           / c") == "It's"
+    assert pv("") is None
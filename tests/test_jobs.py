@@ -0,0 +1,176 @@
+"""Unit tests for jobs.py"""
+import json
+import os
+import time
+import zipfile
+
+import pytest
+
+import jobs
+
+
+class FakeMarkup:
+    """Stands in for markup.Markup: two files, zipped by a real ZipFile."""
+
+    def __init__(self, tmp_path, fail=False):
+        self.paths = list()
+        for name in ('a.fits', 'b.fits'):
+            path = str(tmp_path / name)
+            with open(path, 'wb') as f:
+                f.write(name.encode() * 1000)
+            self.paths.append(path)
+        self.fail = fail
+
+    def fetchZipRows(self, recidstr):
+        return [(i, path) for i, path in enumerate(self.paths)]
+
+    def zipstream(self, recidstr, fmt='fz', progress=None):
+        if self.fail:
+            raise OSError('disk on fire')
+        import io
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            for i, path in enumerate(self.paths):
+                zf.write(path, os.path.basename(path))
+                progress(i + 1, len(self.paths))
+        data = buf.getvalue()
+        yield data[:100]
+        yield data[100:]
+
+
+@pytest.fixture
+def downloads(tmp_path):
+    return jobs.DownloadJobs(FakeMarkup(tmp_path), jobdir=str(tmp_path / 'jobs'))
+
+
+def _wait(downloads, job):
+    for _ in range(100):
+        status = downloads.status(job)
+        if status['state'] in ('done', 'error'):
+            return status
+        time.sleep(0.05)
+    raise AssertionError('job never finished')
+
+
+def test_is_large(downloads):
+    assert not downloads.isLarge(1, 1024)
+    assert downloads.isLarge(downloads.max_stream_files + 1, 0)
+    assert downloads.isLarge(1, downloads.max_stream_bytes + 1)
+
+
+def test_job_builds_archive(downloads):
+    job = downloads.submit('1,2', filename='fits_x.zip')
+    status = _wait(downloads, job)
+    assert status['state'] == 'done'
+    assert status['files_done'] == status['files_total'] == 2
+    assert status['filename'] == 'fits_x.zip'
+    archive = downloads.archive(job)
+    assert status['bytes'] == os.path.getsize(archive)
+    with zipfile.ZipFile(archive) as zf:
+        assert zf.namelist() == ['a.fits', 'b.fits']
+
+
+def test_failed_job_reports_error(tmp_path):
+    downloads = jobs.DownloadJobs(FakeMarkup(tmp_path, fail=True), jobdir=str(tmp_path / 'jobs'))
+    job = downloads.submit('1,2')
+    status = _wait(downloads, job)
+    assert status['state'] == 'error'
+    assert 'disk on fire' in status['error']
+    assert downloads.archive(job) is None
+
+
+def test_stalled_job_reports_error(downloads):
+    job = downloads.submit('1,2')
+    _wait(downloads, job)
+    statusfile = downloads.path(job, 'status.json')
+    with open(statusfile) as f:
+        status = json.load(f)
+    status.update(state='running', updated=time.time() - downloads.stall - 1)
+    with open(statusfile, 'w') as f:
+        json.dump(status, f)
+    assert downloads.status(job)['state'] == 'error'
+
+
+@pytest.mark.parametrize('job', ['', '../etc', 'ABCDEF', '0' * 31, '0' * 32 + '/..'])
+def test_bad_job_ids_rejected(downloads, job):
+    assert downloads.path(job) is None
+    assert downloads.status(job) is None
+    assert downloads.archive(job) is None
+
+
+def test_expire_removes_old_jobs(downloads):
+    old = downloads.submit('1,2')
+    _wait(downloads, old)
+    stale = time.time() - downloads.ttl - 1
+    os.utime(downloads.path(old, 'status.json'), (stale, stale))
+    new = downloads.submit('1,2')  # submitting sweeps
+    _wait(downloads, new)
+    assert not os.path.exists(downloads.path(old))
+    assert downloads.archive(new) is not None
+
+
+def test_polling_sweeps_old_jobs_without_new_submissions(downloads, monkeypatch):
+    old = downloads.submit('1,2')
+    new = downloads.submit('1,2')
+    _wait(downloads, old)
+    _wait(downloads, new)
+    stale = time.time() - downloads.ttl - 1
+    os.utime(downloads.path(old, 'status.json'), (stale, stale))
+
+    monkeypatch.setattr(jobs.DownloadJobs, 'swept', time.time())
+    assert downloads.status(new)['state'] == 'done'  # swept recently: not yet
+    assert os.path.exists(downloads.path(old))
+
+    monkeypatch.setattr(jobs.DownloadJobs, 'swept', time.time() - downloads.sweep)
+    assert downloads.archive(new) is not None
+    assert not os.path.exists(downloads.path(old))
+    assert downloads.status(old) is None
+
+
+def _rewrite_status(downloads, job, **changes):
+    statusfile = downloads.path(job, 'status.json')
+    with open(statusfile) as f:
+        status = json.load(f)
+    status.update(changes)
+    with open(statusfile, 'w') as f:
+        json.dump(status, f)
+
+
+def test_long_queued_job_is_not_stalled(downloads):
+    job = downloads.submit('1,2')
+    _wait(downloads, job)
+    _rewrite_status(downloads, job, state='queued', updated=time.time() - downloads.stall - 1)
+    assert downloads.status(job)['state'] == 'queued'
+
+
+def test_queued_job_of_a_dead_process_reports_error(downloads):
+    import subprocess
+    import sys
+    gone = subprocess.Popen([sys.executable, '-c', 'pass'])
+    gone.wait()
+    job = downloads.submit('1,2')
+    _wait(downloads, job)
+    _rewrite_status(downloads, job, state='queued', pid=gone.pid)
+    status = downloads.status(job)
+    assert status['state'] == 'error'
+    assert status['error'] == 'runner gone'
+
+
+def test_bytes_are_reported_while_a_member_is_written(tmp_path, monkeypatch):
+    seen = []
+
+    class OneBigFile(FakeMarkup):
+        def zipstream(self, recidstr, fmt='fz', progress=None):
+            for _ in range(3):
+                yield b'x' * 1000
+                with open(downloads.path(job, 'status.json')) as f:
+                    seen.append(json.load(f)['bytes'])
+
+    downloads = jobs.DownloadJobs(OneBigFile(tmp_path), jobdir=str(tmp_path / 'jobs'))
+    monkeypatch.setattr(downloads, 'report', 0)
+    monkeypatch.setattr(downloads.runner, 'submit', lambda fn, *args: None)  # run it here instead
+    job = downloads.submit('1,2')
+    with open(downloads.path(job, 'status.json')) as f:
+        status = json.load(f)
+    downloads._run(job, '1,2', 'fz', status)
+    assert seen == [1000, 2000, 3000]
@@ -0,0 +1,110 @@
+"""Unit tests for manifest.py"""
+import os
+import shutil
+import time
+from unittest.mock import patch
+
+import pytest
+
+import manifest
+
+PATTERNS = ['*.fits', '*.fits.fz']
+
+
+def _touch(path, data=b'x', mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def _age(path, seconds=2 * manifest.Manifest.settle):
+    """Back-date a directory so the manifest treats it as settled."""
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def _scan(db, root):
+    m = manifest.Manifest(db)
+    found = m.scan(str(root), PATTERNS)
+    m.save()
+    return found
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'Eagle'
+    _touch(str(root / '2024-06-01' / 'a.fits'))
+    _touch(str(root / '2024-06-01' / 'notes.txt'))
+    _touch(str(root / '2024-06-02' / 'b.fits.fz'))
+    for d in [root / '2024-06-01', root / '2024-06-02', root]:
+        _age(str(d))
+    return root
+
+
+def test_first_scan_finds_everything(fresh_db, tree):
+    found = _scan(fresh_db, tree)
+    assert [os.path.relpath(f, str(tree)) for f in found] == [
+        os.path.join('2024-06-01', 'a.fits'), os.path.join('2024-06-02', 'b.fits.fz')]
+
+
+def test_rescan_finds_nothing(fresh_db, tree):
+    _scan(fresh_db, tree)
+    assert _scan(fresh_db, tree) == []
+
+
+def test_unsaved_scan_is_repeated(fresh_db, tree):
+    manifest.Manifest(fresh_db).scan(str(tree), PATTERNS)
+    assert len(_scan(fresh_db, tree)) == 2
+
+
+def test_new_file_with_old_mtime_found(fresh_db, tree):
+    """A copy that preserves an mtime older than the last scan is still found."""
+    _scan(fresh_db, tree)
+    old = time.time() - 10 * 86400
+    _touch(str(tree / '2024-06-01' / 'c.fits'), mtime=old)
+    assert _scan(fresh_db, tree) == [str(tree / '2024-06-01' / 'c.fits')]
+
+
+def test_new_directory_found(fresh_db, tree):
+    _scan(fresh_db, tree)
+    src = str(tree / '2024-06-01' / 'a.fits')
+    os.makedirs(str(tree / '2024-06-03'))
+    shutil.copy2(src, str(tree / '2024-06-03' / 'd.fits'))
+    assert _scan(fresh_db, tree) == [str(tree / '2024-06-03' / 'd.fits')]
+
+
+def test_modified_file_in_unsettled_dir_found(fresh_db, tree):
+    d = tree / '2024-06-02'
+    _touch(str(d / 'e.fits'), data=b'partial')
+    _scan(fresh_db, tree)
+    _touch(str(d / 'e.fits'), data=b'partial upload complete')
+    assert _scan(fresh_db, tree) == [str(d / 'e.fits')]
+
+
+def test_deleted_file_forgotten(fresh_db, tree):
+    _scan(fresh_db, tree)
+    os.unlink(str(tree / '2024-06-01' / 'a.fits'))
+    shutil.rmtree(str(tree / '2024-06-02'))
+    assert _scan(fresh_db, tree) == []
+    paths = [r[0] for r in fresh_db.con.execute("SELECT path FROM manifest")]
+    dirs = [r[0] for r in fresh_db.con.execute("SELECT path FROM manifest_dirs")]
+    assert paths == []
+    assert str(tree / '2024-06-02') not in dirs
+
+
+def test_settled_directories_not_listed(fresh_db, tree):
+    _scan(fresh_db, tree)
+    _touch(str(tree / '2024-06-02' / 'f.fits'))
+    calls = []
+    real_scandir = os.scandir
+
+    def counting_scandir(path):
+        calls.append(path)
+        return real_scandir(path)
+
+    with patch('manifest.os.scandir', side_effect=counting_scandir):
+        found = _scan(fresh_db, tree)
+    assert found == [str(tree / '2024-06-02' / 'f.fits')]
+    assert calls == [str(tree / '2024-06-02')]
@@ -1,4 +1,5 @@
 """Unit tests for markup.py"""
+import io
 import os
 import zipfile
 from unittest.mock import patch
@@ -55,6 +56,19 @@ def test_target_exact_match(m, fresh_db):
     assert 'M 51' in m.get_params()
 
 
+def test_target_catalog_alias_resolves_to_target(fresh_catalog_db):
+    fresh_catalog_db.insert(_stats_rec())
+    fresh_catalog_db.con.executemany("INSERT INTO catalog_by_target (target, id, cname) VALUES (?,?,?)", [
+        ('NGC 5194', 1, 'M 51'), ('M 51', 1, 'M 51')])
+    fresh_catalog_db.con.commit()
+    m = markup_module.Markup()
+    m.reset()
+    m.buildWhere_target('ngc  5194')
+    assert m.get_where() == 'target = ?'
+    assert m.get_params() == ['M 51']
+    assert m.get_what() == 'M 51'
+
+
 def test_target_fuzzy_match_uses_parameter(m):
     """SQL injection fix: fuzzy LIKE must use a bound parameter, not interpolation."""
     m.buildWhere_target("M'; DROP TABLE fits; --")
@@ -81,30 +95,16 @@ def test_multiple_wheres_joined_with_and(m):
 
 
 # ---------------------------------------------------------------------------
-# findStartDate
+# zipstream
 # ---------------------------------------------------------------------------
 
-def test_find_start_date_exact(m):
-    dates = ['2024-06-03', '2024-06-02', '2024-06-01']
-    assert m.findStartDate(dates, '2024-06-02') == 1
-
-
-def test_find_start_date_none_returns_zero(m):
-    dates = ['2024-06-03', '2024-06-02', '2024-06-01']
-    assert m.findStartDate(dates, None) == 0
-
+def _zipped(m, recidstr, fmt='fz'):
+    """The whole zipstream() of `recidstr`, opened as a ZipFile."""
+    return zipfile.ZipFile(io.BytesIO(b''.join(m.zipstream(recidstr, fmt))))
 
-def test_find_start_date_beyond_end_wraps_to_zero(m):
-    dates = ['2024-06-03', '2024-06-02', '2024-06-01']
-    assert m.findStartDate(dates, '2023-01-01') == 0
 
-
-# ---------------------------------------------------------------------------
-# zipit
-# ---------------------------------------------------------------------------
-
-def test_zipit_returns_valid_zip(fresh_db, tmp_path):
-    """zipit() should produce a readable ZIP containing the requested file."""
+def test_zipstream_returns_valid_zip(fresh_db, tmp_path):
+    """zipstream() should produce a readable ZIP containing the requested file."""
     fits_file = str(tmp_path / 'target.fits')
     make_fits_file(fits_file)
 
@@ -119,15 +119,12 @@ def test_zipit_returns_valid_zip(fresh_db, tmp_path):
     recid = cur.execute("SELECT id FROM fits WHERE path = ?", [fits_file]).fetchone()[0]
 
     m = markup_module.Markup()
-    zip_path = m.zipit(str(recid))
-
-    assert os.path.exists(zip_path)
-    with zipfile.ZipFile(zip_path) as zf:
+    with _zipped(m, str(recid)) as zf:
         names = zf.namelist()
     assert 'target.fits' in names
 
 
-def test_zipit_filename_is_basename(fresh_db, tmp_path):
+def test_zipstream_filename_is_basename(fresh_db, tmp_path):
     """Files in the ZIP should use just the basename, not the full path."""
     fits_file = str(tmp_path / 'deep' / 'nested' / 'image.fits')
     os.makedirs(os.path.dirname(fits_file))
@@ -144,13 +141,11 @@ def test_zipit_filename_is_basename(fresh_db, tmp_path):
     recid = cur.execute("SELECT id FROM fits WHERE path = ?", [fits_file]).fetchone()[0]
 
     m = markup_module.Markup()
-    zip_path = m.zipit(str(recid))
-
-    with zipfile.ZipFile(zip_path) as zf:
+    with _zipped(m, str(recid)) as zf:
         assert 'image.fits' in zf.namelist()
 
 
-def test_zipit_fitsz_served_as_fz(fresh_db, tmp_path):
+def test_zipstream_fitsz_served_as_fz(fresh_db, tmp_path):
     """fmt='fz' passes .fits.fz through to the ZIP unchanged."""
     fitsz_file = str(tmp_path / 'image.fits.fz')
     make_fitsz_file(fitsz_file)
@@ -166,9 +161,7 @@ def test_zipit_fitsz_served_as_fz(fresh_db, tmp_path):
     recid = cur.execute("SELECT id FROM fits WHERE path = ?", [fitsz_file]).fetchone()[0]
 
     m = markup_module.Markup()
-    zip_path = m.zipit(str(recid), fmt='fz')
-
-    with zipfile.ZipFile(zip_path) as zf:
+    with _zipped(m, str(recid), fmt='fz') as zf:
         assert 'image.fits.fz' in zf.namelist()
 
 
@@ -202,9 +195,8 @@ def test_buildwhere_observer(m):
     assert 'J. Smith' in m.get_params()
 
 
-def test_zipit_fitsz_decompressed_to_fits(fresh_db, tmp_path):
+def test_zipstream_fitsz_decompressed_to_fits(fresh_db, tmp_path):
     """fmt='fits' decompresses .fits.fz in memory and writes .fits into the ZIP."""
-    import io
     from astropy.io import fits as astrofits
 
     fitsz_file = str(tmp_path / 'image.fits.fz')
@@ -221,11 +213,360 @@ def test_zipit_fitsz_decompressed_to_fits(fresh_db, tmp_path):
     recid = cur.execute("SELECT id FROM fits WHERE path = ?", [fitsz_file]).fetchone()[0]
 
     m = markup_module.Markup()
-    zip_path = m.zipit(str(recid), fmt='fits')
-
-    with zipfile.ZipFile(zip_path) as zf:
+    with _zipped(m, str(recid), fmt='fits') as zf:
         names = zf.namelist()
         assert 'image.fits.fz' not in names
         assert 'image.fits' in names
         with astrofits.open(io.BytesIO(zf.read('image.fits'))) as hdul:
             assert len(hdul) > 0
+
+
+# ---------------------------------------------------------------------------
+# Threading
+# ---------------------------------------------------------------------------
+
+def test_threads_get_own_connection_and_query_state(fresh_db):
+    """One shared Markup instance gives each thread its own db and where_list."""
+    import threading
+
+    m = markup_module.Markup()
+    m.reset()
+    m.add_where('target = ?', ['M 51'])
+    seen = {}
+
+    def worker():
+        m.reset()
+        m.add_where('target = ?', ['M 101'])
+        seen['db'] = m.db
+        seen['params'] = m.get_params()
+
+    t = threading.Thread(target=worker)
+    t.start()
+    t.join()
+    assert seen['db'] is not m.db
+    assert seen['params'] == ['M 101']
+    assert m.get_params() == ['M 51']
+
+
+# ---------------------------------------------------------------------------
+# Cached stats
+# ---------------------------------------------------------------------------
+
+def _stats_rec(**overrides):
+    rec = dict(
+        target='M 51', object='NGC 5194', date='2024-06-01',
+        timestamp='2024-06-01T04:30:00', filter='Clear', binning='2x2',
+        exposure=300.0, x=200, y=100, path='/t/a.fits',
+        preview='/t/a.png', thumbnail='/t/a-thumb.png', imagetype='tgt',
+    )
+    rec.update(overrides)
+    return rec
+
+
+def test_stats_cached_until_database_changes(fresh_db):
+    m = markup_module.Markup()
+    fresh_db.insert(_stats_rec())
+    with patch.object(m, 'fetchStats', wraps=m.fetchStats) as fetch:
+        m.reset()
+        m.reset()
+        assert fetch.call_count == 1
+        assert m.total_rows == 1
+        fresh_db.insert(_stats_rec(path='/t/b.fits.fz', imagetype='cal', target='Dark Frame'))
+        m.reset()
+        assert fetch.call_count == 2
+    assert (m.total_rows, m.total_cals, m.total_tgts, m.distinct_tgts) == (2, 1, 1, 1)
+    assert m.has_any_compressed is True
+
+
+def test_filtered_stats_single_query(fresh_db):
+    fresh_db.insert(_stats_rec())
+    fresh_db.insert(_stats_rec(path='/t/b.fits.fz', target='M 101'))
+    fresh_db.insert(_stats_rec(path='/t/c.fits', imagetype='cal', target='Dark Frame'))
+    m = markup_module.Markup()
+    stats = m.fetchStats("target LIKE ?", ['M %'])
+    assert stats == dict(total_rows=2, total_cals=0, total_tgts=2,
+                         distinct_tgts=2, has_compressed=True)
+    assert m.fetchStats("target = ?", ['nothing'])['total_rows'] == 0
+
+
+# ---------------------------------------------------------------------------
+# Page assembly
+# ---------------------------------------------------------------------------
+
+def _night(db, date, n):
+    for i in range(n):
+        db.insert(_stats_rec(date=date, path='/t/{}_{}.fits'.format(date, i),
+                             thumbnail='/t/{}_{}-thumb.png'.format(date, i)))
+
+
+def test_fetch_page_keeps_dates_whole(fresh_db, monkeypatch):
+    monkeypatch.setattr(markup_module.Markup, 'thumb_max', 4)
+    _night(fresh_db, '2024-06-03', 3)
+    _night(fresh_db, '2024-06-02', 3)
+    _night(fresh_db, '2024-06-01', 1)
+    m = markup_module.Markup()
+    m.reset()
+    page, nxt = m.fetchPage()
+    assert [(date, len(rows)) for date, rows in page] == [('2024-06-03', 3), ('2024-06-02', 3)]
+    assert nxt[0] == '2024-06-01'
+    page, nxt = m.fetchPage(*nxt)
+    assert [(date, len(rows)) for date, rows in page] == [('2024-06-01', 1)]
+    assert nxt is None
+
+
+def test_build_images_collections(fresh_db, monkeypatch):
+    monkeypatch.setattr(markup_module.Markup, 'thumb_max', 2)
+    _night(fresh_db, '2024-06-02', 2)
+    _night(fresh_db, '2024-06-01', 2)
+    m = markup_module.Markup()
+    with patch.object(m, 'fetchPage', wraps=m.fetchPage) as fetch:
+        images = m.build_images()
+    assert fetch.call_count == 1
+    assert images['next'] == '2024-06-01'
+    assert images['next_id'] == 3
+    [collection] = images['collections']
+    assert collection['id'] == 'rfo_2024-06-02'
+    assert [pic['id'] for pic in collection['pics']] == ['rfo_2024-06-02_001', 'rfo_2024-06-02_002']
+    assert collection['pics'][0]['src'] == '/t/2024-06-02_0-thumb.png'
+
+
+def test_keyset_paging_round_trip(fresh_db, monkeypatch):
+    monkeypatch.setattr(markup_module.Markup, 'thumb_max', 2)
+    for date in ['2024-06-04', '2024-06-03', '2024-06-02', '2024-06-01']:
+        _night(fresh_db, date, 2)
+    m = markup_module.Markup()
+
+    first = m.build_images()
+    assert 'prev' not in first
+    second = m.build_images(start=first['next'], start_id=first['next_id'])
+    assert second['collections'][0]['id'] == 'rfo_2024-06-03'
+    assert (second['prev'], second['prev_id']) == ('2024-06-04', first['collections'][0]['pics'][0]['recid'])
+    last = m.build_images(start='2024-06-01')
+    assert 'next' not in last
+    assert last['prev'] == '2024-06-02'
+    assert last['obsDates'] == ['2024-06-04', '2024-06-03', '2024-06-02', '2024-06-01']
+
+
+def test_start_older_than_archive_shows_first_page(fresh_db):
+    _night(fresh_db, '2024-06-01', 1)
+    m = markup_module.Markup()
+    images = m.build_images(start='2020-01-01')
+    assert images['collections'][0]['id'] == 'rfo_2024-06-01'
+    assert 'date' not in images
+
+
+def test_page_query_uses_date_id_index(fresh_db):
+    fresh_db.con.execute("CREATE INDEX fits_date_id_index ON fits (date DESC, id)")
+    m = markup_module.Markup()
+    m.reset()
+    sql = ("EXPLAIN QUERY PLAN SELECT id FROM fits WHERE date <= ? AND (date < ? OR id >= ?)"
+           " ORDER BY date DESC, id")
+    plan = ' '.join(row[-1] for row in m.db.con.execute(sql, ['2024-06-01', '2024-06-01', 0]))
+    assert 'fits_date_id_index' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def test_page_cursors_seek_rather_than_scan(fresh_db):
+    """fetchPage() and fetchPrev() must SEARCH the index from the cursor, not SCAN all of it."""
+    fresh_db.con.execute("CREATE INDEX fits_date_id_index ON fits (date DESC, id)")
+    _night(fresh_db, '2024-06-02', 2)
+    m = markup_module.Markup()
+    m.reset()
+    m.buildWhere_imgfilter('tgt')
+    statements = []
+    m.db.con.set_trace_callback(statements.append)
+    m.fetchPage('2024-06-02', 1)
+    m.fetchPrev('2024-06-01')
+    m.db.con.set_trace_callback(None)
+    queries = [sql for sql in statements if sql.startswith('SELECT') and 'ORDER BY date' in sql]
+    assert len(queries) == 2
+    for sql in queries:
+        plan = ' '.join(row[-1] for row in m.db.con.execute("EXPLAIN QUERY PLAN " + sql))
+        assert 'SEARCH fits USING' in plan and 'fits_date_id_index (date' in plan, plan
+        assert 'SCAN' not in plan, plan
+
+
+# ---------------------------------------------------------------------------
+# Target autocomplete
+# ---------------------------------------------------------------------------
+
+def test_target_suggestions_include_aliases(fresh_catalog_db):
+    fresh_catalog_db.insert(_stats_rec(target='M 51'))
+    fresh_catalog_db.insert(_stats_rec(target='NGC 7000', path='/t/b.fits'))
+    cur = fresh_catalog_db.con.cursor()
+    cur.executemany("INSERT INTO catalog_by_target (target, id, cname) VALUES (?,?,?)", [
+        ('NGC 5194', 1, 'M 51'), ('NGC 5195', 2, 'NGC 5195'), ('ngc 7000', 3, 'NGC 7000')])
+    fresh_catalog_db.con.commit()
+    m = markup_module.Markup()
+    assert m.fetchTargetSuggestions('ngc') == [
+        {'label': 'NGC 5194 (M 51)', 'value': 'M 51'},
+        {'label': 'NGC 7000', 'value': 'NGC 7000'},
+        {'label': 'ngc 7000 (NGC 7000)', 'value': 'NGC 7000'},
+    ]
+    assert m.fetchTargetSuggestions('m 5') == [{'label': 'M 51', 'value': 'M 51'}]
+    assert m.fetchTargetSuggestions('') == []
+
+
+def test_target_suggestions_use_nocase_index(fresh_db):
+    fresh_db.con.execute("CREATE INDEX fits_target_nocase_index ON fits (target COLLATE NOCASE)")
+    sql = ("EXPLAIN QUERY PLAN SELECT DISTINCT target FROM fits"
+           " WHERE target >= ? COLLATE NOCASE AND target < ? COLLATE NOCASE")
+    plan = ' '.join(row[-1] for row in fresh_db.con.execute(sql, ['m', 'm\U0010ffff']))
+    assert 'fits_target_nocase_index' in plan
+
+
+def test_fuzzy_target_uses_search_index(fresh_catalog_db):
+    fresh_catalog_db.insert(_stats_rec(target='M 51', object='NGC 5194'))
+    fresh_catalog_db.insert(_stats_rec(target='M 101', object='Pinwheel', path='/t/b.fits'))
+    fresh_catalog_db.createSearch()
+    m = markup_module.Markup()
+    m.reset()
+    m.buildWhere_target('5194')
+    assert m.get_where() == 'target IN (?)'
+    assert m.get_params() == ['M 51']
+    m.reset()
+    m.buildWhere_target('pinwh')
+    assert m.get_params() == ['M 101']
+    m.reset()
+    m.buildWhere_target('no such thing')
+    assert m.fetchStats(m.get_where(), m.get_params())['total_rows'] == 0
+
+
+# ---------------------------------------------------------------------------
+# Streaming zip
+# ---------------------------------------------------------------------------
+
+def test_zipstream_yields_members_as_it_goes(fresh_db, tmp_path):
+    import io
+    import zlib
+    for name in ['a', 'b']:
+        path = str(tmp_path / (name + '.fits'))
+        make_fits_file(path)
+        fresh_db.insert(_stats_rec(path=path))
+    m = markup_module.Markup()
+    stream = m.zipstream('1,2')
+    first = next(stream)
+    assert first.startswith(b'PK\x03\x04')
+    chunks = [first] + list(stream)
+    assert len(chunks) == 3  # a member at a time, then the central directory
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zf:
+        assert zf.namelist() == ['a.fits', 'b.fits']
+        assert zf.testzip() is None
+        data = open(str(tmp_path / 'a.fits'), 'rb').read()
+        assert zf.read('a.fits') == data
+        info = zf.getinfo('a.fits')
+        assert info.compress_type == zipfile.ZIP_DEFLATED
+        level1 = zlib.compressobj(1, zlib.DEFLATED, -15)
+        assert info.compress_size == len(level1.compress(data) + level1.flush())
+
+
+def test_zipstream_parallel_decompression_matches_serial(fresh_db, tmp_path, monkeypatch):
+    import io
+    names = ['c', 'a', 'b']
+    for name in names:
+        path = str(tmp_path / (name + '.fits.fz'))
+        make_fitsz_file(path, object_name=name)
+        fresh_db.insert(_stats_rec(path=path))
+    fresh_db.insert(_stats_rec(path=str(tmp_path / 'plain.fits')))
+    make_fits_file(str(tmp_path / 'plain.fits'))
+
+    def members(workers):
+        monkeypatch.setattr(markup_module.Markup, 'zip_workers', workers)
+        data = b''.join(markup_module.Markup().zipstream('1,2,3,4', fmt='fits'))
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            return [(n, zf.read(n)) for n in zf.namelist()]
+
+    parallel = members(2)
+    assert [n for n, _ in parallel] == ['c.fits', 'a.fits', 'b.fits', 'plain.fits']
+    assert parallel == members(1)
+
+
+def test_zipstream_reuses_one_spawned_pool(fresh_db, tmp_path, monkeypatch):
+    for name in 'ab':
+        path = str(tmp_path / (name + '.fits.fz'))
+        make_fitsz_file(path, object_name=name)
+        fresh_db.insert(_stats_rec(path=path))
+    monkeypatch.setattr(markup_module.Markup, 'zip_workers', 2)
+    monkeypatch.setattr(markup_module.fitscache.FitsCache, 'get', lambda self, path: None)  # decompress every time
+    monkeypatch.setattr(markup_module, '_zip_pool', None)
+    exits = []
+    monkeypatch.setattr(markup_module.atexit, 'register', exits.append)
+    with patch('concurrent.futures.ProcessPoolExecutor', wraps=markup_module.concurrent.futures.ProcessPoolExecutor) as pools:
+        for _ in range(2):
+            data = b''.join(markup_module.Markup().zipstream('1,2', fmt='fits'))
+    assert pools.call_count == 1
+    assert pools.call_args.kwargs['mp_context'].get_start_method() == 'spawn'
+    assert exits == [markup_module.shutdownZipPool]
+    workers = list(markup_module._zip_pool._processes.values())
+    exits[0]()
+    assert markup_module._zip_pool is None
+    assert workers and not any(worker.is_alive() for worker in workers)
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.namelist() == ['a.fits', 'b.fits']
+
+
+def test_zipstream_serves_repeat_fits_download_from_cache(fresh_db, tmp_path, monkeypatch):
+    import io
+    import fitscache
+    path = str(tmp_path / 'a.fits.fz')
+    make_fitsz_file(path)
+    fresh_db.insert(_stats_rec(path=path))
+    monkeypatch.setattr(fitscache.FitsCache, 'cachedir', str(tmp_path / 'cache'))
+    m = markup_module.Markup()
+
+    first = b''.join(m.zipstream('1', fmt='fits'))
+    with patch('markup.decompressFits', side_effect=AssertionError('decompressed again')):
+        second = b''.join(m.zipstream('1', fmt='fits'))
+    with zipfile.ZipFile(io.BytesIO(first)) as a, zipfile.ZipFile(io.BytesIO(second)) as b:
+        assert a.read('a.fits') == b.read('a.fits')
+
+
+def test_build_images_uses_sprite_coordinates(fresh_db):
+    _night(fresh_db, '2024-06-01', 2)
+    fresh_db.con.execute("UPDATE fits SET sprite = '/home/nas/Eagle/sprites/s.png', sprite_x = 128,"
+                         " sprite_y = 0, sprite_w = 120, sprite_h = 80 WHERE id = 2")
+    fresh_db.con.commit()
+    m = markup_module.Markup()
+    [collection] = m.build_images()['collections']
+    plain, sprited = collection['pics']
+    assert 'sprite' not in plain
+    assert plain['src'] == '/t/2024-06-01_0-thumb.png'
+    assert sprited['sprite'] == 'Eagle/sprites/s.png'
+    assert (sprited['sprite_x'], sprited['sprite_y'], sprited['sprite_w'], sprited['sprite_h']) == (128, 0, 120, 80)
+
+
+def _positioned(db, name, ra, dec):
+    db.insert(_stats_rec(target=name, path='/t/{}.fits'.format(name), thumbnail='/t/{}-thumb.png'.format(name), ra=ra, dec=dec))
+
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_cone_search_across_ra_zero(fresh_db, indexed):
+    if (indexed):
+        fresh_db.createRadec()
+    _positioned(fresh_db, 'east', 0.2, 0.1)
+    _positioned(fresh_db, 'west', 359.8, -0.1)
+    _positioned(fresh_db, 'corner', 359.7, 0.45)   # inside the box, outside the cone
+    _positioned(fresh_db, 'far', 180.0, 0.0)
+    fresh_db.insert(_stats_rec(target='nowhere', path='/t/nowhere.fits'))
+    m = markup_module.Markup()
+    m.reset()
+    assert m.buildWhere_cone('0h', '0', '0.5') == (0.0, 0.0, 0.5)
+    assert ('fits_radec' in m.get_where()) == indexed
+    rows = fresh_db.con.execute("SELECT target FROM fits WHERE " + m.get_where() + " ORDER BY target",
+                                m.get_params()).fetchall()
+    assert rows == [('east',), ('west',)]
+
+
+def test_cone_search_rejects_bad_coordinates(m):
+    assert m.buildWhere_cone('north', '+10', None) is None
+    assert m.buildWhere_cone('10', '+10', '-1') is None
+    assert m.get_where() == ''
+
+
+def test_build_images_cone(fresh_db):
+    _positioned(fresh_db, 'M 51', 202.47, 47.2)
+    _positioned(fresh_db, 'M 101', 210.8, 54.35)
+    images = markup_module.Markup().build_images(ra='13 29 52', dec='+47 11 43')
+    assert images['cone']['radius'] == markup_module.Markup.cone_radius
+    assert images['total_rows'] == 1
+    assert [pic['src'] for c in images['collections'] for pic in c['pics']] == ['/t/M 51-thumb.png']
@@ -0,0 +1,182 @@
+"""Unit tests for pngrender.py"""
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+import pngrender
+from tests.conftest import make_fits_file, make_fitsz_file
+
+
+@pytest.fixture
+def pr():
+    return pngrender.PngRender()
+
+
+def _read_png(path):
+    """Decode an 8-bit greyscale, filter-0 png written by writePng()."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    pos, idat = 8, b''
+    while pos < len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        payload = data[pos + 8:pos + 8 + length]
+        if kind == b'IHDR':
+            width, height, depth, ctype = struct.unpack('>IIBB', payload[:10])
+        elif kind == b'IDAT':
+            idat += payload
+        pos += 12 + length
+    raw = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(height, width + 1)
+    assert depth == 8 and ctype == 0
+    return raw[:, 1:]
+
+
+# ---------------------------------------------------------------------------
+# writePng
+# ---------------------------------------------------------------------------
+
+def test_write_png_roundtrip(pr, tmp_path):
+    pixels = np.arange(60, dtype=np.uint8).reshape(6, 10)
+    path = str(tmp_path / 'out.png')
+    pr.writePng(path, pixels)
+    assert np.array_equal(_read_png(path), pixels)
+
+
+# ---------------------------------------------------------------------------
+# levels / stretch / shrink
+# ---------------------------------------------------------------------------
+
+def test_levels_constant_image_does_not_divide_by_zero(pr):
+    black, white = pr.levels(np.zeros((10, 10), dtype=np.float32))
+    assert white > black
+
+
+def test_stretch_clips_and_flips(pr):
+    data = np.array([[0.0, 50.0], [100.0, 200.0]], dtype=np.float32)
+    pixels = pr.stretch(data, 0.0, 100.0)
+    assert pixels.dtype == np.uint8
+    # FITS row 0 is the bottom of the image, so it becomes the last png row
+    assert pixels.tolist() == [[255, 255], [0, 127]]
+
+
+def test_stretch_handles_nan(pr):
+    data = np.array([[np.nan, 1.0]], dtype=np.float32)
+    assert pr.stretch(data, 0.0, 1.0).tolist() == [[0, 255]]
+
+
+def test_shrink_block_average(pr):
+    data = np.arange(16, dtype=np.float32).reshape(4, 4)
+    small = pr.shrink(data, 2)
+    assert small.tolist() == [[2.5, 4.5], [10.5, 12.5]]
+
+
+def test_shrink_truncates_partial_blocks(pr):
+    assert pr.shrink(np.ones((100, 200), dtype=np.float32), 3).shape == (33, 66)
+
+
+# ---------------------------------------------------------------------------
+# render
+# ---------------------------------------------------------------------------
+
+def test_render_fits(pr, tmp_path):
+    src = str(tmp_path / 'img.fits')
+    make_fits_file(src)
+    preview, thumb = str(tmp_path / 'img.png'), str(tmp_path / 'img-thumb.png')
+    pr.render(src, preview=preview, thumbnail=thumb, scaling=2)
+    assert _read_png(preview).shape == (100, 200)
+    assert _read_png(thumb).shape == (50, 100)
+
+
+def test_render_fitsz(pr, tmp_path):
+    src = str(tmp_path / 'img.fits.fz')
+    make_fitsz_file(src)
+    thumb = str(tmp_path / 'img-thumb.png')
+    pr.render(src, thumbnail=thumb, scaling=4)
+    assert _read_png(thumb).shape == (25, 50)
+
+
+# ---------------------------------------------------------------------------
+# readPng
+# ---------------------------------------------------------------------------
+
+def _filtered_png(path, pixels, kind, channels=1):
+    """Write `pixels` (h x w*channels) as an 8-bit png with every row using filter `kind`."""
+    height, stride = pixels.shape
+    raw = b''
+    prior = np.zeros(stride, dtype=np.int32)
+    for y in range(height):
+        row = pixels[y].astype(np.int32)
+        out = np.zeros(stride, dtype=np.int32)
+        for x in range(stride):
+            left = row[x - channels] if x >= channels else 0
+            upleft = prior[x - channels] if x >= channels else 0
+            up = prior[x]
+            if kind == 0:
+                predictor = 0
+            elif kind == 1:
+                predictor = left
+            elif kind == 2:
+                predictor = up
+            elif kind == 3:
+                predictor = (left + up) >> 1
+            else:
+                p = left + up - upleft
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - upleft)
+                predictor = left if pa <= pb and pa <= pc else (up if pb <= pc else upleft)
+            out[x] = (row[x] - predictor) & 0xff
+        raw += bytes([kind]) + bytes(out.astype(np.uint8))
+        prior = row
+    ctype = {1: 0, 3: 2}[channels]
+    chunk = pngrender.PngRender._chunk
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', stride // channels, height, 8, ctype, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw)))
+        f.write(chunk(b'IEND', b''))
+
+
+def test_read_png_roundtrip(pr, tmp_path):
+    pixels = (np.arange(70).reshape(7, 10) * 37 % 256).astype(np.uint8)
+    path = str(tmp_path / 'r.png')
+    pr.writePng(path, pixels)
+    assert np.array_equal(pr.readPng(path), pixels)
+
+
+@pytest.mark.parametrize('kind', [0, 1, 2, 3, 4])
+def test_read_png_all_filters(pr, tmp_path, kind):
+    pixels = (np.arange(48).reshape(6, 8) * 53 % 256).astype(np.uint8)
+    path = str(tmp_path / 'f.png')
+    _filtered_png(path, pixels, kind)
+    assert np.array_equal(pr.readPng(path), pixels)
+
+
+def test_read_png_rgb_to_grey(pr, tmp_path):
+    rgb = np.array([[30, 60, 90, 0, 0, 3]], dtype=np.uint8)
+    path = str(tmp_path / 'rgb.png')
+    _filtered_png(path, rgb, 4, channels=3)
+    assert pr.readPng(path).tolist() == [[60, 1]]
+
+
+def test_read_png_rejects_16_bit(pr, tmp_path):
+    path = str(tmp_path / 'deep.png')
+    chunk = pngrender.PngRender._chunk
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 16, 0, 0, 0, 0)))
+    with pytest.raises(ValueError):
+        pr.readPng(path)
+
+
+def test_render_tiles_match_preview(pr, tmp_path):
+    import tiles
+    src = str(tmp_path / 'img.fits')
+    make_fits_file(src)
+    preview, tilesfile = str(tmp_path / 'img.png'), str(tmp_path / 'img.tiles')
+    pr.render(src, preview=preview, tiles=tilesfile)
+    info = tiles.TilePyramid().info(tilesfile)
+    assert (info['width'], info['height']) == (200, 100)
+    tile = str(tmp_path / 'tile.png')
+    with open(tile, 'wb') as f:
+        f.write(tiles.TilePyramid().read(tilesfile, 0, 0, 0))
+    assert np.array_equal(pr.readPng(tile), pr.readPng(preview))
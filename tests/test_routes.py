@@ -1,4 +1,5 @@
 """Integration tests for all six Flask routes in __init__.py"""
+import io
 import os
 import zipfile
 
@@ -70,6 +71,43 @@ def test_search_unknown_target_flashes_message(client):
     assert b'not found' in r.data
 
 
+def test_search_cone_keeps_coordinates_in_paging_forms(client):
+    r = client.get('/search?ra=13+29+52&dec=%2B47+11+43&radius=0.25')
+    assert r.status_code == 200
+    assert b'name="radius" value="0.25"' in r.data
+
+
+def test_search_cone_bad_coordinates_flashes_message(client):
+    r = client.get('/search?ra=north&dec=up')
+    assert r.status_code == 200
+    assert b'Cannot search around' in r.data
+
+
+# ---------------------------------------------------------------------------
+# Route: /api/targets
+# ---------------------------------------------------------------------------
+
+def test_api_targets_prefix(client, seeded):
+    r = client.get('/api/targets?prefix=m%205')
+    assert r.status_code == 200
+    assert {'label': 'M 51', 'value': 'M 51'} in r.get_json()
+    assert 'max-age' in r.headers['Cache-Control']
+
+
+def test_api_targets_etag_revalidates(client, seeded):
+    r = client.get('/api/targets?prefix=M')
+    r2 = client.get('/api/targets?prefix=M', headers={'If-None-Match': r.headers['ETag']})
+    assert r2.status_code == 304
+
+
+def test_api_targets_empty_prefix(client):
+    assert client.get('/api/targets').get_json() == []
+
+
+def test_home_does_not_inline_target_list(client, seeded):
+    assert b'<datalist' not in client.get('/').data
+
+
 # ---------------------------------------------------------------------------
 # Route: /deets
 # ---------------------------------------------------------------------------
@@ -81,6 +119,19 @@ def test_deets_returns_html_fragment(client, seeded):
     assert b'M 51' in r.data
 
 
+def test_api_catalog(client, _session_db):
+    cur = _session_db.con.cursor()
+    cur.execute("INSERT INTO catalog (object, other, type, con) VALUES ('NGC 6960', 'Veil Nebula', 'SNREM', 'CYG')")
+    cur.execute("INSERT INTO catalog_by_target (target, id, cname) VALUES ('Veil Nebula', ?, 'NGC 6960')", [cur.lastrowid])
+    _session_db.con.commit()
+    r = client.get('/api/catalog?q=veil&mode=prefix')
+    assert r.status_code == 200
+    [veil] = r.get_json()
+    assert (veil['object'], veil['cname'], veil['con']) == ('NGC 6960', 'NGC 6960', 'CYG')
+    assert client.get('/api/catalog?con=cyg').get_json()[0]['object'] == 'NGC 6960'
+    assert client.get('/api/catalog?q=veil&mode=bogus').status_code == 400
+
+
 # ---------------------------------------------------------------------------
 # Route: /download
 # ---------------------------------------------------------------------------
@@ -91,6 +142,13 @@ def test_download_returns_zip(client, seeded):
     assert r.content_type == 'application/zip'
 
 
+def test_download_streams_attachment(client, seeded):
+    r = client.post('/download', data={'recids': str(seeded['recid'])})
+    assert r.is_streamed
+    assert r.headers['Content-Disposition'].startswith('attachment; filename=fits_')
+    assert 'Content-Length' not in r.headers
+
+
 def test_download_zip_contains_fits_file(client, seeded):
     r = client.post('/download', data={'recids': str(seeded['recid'])})
     import io
@@ -169,6 +227,76 @@ def test_eagle_path_serves_file(client):
     assert r.status_code == 200
 
 
+@pytest.fixture
+def served_tree(tmp_path, app, monkeypatch):
+    """A fits/ tree with a preview and a FITS file under a temporary app root."""
+    (tmp_path / 'fits' / '2024-06-01').mkdir(parents=True)
+    (tmp_path / 'fits' / '2024-06-01' / 'M51.png').write_bytes(b'\x89PNG fake')
+    (tmp_path / 'fits' / '2024-06-01' / 'M51.fits').write_bytes(b'SIMPLE  =T')
+    monkeypatch.setattr(app, 'root_path', str(tmp_path))
+    return tmp_path
+
+
+def test_fits_png_is_immutable_with_etag(client, served_tree):
+    r = client.get('/fits/2024-06-01/M51.png')
+    assert r.status_code == 200
+    assert r.data == b'\x89PNG fake'
+    assert r.cache_control.immutable
+    assert r.cache_control.max_age == 365 * 24 * 3600
+    etag = r.headers['ETag']
+    assert not etag.startswith('W/')
+
+    r = client.get('/fits/2024-06-01/M51.png', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+
+
+def test_fits_non_png_not_immutable(client, served_tree):
+    r = client.get('/fits/2024-06-01/M51.fits')
+    assert r.status_code == 200
+    assert not r.cache_control.immutable
+
+
+def test_fits_path_traversal_rejected(client, served_tree):
+    assert client.get('/fits/..%2f..%2fetc%2fpasswd').status_code == 404
+
+
+def test_fits_xsendfile_offload(client, app, served_tree, monkeypatch):
+    import __init__ as app_module
+    monkeypatch.setattr(app_module, 'sendfile', 'xsendfile')
+    r = client.get('/fits/2024-06-01/M51.png')
+    assert r.status_code == 200
+    assert r.headers['X-Sendfile'] == str(served_tree / 'fits' / '2024-06-01' / 'M51.png')
+    assert r.data == b''
+    assert r.cache_control.immutable
+    r = client.get('/fits/2024-06-01/M51.png', headers={'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+    assert client.get('/fits/2024-06-01/missing.png').status_code == 404
+
+
+def test_favicon_not_offloaded_in_xsendfile_mode(client, monkeypatch):
+    import __init__ as app_module
+    monkeypatch.setattr(app_module, 'sendfile', 'xsendfile')
+    r = client.get('/favicon.ico')
+    assert r.status_code == 200
+    assert 'X-Sendfile' not in r.headers
+    assert r.data.startswith(b'\x89PNG')
+
+
+def test_fits_accel_offload(client, served_tree, monkeypatch):
+    import __init__ as app_module
+    monkeypatch.setattr(app_module, 'sendfile', 'accel')
+    r = client.get('/fits/2024-06-01/M51.png')
+    assert r.status_code == 200
+    assert r.headers['X-Accel-Redirect'] == '/protected/fits/2024-06-01/M51.png'
+    assert r.data == b''
+    assert r.cache_control.immutable
+    etag = r.headers['ETag']
+
+    r = client.get('/fits/2024-06-01/M51.png', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert client.get('/fits/2024-06-01/missing.png').status_code == 404
+
+
 # ---------------------------------------------------------------------------
 # Round-trip: ingest → query → render
 # ---------------------------------------------------------------------------
@@ -178,3 +306,100 @@ def test_roundtrip_target_appears_in_html(client, seeded):
     r = client.post('/', data={'target': 'M 51', 'imgfilter': 'tgt'})
     assert r.status_code == 200
     assert b'M 51' in r.data
+
+
+# ---------------------------------------------------------------------------
+# Route: /download for large selections, /download/status, /download/fetch
+# ---------------------------------------------------------------------------
+
+def test_download_large_selection_becomes_job(client, seeded, monkeypatch):
+    import io
+    import re
+    import time
+    import __init__ as _app_module
+    monkeypatch.setattr(_app_module.jobs, 'max_stream_files', 0)
+
+    r = client.post('/download', data={'recids': str(seeded['recid'])})
+    assert r.status_code == 200
+    assert r.content_type.startswith('text/html')
+    job = re.search(rb"pollDownload\('([0-9a-f]{32})'\)", r.data).group(1).decode()
+
+    for _ in range(100):
+        status = client.get('/download/status/' + job).get_json()
+        if status['state'] in ('done', 'error'):
+            break
+        time.sleep(0.05)
+    assert status['state'] == 'done'
+    assert status['files_done'] == status['files_total'] == 1
+
+    r = client.get('/download/fetch/' + job)
+    assert r.status_code == 200
+    assert r.headers['Content-Disposition'].startswith('attachment; filename=fits_')
+    with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+        assert 'M51_300s.fits' in zf.namelist()
+
+
+def test_download_fetch_not_offloaded_in_xsendfile_mode(client, seeded, monkeypatch):
+    import time
+    import __init__ as _app_module
+    monkeypatch.setattr(_app_module, 'sendfile', 'xsendfile')
+    job = _app_module.jobs.submit(str(seeded['recid']), 'fz', 'fits_test.zip')
+    for _ in range(100):
+        if _app_module.jobs.status(job)['state'] in ('done', 'error'):
+            break
+        time.sleep(0.05)
+    r = client.get('/download/fetch/' + job)
+    assert r.status_code == 200
+    assert 'X-Sendfile' not in r.headers  # /tmp isn't in Apache's XSendFilePath
+    with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+        assert 'M51_300s.fits' in zf.namelist()
+
+
+def test_download_status_unknown_job_404(client):
+    assert client.get('/download/status/' + '0' * 32).status_code == 404
+    assert client.get('/download/status/nonsense').status_code == 404
+    assert client.get('/download/fetch/' + '0' * 32).status_code == 404
+
+
+# ---------------------------------------------------------------------------
+# Route: /tiles/<recid>/info  and  /tiles/<recid>/<z>/<x>/<y>
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def seeded_tiles(seeded):
+    import numpy as np
+    import tiles
+    filename = seeded['fits_file'].replace('.fits', '.tiles')
+    tiles.TilePyramid().write(filename, np.full((300, 600), 7, dtype=np.uint8))
+    yield seeded
+    os.unlink(filename)
+
+
+def test_tiles_info(client, seeded_tiles):
+    r = client.get('/tiles/{}/info'.format(seeded_tiles['recid']))
+    assert r.status_code == 200
+    info = r.get_json()
+    assert info['levels'] == [[150, 75], [300, 150], [600, 300]]
+    assert info['tile'] == 256
+    assert info['version']
+
+
+def test_tiles_tile_is_png(client, seeded_tiles):
+    info = client.get('/tiles/{}/info'.format(seeded_tiles['recid'])).get_json()
+    r = client.get('/tiles/{}/2/2/1?v={}'.format(seeded_tiles['recid'], info['version']))
+    assert r.status_code == 200
+    assert r.content_type == 'image/png'
+    assert r.data.startswith(b'\x89PNG')
+    assert r.cache_control.immutable
+    r = client.get('/tiles/{}/2/2/1?v={}'.format(seeded_tiles['recid'], info['version']),
+                   headers={'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+
+
+def test_tiles_missing(client, seeded, seeded_tiles):
+    assert client.get('/tiles/{}/2/3/0'.format(seeded_tiles['recid'])).status_code == 404
+    assert client.get('/tiles/999999/info').status_code == 404
+
+
+def test_tiles_info_without_pyramid_404(client, seeded):
+    assert client.get('/tiles/{}/info'.format(seeded['recid'])).status_code == 404
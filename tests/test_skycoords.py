@@ -0,0 +1,78 @@
+"""Unit tests for skycoords.py"""
+import numpy as np
+import pytest
+
+import skycoords
+
+
+def test_parse_ra_sexagesimal_hours():
+    assert skycoords.parseRA('05 35 17.3') == pytest.approx(83.822083, abs=1e-6)
+    assert skycoords.parseRA('05:35:17.3') == pytest.approx(83.822083, abs=1e-6)
+    assert skycoords.parseRA('5h35m17.3s') == pytest.approx(83.822083, abs=1e-6)
+    assert skycoords.parseRA('13 29.9') == pytest.approx(202.475)
+
+
+def test_parse_ra_decimal_degrees():
+    assert skycoords.parseRA('202.47') == pytest.approx(202.47)
+    assert skycoords.parseRA(202.47) == pytest.approx(202.47)
+    assert skycoords.parseRA(360) == 0.0
+
+
+def test_parse_dec():
+    assert skycoords.parseDec('-05 23 28') == pytest.approx(-5.391111, abs=1e-6)
+    assert skycoords.parseDec('+47 12') == pytest.approx(47.2)
+    assert skycoords.parseDec('-00 30 00') == pytest.approx(-0.5)
+    assert skycoords.parseDec(47.2) == pytest.approx(47.2)
+
+
+@pytest.mark.parametrize('ra', ['', 'north', '25h', '400', '1 2 3 4'])
+def test_parse_ra_rejects_garbage(ra):
+    with pytest.raises(ValueError):
+        skycoords.parseRA(ra)
+
+
+def test_parse_dec_rejects_out_of_range():
+    with pytest.raises(ValueError):
+        skycoords.parseDec('+91 00')
+
+
+def test_from_headers_prefers_objctra():
+    headers = {'OBJCTRA': '13 29 52.7', 'OBJCTDEC': '+47 11 43', 'RA': 10.0, 'DEC': 10.0}
+    ra, dec = skycoords.fromHeaders(headers)
+    assert ra == pytest.approx(202.4696, abs=1e-4)
+    assert dec == pytest.approx(47.1953, abs=1e-4)
+    assert skycoords.fromHeaders({'RA': 10.0, 'DEC': -10.0}) == (10.0, -10.0)
+    assert skycoords.fromHeaders({'OBJECT': 'M 51'}) is None
+    assert skycoords.fromHeaders({'OBJCTRA': 'bad', 'OBJCTDEC': 'bad'}) is None
+
+
+def test_angsep():
+    assert skycoords.angsep(0.0, 0.0, 0.0, 1.0) == pytest.approx(1.0)
+    assert skycoords.angsep(359.5, 0.0, 0.5, 0.0) == pytest.approx(1.0)
+    assert skycoords.angsep(0.0, 89.0, 180.0, 89.0) == pytest.approx(2.0)
+    assert skycoords.angsep(None, 0.0, 0.0, 0.0) is None
+
+
+def test_angsep_array_matches_scalar():
+    ras = np.array([0.5, 359.5, 10.0])
+    decs = np.array([0.0, 0.0, 45.0])
+    seps = skycoords.angsepArray(0.0, 0.0, ras, decs)
+    assert seps == pytest.approx([skycoords.angsep(0.0, 0.0, r, d) for r, d in zip(ras, decs)])
+
+
+def test_bounds_simple_box_covers_cone():
+    [(min_ra, max_ra, min_dec, max_dec)] = skycoords.bounds(180.0, 60.0, 1.0)
+    assert (min_dec, max_dec) == (59.0, 61.0)
+    assert max_ra - min_ra > 2.0  # widened by 1/cos(dec)
+    assert skycoords.angsep(180.0, 60.0, max_ra, 60.5) > 0.0
+
+
+def test_bounds_split_at_ra_zero():
+    boxes = skycoords.bounds(0.2, 0.0, 0.5)
+    assert len(boxes) == 2
+    assert (0.0, pytest.approx(0.7)) == boxes[0][:2]
+    assert (pytest.approx(359.7), 360.0) == boxes[1][:2]
+
+
+def test_bounds_over_pole_takes_all_ra():
+    assert skycoords.bounds(45.0, 89.8, 0.5) == [(0.0, 360.0, 89.3, 90.0)]
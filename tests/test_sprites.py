@@ -0,0 +1,147 @@
+"""Unit tests for sprites.py"""
+import os
+
+import numpy as np
+import pytest
+
+import pngrender
+import sprites
+from tests.conftest import _insert_fits_record
+
+
+@pytest.fixture
+def sheets(fresh_db, tmp_path):
+    return sprites.SpriteSheets(fresh_db, spritedir=str(tmp_path / 'sprites'))
+
+
+def _thumb(tmp_path, name, shape, value):
+    path = str(tmp_path / name)
+    pngrender.PngRender().writePng(path, np.full(shape, value, dtype=np.uint8))
+    return path
+
+
+def _sprite_rows(db):
+    return db.con.execute(
+        "SELECT id, sprite, sprite_x, sprite_y, sprite_w, sprite_h FROM fits ORDER BY id"
+    ).fetchall()
+
+
+def test_build_packs_thumbnails_and_records_offsets(sheets, fresh_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(sheets, 'columns', 2)
+    shapes = [(80, 120), (100, 120), (60, 90)]
+    for i, shape in enumerate(shapes):
+        _insert_fits_record(fresh_db, path='/t/{}.fits'.format(i), date='2024-06-01', filter='R',
+                            thumbnail=_thumb(tmp_path, '{}-thumb.png'.format(i), shape, 10 * (i + 1)))
+    assert sheets.build('2024-06-01', 'R')
+
+    rows = _sprite_rows(fresh_db)
+    sheet = rows[0][1]
+    assert os.path.basename(sheet).startswith('2024-06-01_R_')
+    assert all(row[1] == sheet for row in rows)
+    assert [row[2:] for row in rows] == [(0, 0, 120, 80), (128, 0, 120, 100), (0, 100, 90, 60)]
+
+    pixels = pngrender.PngRender().readPng(sheet)
+    assert pixels.shape == (160, 256)
+    for i, (recid, _, x, y, w, h) in enumerate(rows):
+        assert (pixels[y:y + h, x:x + w] == 10 * (i + 1)).all()
+
+
+def test_rebuild_is_versioned_and_prunes_old_sheet(sheets, fresh_db, tmp_path):
+    _insert_fits_record(fresh_db, path='/t/a.fits', date='2024-06-01', filter='R',
+                        thumbnail=_thumb(tmp_path, 'a-thumb.png', (10, 10), 1))
+    assert sheets.build('2024-06-01', 'R')
+    first = _sprite_rows(fresh_db)[0][1]
+    assert not sheets.build('2024-06-01', 'R')  # nothing changed
+    assert _sprite_rows(fresh_db)[0][1] == first
+
+    _insert_fits_record(fresh_db, path='/t/b.fits', date='2024-06-01', filter='R',
+                        thumbnail=_thumb(tmp_path, 'b-thumb.png', (10, 10), 2))
+    assert sheets.update([('2024-06-01', 'R')]) == 1
+    second = _sprite_rows(fresh_db)[0][1]
+    assert second != first
+    assert os.path.exists(second)
+    assert not os.path.exists(first)
+
+
+def test_groups_are_separate_sheets(sheets, fresh_db, tmp_path):
+    _insert_fits_record(fresh_db, path='/t/a.fits', date='2024-06-01', filter='R',
+                        thumbnail=_thumb(tmp_path, 'a-thumb.png', (10, 10), 1))
+    _insert_fits_record(fresh_db, path='/t/b.fits', date='2024-06-01', filter=None,
+                        thumbnail=_thumb(tmp_path, 'b-thumb.png', (10, 10), 2))
+    assert sheets.groups() == [('2024-06-01', None), ('2024-06-01', 'R')]
+    assert sheets.update(sheets.groups()) == 2
+    names = sorted(os.path.basename(row[1]) for row in _sprite_rows(fresh_db))
+    assert names[0].startswith('2024-06-01_R_') and names[1].startswith('2024-06-01_none_')
+
+
+def test_missing_thumbnail_left_out(sheets, fresh_db, tmp_path):
+    _insert_fits_record(fresh_db, path='/t/a.fits', date='2024-06-01', filter='R',
+                        thumbnail=_thumb(tmp_path, 'a-thumb.png', (10, 10), 1))
+    _insert_fits_record(fresh_db, path='/t/b.fits', date='2024-06-01', filter='R',
+                        thumbnail=str(tmp_path / 'gone-thumb.png'))
+    sheets.build('2024-06-01', 'R')
+    rows = _sprite_rows(fresh_db)
+    assert rows[0][1] is not None
+    assert rows[1][1:] == (None, None, None, None, None)
+
+
+def test_enabled_needs_sprite_columns(tmp_path, monkeypatch):
+    import fitsdb
+    monkeypatch.setattr(fitsdb.Fitsdb, 'dbfile', str(tmp_path / 'old.db'))
+    db = fitsdb.Fitsdb()
+    db.con.execute("CREATE TABLE fits (id INTEGER PRIMARY KEY, date TEXT, filter TEXT, thumbnail TEXT)")
+    assert not sprites.SpriteSheets(db).enabled()
+
+
+def test_new_thumbnails_are_appended_without_rereading_the_others(sheets, fresh_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(sheets, 'columns', 2)
+    _insert_fits_record(fresh_db, path='/t/0.fits', date='2024-06-01', filter='R',
+                        thumbnail=_thumb(tmp_path, '0-thumb.png', (80, 120), 10))
+    assert sheets.build('2024-06-01', 'R')
+    first = _sprite_rows(fresh_db)[0][1]
+
+    for i, shape in [(1, (100, 120)), (2, (60, 90))]:
+        _insert_fits_record(fresh_db, path='/t/{}.fits'.format(i), date='2024-06-01', filter='R',
+                            thumbnail=_thumb(tmp_path, '{}-thumb.png'.format(i), shape, 10 * (i + 1)))
+    read = []
+    readPng = pngrender.PngRender.readPng
+    monkeypatch.setattr(pngrender.PngRender, 'readPng', lambda self, f: read.append(f) or readPng(self, f))
+    assert sheets.build('2024-06-01', 'R')
+    assert read == [str(tmp_path / '1-thumb.png'), str(tmp_path / '2-thumb.png'), first]
+
+    # Same layout as packing all three at once
+    rows = _sprite_rows(fresh_db)
+    sheet = rows[0][1]
+    assert sheet != first and not os.path.exists(first)
+    assert all(row[1] == sheet for row in rows)
+    assert [row[2:] for row in rows] == [(0, 0, 120, 80), (128, 0, 120, 100), (0, 100, 90, 60)]
+    pixels = readPng(pngrender.PngRender(), sheet)
+    assert pixels.shape == (160, 256)
+    for i, (recid, _, x, y, w, h) in enumerate(rows):
+        assert (pixels[y:y + h, x:x + w] == 10 * (i + 1)).all()
+
+
+def test_rebuild_repacks_rethumbnailed_frames(sheets, fresh_db, tmp_path):
+    thumb = _thumb(tmp_path, 'a-thumb.png', (10, 10), 1)
+    _insert_fits_record(fresh_db, path='/t/a.fits', date='2024-06-01', filter='R', thumbnail=thumb)
+    assert sheets.build('2024-06-01', 'R')
+    first = _sprite_rows(fresh_db)[0][1]
+    pngrender.PngRender().writePng(thumb, np.full((10, 10), 7, dtype=np.uint8))
+    assert not sheets.build('2024-06-01', 'R')  # appending: nothing new
+    assert sheets.update([('2024-06-01', 'R')], rebuild=True) == 1
+    sheet = _sprite_rows(fresh_db)[0][1]
+    assert sheet != first
+    assert (pngrender.PngRender().readPng(sheet)[:10, :10] == 7).all()
+
+
+def test_missing_sheet_is_repacked(sheets, fresh_db, tmp_path):
+    _insert_fits_record(fresh_db, path='/t/a.fits', date='2024-06-01', filter='R',
+                        thumbnail=_thumb(tmp_path, 'a-thumb.png', (10, 10), 1))
+    assert sheets.build('2024-06-01', 'R')
+    os.unlink(_sprite_rows(fresh_db)[0][1])
+    _insert_fits_record(fresh_db, path='/t/b.fits', date='2024-06-01', filter='R',
+                        thumbnail=_thumb(tmp_path, 'b-thumb.png', (10, 10), 2))
+    assert sheets.build('2024-06-01', 'R')
+    rows = _sprite_rows(fresh_db)
+    assert os.path.exists(rows[0][1]) and rows[0][1] == rows[1][1]
+    assert [row[2:] for row in rows] == [(0, 0, 10, 10), (128, 0, 10, 10)]
@@ -0,0 +1,63 @@
+"""Unit tests for tiles.py"""
+import numpy as np
+import pytest
+
+import pngrender
+import tiles
+
+
+@pytest.fixture
+def pyramid():
+    return tiles.TilePyramid()
+
+
+def _decode(tmp_path, data):
+    path = str(tmp_path / 'tile.png')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return pngrender.PngRender().readPng(path)
+
+
+def test_levels_halve_until_one_tile(pyramid):
+    pixels = np.zeros((1000, 1500), dtype=np.uint8)
+    shapes = [level.shape for level in pyramid.levels(pixels)]
+    assert shapes == [(125, 188), (250, 375), (500, 750), (1000, 1500)]
+
+
+def test_small_image_is_one_level(pyramid):
+    assert [level.shape for level in pyramid.levels(np.zeros((100, 200), dtype=np.uint8))] == [(100, 200)]
+
+
+def test_levels_average_blocks(pyramid):
+    pixels = np.array([[0, 2, 4], [2, 4, 6]], dtype=np.uint8)
+    pyramid.tile = 2
+    small, full = pyramid.levels(pixels)
+    assert small.tolist() == [[2, 5]]  # odd column padded from the edge
+
+
+def test_write_then_read_tiles(pyramid, tmp_path):
+    pixels = (np.arange(600 * 300) % 251).astype(np.uint8).reshape(300, 600)
+    filename = str(tmp_path / 'frame.tiles')
+    pyramid.write(filename, pixels)
+
+    info = pyramid.info(filename)
+    assert info == {'width': 600, 'height': 300, 'tile': 256, 'levels': [[150, 75], [300, 150], [600, 300]]}
+
+    assert np.array_equal(_decode(tmp_path, pyramid.read(filename, 2, 0, 0)), pixels[:256, :256])
+    assert np.array_equal(_decode(tmp_path, pyramid.read(filename, 2, 2, 1)), pixels[256:, 512:])
+    assert _decode(tmp_path, pyramid.read(filename, 0, 0, 0)).shape == (75, 150)
+
+
+@pytest.mark.parametrize('z, x, y', [(3, 0, 0), (-1, 0, 0), (2, 3, 0), (2, 0, 2), (0, 1, 0)])
+def test_read_out_of_range_is_none(pyramid, tmp_path, z, x, y):
+    filename = str(tmp_path / 'frame.tiles')
+    pyramid.write(filename, np.zeros((300, 600), dtype=np.uint8))
+    assert pyramid.read(filename, z, x, y) is None
+
+
+def test_not_a_pyramid(pyramid, tmp_path):
+    filename = str(tmp_path / 'frame.png')
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+    with pytest.raises(ValueError):
+        pyramid.info(filename)
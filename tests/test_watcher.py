@@ -0,0 +1,67 @@
+"""Unit tests for watcher.py"""
+import os
+import time
+
+import pytest
+
+import watcher
+
+PATTERNS = ['*.fits', '*.fits.fz']
+
+
+def _write(path, data=b'x'):
+    with open(path, 'ab') as f:
+        f.write(data)
+
+
+def _wait(w, seconds=3.0):
+    """Call ready() until it returns something or `seconds` pass."""
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        found = w.ready(timeout=0.05)
+        if found:
+            return found
+    return []
+
+
+@pytest.fixture
+def fast(monkeypatch):
+    monkeypatch.setattr(watcher.Watcher, 'settle', 0.3)
+    monkeypatch.setattr(watcher.Watcher, 'interval', 0.1)
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_new_file_reported_once_settled(fresh_db, tmp_path, fast, inotify):
+    w = watcher.Watcher([str(tmp_path)], PATTERNS, fresh_db, inotify=inotify)
+    try:
+        if inotify and w.fd is None:
+            pytest.skip('inotify not available')
+        os.mkdir(str(tmp_path / 'night'))
+        path = str(tmp_path / 'night' / 'a.fits')
+        _write(path)
+        _write(str(tmp_path / 'night' / 'a.png'))
+        assert _wait(w) == [path]
+        assert _wait(w, 0.5) == []
+    finally:
+        w.close()
+
+
+def test_growing_file_not_reported(fresh_db, tmp_path, fast):
+    w = watcher.Watcher([str(tmp_path)], PATTERNS, fresh_db, inotify=False)
+    path = str(tmp_path / 'upload.fits')
+    deadline = time.time() + 1.0
+    while time.time() < deadline:
+        _write(path)
+        assert w.ready(timeout=0.05) == []
+        time.sleep(0.05)
+    assert _wait(w) == [path]
+
+
+def test_polling_saves_manifest_after_handover(fresh_db, tmp_path, fast):
+    w = watcher.Watcher([str(tmp_path)], PATTERNS, fresh_db, inotify=False)
+    path = str(tmp_path / 'a.fits')
+    _write(path)
+    assert _wait(w) == [path]
+    w.ready(timeout=0)
+    rows = fresh_db.con.execute("SELECT path FROM manifest").fetchall()
+    assert rows == [(path,)]
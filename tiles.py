@@ -0,0 +1,150 @@
+#
+# tiles.py -- multi-resolution tile pyramids for the preview pane
+#
+#   A full size preview png is several megabytes, but the preview pane only ever shows a
+#   window's worth of it.  Ingest also writes each frame as a pyramid of `tile` pixel png
+#   tiles, halving the resolution at each level until the whole frame fits in one tile,
+#   and the pane fetches just the tiles in view at the level it is showing.
+#
+#   All the tiles of a frame live in one `<stem>.tiles` file, so a frame is still one
+#   file on the NAS rather than hundreds:
+#
+#       magic 'IMGTILE1'
+#       width, height, tile, levels                 (>IIHH)
+#       width, height of each level, smallest first  (>II each)
+#       offset, length of each tile, by level then row then column  (>QI each)
+#       png data
+#
+#   python3 tiles.py [date...]    builds missing pyramids for the frames of `date`s (or all)
+#
+
+import argparse
+import logging
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+import fitsdb
+import pngrender
+
+class TilePyramid:
+
+    tile = 256   # Tile size in pixels
+
+    MAGIC = b'IMGTILE1'
+    HEADER = struct.Struct('>IIHH')
+    LEVEL = struct.Struct('>II')
+    ENTRY = struct.Struct('>QI')
+
+    def levels(self, pixels):
+        '''Return the levels of the pyramid of `pixels` (2-D uint8), smallest first.'''
+        levels = [ pixels ]
+        while (max(levels[-1].shape) > self.tile):
+            data = levels[-1]
+            if (data.shape[0] % 2 or data.shape[1] % 2):
+                data = np.pad(data, ((0, data.shape[0] % 2), (0, data.shape[1] % 2)), mode='edge')
+            rows, cols = data.shape[0] // 2, data.shape[1] // 2
+            half = data.reshape(rows, 2, cols, 2).mean(axis=(1, 3), dtype=np.float32)
+            levels.append(np.round(half).astype(np.uint8))
+        levels.reverse()
+        return(levels)
+
+    def grid(self, width, height, tile=None):
+        '''Return the (columns, rows) of `tile` pixel tiles covering a `width` x `height` level.'''
+        tile = tile or self.tile
+        return(-(-width // tile), -(-height // tile))
+
+    def write(self, filename, pixels):
+        '''Write the pyramid of `pixels` (2-D uint8, top row first) to `filename`.
+
+        Like PngRender.writePng(), it goes to a temp file that is then moved into place.'''
+        encoder = pngrender.PngRender()
+        levels = self.levels(pixels)
+        tiles = list()
+        for level in levels:
+            height, width = level.shape
+            cols, rows = self.grid(width, height)
+            for y in range(rows):
+                for x in range(cols):
+                    tiles.append(encoder.encodePng(level[y * self.tile:(y + 1) * self.tile, x * self.tile:(x + 1) * self.tile]))
+
+        offset = len(self.MAGIC) + self.HEADER.size + self.LEVEL.size * len(levels) + self.ENTRY.size * len(tiles)
+        fd, temp = tempfile.mkstemp(prefix='.imagelib_', suffix='.tiles', dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(self.MAGIC)
+                file.write(self.HEADER.pack(pixels.shape[1], pixels.shape[0], self.tile, len(levels)))
+                for level in levels:
+                    file.write(self.LEVEL.pack(level.shape[1], level.shape[0]))
+                for data in tiles:
+                    file.write(self.ENTRY.pack(offset, len(data)))
+                    offset += len(data)
+                for data in tiles:
+                    file.write(data)
+            os.chmod(temp, 0o644)
+            os.replace(temp, filename)
+        finally:
+            if os.path.exists(temp):
+                os.unlink(temp)
+
+    def _readHeader(self, file):
+        magic = file.read(len(self.MAGIC))
+        if (magic != self.MAGIC):
+            raise ValueError("not a tile pyramid")
+        width, height, tile, count = self.HEADER.unpack(file.read(self.HEADER.size))
+        levels = [ list(self.LEVEL.unpack(file.read(self.LEVEL.size))) for _ in range(count) ]
+        return(width, height, tile, levels)
+
+    def info(self, filename):
+        '''Return the geometry of the pyramid in `filename` as a dict (for /tiles/<recid>/info).'''
+        with open(filename, 'rb') as file:
+            width, height, tile, levels = self._readHeader(file)
+        return(dict(width=width, height=height, tile=tile, levels=levels))
+
+    def read(self, filename, z, x, y):
+        '''Return the png data of tile (`x`, `y`) of level `z` of `filename`, or None if there's no such tile.'''
+        with open(filename, 'rb') as file:
+            width, height, tile, levels = self._readHeader(file)
+            if (z < 0 or z >= len(levels)):
+                return(None)
+            index = 0
+            for level in range(z + 1):
+                cols, rows = self.grid(*levels[level], tile=tile)
+                if (level < z):
+                    index += cols * rows
+            if (x < 0 or x >= cols or y < 0 or y >= rows):
+                return(None)
+            index += y * cols + x
+            file.seek(len(self.MAGIC) + self.HEADER.size + self.LEVEL.size * len(levels) + self.ENTRY.size * index)
+            offset, length = self.ENTRY.unpack(file.read(self.ENTRY.size))
+            file.seek(offset)
+            return(file.read(length))
+
+
+if (__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser(description='Build preview tile pyramids for frames ingested without them.')
+    parser.add_argument('--debug', '-d', dest='debug', action='store_true', help='print diabolocal debugging dregs')
+    parser.add_argument('date', nargs='*', help='observing date (YYYY-MM-DD) to build (may be repeated; default: all)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    db = fitsdb.Fitsdb()
+    sql = "SELECT path, preview FROM fits WHERE preview LIKE '%.png'"
+    if (args.date):
+        sql += " AND date IN ({})".format(', '.join(['?'] * len(args.date)))
+    renderer = pngrender.PngRender()
+    count = 0
+    for path, preview in db.con.execute(sql, args.date).fetchall():
+        filename = preview[:-4] + '.tiles'
+        if (os.path.exists(filename)):
+            continue
+        try:
+            renderer.render(path, tiles=filename)  # From the FITS data, as ingest does
+            count += 1
+        except (OSError, ValueError) as e:
+            logging.warning("Cannot build {}: {}".format(filename, e))
+    print("Built {} tile pyramids".format(count))
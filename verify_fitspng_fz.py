@@ -8,6 +8,7 @@ Answers the open question in doc/plan.md section 3b:
   - Does fitspng accept a .fits.fz file renamed to .fits (the existing temp-rename workaround)?
   - Does astropy decompress to plain .fits before fitspng work as a fallback?
   - Is the fits_path_abs[:-5] extension stripping in fits2png() safe for .fits.fz paths?
+  - How do the in-process numpy renderer (pngrender.py) and fitspng compare in output and timing?
 
 Run from the imagelib directory with the virtualenv active:
     python3 verify_fitspng_fz.py
@@ -15,9 +16,11 @@ Run from the imagelib directory with the virtualenv active:
 
 import os
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
+import time
 
 import numpy as np
 from astropy.io import fits
@@ -129,7 +132,8 @@ def test_fitspng_direct(fitsz_path, tmpdir):
 
 # ---------------------------------------------------------------------------
 # Test 3: fitspng via temp rename workaround (copy .fits.fz -> temp_safe_image.fits)
-#         This mirrors what fits2png() does today.
+#         fits2png() now hands fitspng a symlink with this simple name in a private
+#         temp dir instead of renaming the original.
 # ---------------------------------------------------------------------------
 
 def test_fitspng_rename_workaround(fitsz_path, tmpdir):
@@ -193,6 +197,61 @@ def test_fitspng_after_decompress(fitsz_path, tmpdir):
         report("fitspng on decompressed .fits", SKIP, "fitspng not found in PATH")
 
 
+# ---------------------------------------------------------------------------
+# Test 6: numpy renderer vs fitspng -- output dimensions and timing
+#         fits2png() defaults to pngrender.PngRender; fitspng is still selectable
+#         with `fitsfiles.py --renderer fitspng`.
+# ---------------------------------------------------------------------------
+
+def png_size(path):
+    """Return (width, height) from a png's IHDR chunk."""
+    with open(path, 'rb') as f:
+        head = f.read(24)
+    return struct.unpack('>II', head[16:24])
+
+
+def test_renderer_comparison(fitsz_path, tmpdir):
+    print("\nTest 6: numpy renderer vs fitspng (preview + thumbnail)")
+    import pngrender
+
+    width = fits.getheader(fitsz_path, 1)['NAXIS1']
+    scaling = int(width / 128) + 1
+
+    np_preview = os.path.join(tmpdir, "numpy.png")
+    np_thumb   = os.path.join(tmpdir, "numpy-thumb.png")
+    t0 = time.perf_counter()
+    try:
+        pngrender.PngRender().render(fitsz_path, preview=np_preview, thumbnail=np_thumb, scaling=scaling)
+    except Exception as e:
+        report("numpy renderer", FAIL, str(e))
+        return
+    np_secs = time.perf_counter() - t0
+    report("numpy renderer", PASS, f"{np_secs * 1000:.1f} ms for preview + thumbnail")
+
+    fp_preview = os.path.join(tmpdir, "fitspng.png")
+    fp_thumb   = os.path.join(tmpdir, "fitspng-thumb.png")
+    t0 = time.perf_counter()
+    try:
+        subprocess.run(['fitspng', '-o', fp_preview, fitsz_path], capture_output=True, check=True)
+        subprocess.run(['fitspng', '-s', str(scaling), '-o', fp_thumb, fitsz_path], capture_output=True, check=True)
+    except FileNotFoundError:
+        report("fitspng renderer", SKIP, "fitspng not found in PATH")
+        return
+    except subprocess.CalledProcessError as e:
+        report("fitspng renderer", FAIL, f"rc={e.returncode}")
+        return
+    fp_secs = time.perf_counter() - t0
+    report("fitspng renderer", PASS, f"{fp_secs * 1000:.1f} ms for preview + thumbnail "
+           f"({fp_secs / np_secs:.1f}x numpy)")
+
+    for label, a, b in (("preview", np_preview, fp_preview), ("thumbnail", np_thumb, fp_thumb)):
+        if png_size(a) == png_size(b):
+            report(f"  {label} dimensions match", PASS, "{}x{}".format(*png_size(a)))
+        else:
+            report(f"  {label} dimensions match", FAIL,
+                   "numpy {}x{} vs fitspng {}x{}".format(*png_size(a), *png_size(b)))
+
+
 # ---------------------------------------------------------------------------
 # Test 5: Extension stripping safety check
 #         fits_path_abs[:-5] is the current code; show what it produces for .fits.fz
@@ -252,6 +311,7 @@ def main():
         test_fitspng_direct(fitsz_path, tmpdir)
         test_fitspng_rename_workaround(fitsz_path, tmpdir)
         test_fitspng_after_decompress(fitsz_path, tmpdir)
+        test_renderer_comparison(fitsz_path, tmpdir)
 
     test_extension_stripping()
 
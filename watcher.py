@@ -0,0 +1,183 @@
+#
+# watcher.py -- filesystem watcher for the resident ingest daemon (`fitsfiles.py watch`)
+#
+#   Uses Linux inotify (through ctypes; no extra packages) to hear about files as they
+#   land anywhere under the watched trees, and falls back to rescanning with the
+#   persistent manifest (manifest.py) every `interval` seconds where inotify isn't
+#   available.  Either way files are only handed over once their size and mtime have
+#   held still for `settle` seconds, so half-written SCP/rsync uploads are never ingested.
+#
+
+import ctypes
+import ctypes.util
+import fnmatch
+import logging
+import os
+import select
+import struct
+import time
+
+import manifest
+
+class Watcher:
+
+    settle = 5        # Seconds a file's size and mtime must be unchanged before it is ready
+    interval = 60     # Seconds between manifest rescans when polling
+
+    # inotify(7) constants
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    EVENT = struct.Struct('iIII')  # struct inotify_event: wd, mask, cookie, len (then name)
+
+    def __init__(self, paths, patterns, db, inotify=True):
+        self.paths = paths
+        self.patterns = patterns
+        self.manifest = manifest.Manifest(db)
+        self.pending = dict()   # path --> (size, mtime_ns) when last looked at, time it last changed
+        self.unsaved = False    # True if the manifest holds a rescan not yet saved
+        self.fd = None
+        self.wds = dict()       # inotify watch descriptor --> directory
+        if (inotify):
+            self._initInotify()
+        if (self.fd is None):
+            logging.warning("inotify unavailable; polling {} every {}s".format(', '.join(paths), self.interval))
+            self.next_scan = time.time() + self.interval
+        else:
+            self.next_scan = float('inf')  # only rescan if the event queue overflows
+
+    def _initInotify(self):
+        '''Set up inotify watches on every directory under self.paths; leave self.fd None on failure.'''
+        libname = ctypes.util.find_library('c')
+        try:
+            self.libc = ctypes.CDLL(libname, use_errno=True)
+            fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            logging.debug(">>> inotify_init1: {}".format(e))
+            return
+        if (fd < 0):
+            logging.debug(">>> inotify_init1: {}".format(os.strerror(ctypes.get_errno())))
+            return
+        self.fd = fd
+        try:
+            for path in self.paths:
+                self._watchTree(path, initial=True)
+        except OSError as e:
+            # Most likely ENOSPC: fs.inotify.max_user_watches is too low for the tree
+            logging.warning("Cannot watch {}: {}".format(path, e))
+            os.close(self.fd)
+            self.fd = None
+            self.wds = dict()
+
+    def _watchTree(self, top, initial=False):
+        '''Add a watch on `top` and every directory below it.
+
+        Outside the initial setup, files already present are queued: they may have landed
+        in a new directory before its watch was in place.'''
+        for dirpath, dirnames, filenames in os.walk(top):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.MASK)
+            if (wd < 0):
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), dirpath)
+            self.wds[wd] = dirpath
+            if (not initial):
+                for filename in filenames:
+                    self._queue(os.path.join(dirpath, filename))
+
+    def _matches(self, path):
+        name = os.path.basename(path)
+        return(any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns))
+
+    def _queue(self, path):
+        if (self._matches(path) and path not in self.pending):
+            self.pending[path] = (None, time.time())
+
+    def _readEvents(self, timeout):
+        '''Wait up to `timeout` seconds for inotify events and queue the files they name.'''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if (not readable):
+            return
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while (offset < len(buf)):
+            wd, mask, cookie, length = self.EVENT.unpack_from(buf, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if (mask & self.IN_Q_OVERFLOW):
+                logging.warning("inotify queue overflowed; rescanning")
+                self.next_scan = 0
+                continue
+            if (mask & self.IN_IGNORED):
+                self.wds.pop(wd, None)  # directory was removed
+                continue
+            if (wd not in self.wds):
+                continue
+            path = os.path.join(self.wds[wd], name)
+            if (mask & self.IN_ISDIR):
+                if (mask & (self.IN_CREATE | self.IN_MOVED_TO)):
+                    try:
+                        self._watchTree(path)
+                    except OSError as e:
+                        logging.warning("Cannot watch {}: {}".format(path, e))
+                        self.next_scan = 0
+            else:
+                self._queue(path)
+
+    def _rescan(self):
+        '''Queue new or changed files found by a manifest scan of self.paths.'''
+        for path in self.paths:
+            for filename in self.manifest.scan(path, self.patterns):
+                self._queue(filename)
+        self.unsaved = True
+
+    def ready(self, timeout=1.0):
+        '''Wait up to `timeout` seconds for activity, then return the queued files that have settled.'''
+        if (self.unsaved and not self.pending):
+            # Everything found by the last rescan has been handed over (and ingested)
+            self.manifest.save()
+            self.unsaved = False
+
+        now = time.time()
+        if (now >= self.next_scan):
+            self._rescan()
+            self.next_scan = now + self.interval if self.fd is None else float('inf')
+
+        if (self.fd is not None):
+            self._readEvents(timeout)
+        else:
+            time.sleep(min(timeout, max(0, self.next_scan - now)))
+
+        now = time.time()
+        settled = list()
+        for path, (signature, changed) in list(self.pending.items()):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self.pending[path]  # renamed or deleted before it settled
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if (current != signature):
+                self.pending[path] = (current, now)
+            elif (now - changed >= self.settle):
+                settled.append(path)
+                del self.pending[path]
+        return(sorted(settled))
+
+    def close(self):
+        '''Stop watching.'''
+        if (self.fd is not None):
+            os.close(self.fd)
+            self.fd = None